@@ -0,0 +1,56 @@
+"""Time building the same item under each ITEMS_TYPE_VALIDATION mode.
+
+Usage: python scripts/benchmark_items_validation.py [number of items]
+"""
+import sys
+import timeit
+from typing import Optional, Union
+
+import attr
+
+from ngo_toolkit.scrapers.cfi_midot_scrapy.items import (
+    ITEMS_TYPE_VALIDATION_MODES,
+    type_validators_transformer,
+)
+
+REPORT = dict(
+    ngo_id=580000000,
+    report_year=2021,
+    donations_from_israel=1_000_000.5,
+    expenses_other=250_000,
+    program_expense_ratio=None,
+    activity_fields=["חינוך", "רווחה"],
+)
+
+
+def _report_class(mode: str):
+    """A small item class, shaped like `NgoFinanceInfo`, validated by `mode`"""
+
+    @attr.s(
+        frozen=True,
+        slots=True,
+        auto_attribs=True,
+        field_transformer=type_validators_transformer(mode),
+    )
+    class Report:
+        ngo_id: int
+        report_year: int
+        donations_from_israel: Union[int, float] = 0
+        expenses_other: Union[int, float] = 0
+        program_expense_ratio: Optional[float] = None
+        activity_fields: Optional[list[str]] = None
+
+    return Report
+
+
+def main(number: int = 2_000) -> None:
+    for mode in ITEMS_TYPE_VALIDATION_MODES:
+        report_class = _report_class(mode)
+        seconds = min(
+            timeit.repeat(lambda: report_class(**REPORT), number=number, repeat=3)
+        )
+        print(f"{mode}: {seconds * 1000:.1f}ms for {number} items")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
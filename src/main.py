@@ -1,56 +1,162 @@
+import argparse
+import os
+from typing import Optional
+
 import pandas as pd
 from ngo_toolkit.uploaders.google_sheet import upload_spread_sheet
-from ngo_toolkit.scrapers.api_interaction import download_registered_ngos_ids
+from ngo_toolkit.scrapers.api_interaction import download_registry_records
 
-from ngo_toolkit.ranking.ranking_service import rank_ngos
+from ngo_toolkit.ranking.ranking_cache import RankingCache
+from ngo_toolkit.ranking.ranking_service import (
+    rank_ngos_backfill,
+    rank_ngos_incremental,
+)
+from ngo_toolkit.scheduling.recrawl_scheduler import select_ngos_to_scrape
+from ngo_toolkit.scheduling.registry_delta import (
+    RegistrySnapshot,
+    compute_registry_delta,
+)
+from ngo_toolkit.scheduling.scrape_state import ScrapeStateStore
 from ngo_toolkit.settings import settings
 
 FINANCIAL_REPORT_SHEET_NAME = "NgoFinanceInfo"
 GENERAL_REPORT_SHEET_NAME = "NgoGeneralInfo"
 RANKED_NGO_SHEET_NAME = settings.RANKED_NGO_SHEET_NAME
 
-def scrape_ngo_finance(ngos_ids: list[int]) -> None:
+def scrape_ngo_finance(
+    ngos_ids: list[int],
+    removed_ngos_ids: Optional[list[int]] = None,
+) -> None:
     from scrapy.crawler import CrawlerProcess
     from scrapy.utils.project import get_project_settings
     from ngo_toolkit.scrapers.cfi_midot_scrapy.spiders.guide_star_spider import GuideStarSpider
 
     process = CrawlerProcess(get_project_settings())
 
-    process.crawl(GuideStarSpider, ngos_ids)
+    process.crawl(
+        GuideStarSpider,
+        ngos_ids,
+        removed_ngo_ids=removed_ngos_ids,
+    )
 
     process.start()
 
 
-def main():
+def main(
+    full: bool = False,
+    offline: bool = False,
+    backfill: bool = False,
+    shards: int = 1,
+    shard_index: Optional[int] = None,
+    merge_only: bool = False,
+):
     # # Download latest registered NGOs from https://data.gov.il/dataset/moj-amutot
-    ngos_ids = download_registered_ngos_ids()
+    registry = RegistrySnapshot.from_records(download_registry_records(offline=offline))
+    ngos_ids = registry.ngo_ids.tolist()
+
+    # Only scrape NGOs that are likely to have new reports since their last scrape,
+    # and NGOs that were added or changed in the registry since the last crawl
+    due_ngos_ids = select_ngos_to_scrape(ngos_ids, ScrapeStateStore.load(), full=full)
+    registry_delta = compute_registry_delta(RegistrySnapshot.load(), registry)
+    ngos_ids = sorted(
+        set(due_ngos_ids).union(registry_delta.ngo_ids_to_scrape.tolist())
+    )
+    # NGOs that left the registry are dropped from the outputs
+    removed_ngos_ids = registry_delta.removed_ngo_ids.tolist()
 
     # # Scrape ngos
-    scrape_ngo_finance(ngos_ids)
+    if shard_index is not None:
+        from ngo_toolkit.scrapers.sharded_crawl import partition_ngo_ids, run_shard
+
+        # A single shard of a multi-node crawl, its outputs are merged by `--merge-shards`
+        shard_ngos_ids = partition_ngo_ids(ngos_ids, shards)[shard_index]
+        run_shard(shard_ngos_ids, shard_index)
+        return
+    if merge_only or shards > 1:
+        from ngo_toolkit.scrapers.sharded_crawl import crawl_sharded, merge_shards
+
+        if not merge_only:
+            crawl_sharded(ngos_ids, shards)
+        merge_shards(shards, removed_ngo_ids=removed_ngos_ids)
+    else:
+        scrape_ngo_finance(ngos_ids, removed_ngos_ids=removed_ngos_ids)
+    registry.save()
 
     # Load yearly financial reports for each NGO (FINANCIAL_FNAME), group by ngo_id
-    financial_df = pd.read_csv(f"data/{FINANCIAL_REPORT_SHEET_NAME}.csv")
+    financial_reports = pd.read_csv(f"data/{FINANCIAL_REPORT_SHEET_NAME}.csv")
 
     # Sort the financial reports by year and group by report_year
     # Each group is sorted by year in descending order
-    financial_df = financial_df.sort_values(by="report_year", ascending=True).groupby(
-        ["report_year"]
+    financial_df = financial_reports.sort_values(
+        by="report_year", ascending=True
+    ).groupby(["report_year"])
+    # Rank the NGOs for each year, years whose inputs didn't change are loaded from the cache
+    ranked_dfs, changed_years = rank_ngos_incremental(
+        financial_df, RankingCache(), workers=settings.RANKING_WORKERS
     )
-    # Rank the NGOs for each year
-    ranked_dfs = rank_ngos(financial_df)
 
     # Publish the results to a google spreadsheet
     # Update spreadsheets
     ngo_general_info = pd.read_csv(f"data/{GENERAL_REPORT_SHEET_NAME}.csv")
     upload_spread_sheet(ngo_general_info, ranked_dfs)
 
-    # Save the ranks for each year to a separate csv file
+    # Save the ranks for each year to a separate csv file, only rewriting the changed years
     for ranked_df in ranked_dfs:
-        ranked_df.to_csv(
-            f"data/{RANKED_NGO_SHEET_NAME}_{ranked_df['report_year'].iloc[0]}.csv",
-            index=False,
+        ranked_fname = f"data/{RANKED_NGO_SHEET_NAME}_{ranked_df['report_year'].iloc[0]}.csv"
+        if ranked_df["report_year"].iloc[0] in changed_years or not os.path.exists(
+            ranked_fname
+        ):
+            ranked_df.to_csv(ranked_fname, index=False)
+
+    if backfill:
+        # Historical ranks of every report year, in long format
+        rank_ngos_backfill(financial_reports).to_csv(
+            f"data/{RANKED_NGO_SHEET_NAME}History.csv", index=False
         )
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Scrape all registered NGOs, ignoring when they were last scraped",
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="Read the registered NGOs from the local registry snapshot only",
+    )
+    parser.add_argument(
+        "--backfill",
+        action="store_true",
+        help="Also rank every available report year, for historical rank series",
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        default=1,
+        help="Split the crawl to this many shards by ngo_id, crawled in parallel processes",
+    )
+    parser.add_argument(
+        "--shard-index",
+        type=int,
+        help="Only crawl this shard of --shards (multi-node crawl), to data/shards/<index>. "
+        "Every node needs the same data directory to select the same NGOs",
+    )
+    parser.add_argument(
+        "--merge-shards",
+        action="store_true",
+        help="Don't crawl, merge the outputs of --shards shards in data/shards and rank them",
+    )
+    args = parser.parse_args()
+    if args.shard_index is not None and not 0 <= args.shard_index < args.shards:
+        parser.error("--shard-index must be between 0 and --shards - 1")
+    main(
+        full=args.full,
+        offline=args.offline,
+        backfill=args.backfill,
+        shards=args.shards,
+        shard_index=args.shard_index,
+        merge_only=args.merge_shards,
+    )
@@ -0,0 +1,124 @@
+import logging
+from typing import Iterable, Optional
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Ranked columns kept in memory, from a year ranked by `rank_ngos`
+COHORT_RATIO_COLUMNS = [
+    "ngo_id",
+    "report_year",
+    "main_rank",
+    "growth_ratio",
+    "balance_ratio",
+    "max_income_ratio",
+    "admin_expense_ratio",
+    "yearly_turnover_category",
+]
+# `NgoGeneralInfo` attributes NGOs can be grouped by
+COHORT_ATTRIBUTE_COLUMNS = ["main_activity_field", "activity_fields", "target_audience"]
+# List attributes are exported to csv as comma separated values,
+# an NGO belongs to a cohort for each of their values.
+MULTI_VALUED_COLUMNS = ("activity_fields", "target_audience")
+
+
+def _grouped_pct_ranks(codes: np.ndarray, values: np.ndarray) -> tuple:
+    """Percentile rank of each value within its group (ties get their average rank, like pandas `rank(pct=True)`).
+    Sorts by (group code, value) once, so each group is a contiguous run.
+    Returns the percentile ranks, group sizes and group means aligned with the input.
+    """
+    n = len(values)
+    order = np.lexsort((values, codes))
+    sorted_codes = codes[order]
+    sorted_values = values[order]
+    positions = np.arange(n)
+
+    new_group = np.r_[True, sorted_codes[1:] != sorted_codes[:-1]]
+    group_ids = np.cumsum(new_group) - 1
+    group_starts = positions[new_group]
+    group_sizes = np.diff(np.r_[group_starts, n])
+    group_means = np.bincount(group_ids, weights=sorted_values) / group_sizes
+
+    new_tie = new_group | np.r_[True, sorted_values[1:] != sorted_values[:-1]]
+    tie_ids = np.cumsum(new_tie) - 1
+    tie_firsts = positions[new_tie]
+    tie_lasts = np.r_[tie_firsts[1:] - 1, n - 1]
+    avg_positions = (tie_firsts + tie_lasts)[tie_ids] / 2
+    sorted_pct_ranks = (avg_positions - group_starts[group_ids] + 1) / group_sizes[
+        group_ids
+    ]
+
+    pct_ranks = np.empty(n)
+    sizes = np.empty(n, dtype=int)
+    means = np.empty(n)
+    pct_ranks[order] = sorted_pct_ranks
+    sizes[order] = group_sizes[group_ids]
+    means[order] = group_means[group_ids]
+    return pct_ranks, sizes, means
+
+
+class CohortRanker:
+    """Ranks the NGOs of a ranked year within arbitrary cohorts of their attributes,
+    e.g. `main_activity_field`, or turnover category x activity field.
+
+    The ratios and the general info attributes are joined once and kept in memory.
+    The percentiles of every NGO are computed once per cohort definition and cached,
+    so a query is a lookup.
+    """
+
+    def __init__(self, ranked_year: pd.DataFrame, general_info: pd.DataFrame) -> None:
+        general_info = general_info[["ngo_id", *COHORT_ATTRIBUTE_COLUMNS]]
+        self._ngos = ranked_year[COHORT_RATIO_COLUMNS].merge(
+            general_info.drop_duplicates("ngo_id", keep="last"),
+            on="ngo_id",
+            how="left",
+        )
+        for column in MULTI_VALUED_COLUMNS:
+            if self._ngos[column].dtype == object:
+                self._ngos[column] = self._ngos[column].str.split(",")
+        self._cohort_ranks: dict[tuple, pd.DataFrame] = {}
+
+    def _compute_cohort_ranks(
+        self, cohort_keys: tuple[str, ...], value_column: str
+    ) -> pd.DataFrame:
+        ngos = self._ngos[["ngo_id", *cohort_keys, value_column]]
+        for column in cohort_keys:
+            if column in MULTI_VALUED_COLUMNS:
+                ngos = ngos.explode(column)
+        # NGOs without a value or a cohort are not ranked
+        ngos = ngos.dropna().reset_index(drop=True)
+
+        if len(cohort_keys) == 1:
+            codes, _ = pd.factorize(ngos[cohort_keys[0]])
+        else:
+            codes, _ = pd.factorize(pd.MultiIndex.from_frame(ngos[list(cohort_keys)]))
+        pct_ranks, sizes, means = _grouped_pct_ranks(
+            codes, ngos[value_column].to_numpy(dtype=float)
+        )
+
+        ngos["cohort_percentile"] = pct_ranks
+        ngos["cohort_percentile_num"] = np.ceil(pct_ranks / 0.2).astype(int)
+        ngos["cohort_size"] = sizes
+        ngos["cohort_benchmark"] = means
+        return ngos.sort_values("ngo_id", ignore_index=True)
+
+    def rank_within_cohort(
+        self,
+        cohort_keys: Iterable[str],
+        ngo_ids: Optional[Iterable[int]] = None,
+        value_column: str = "main_rank",
+    ) -> pd.DataFrame:
+        """Rank the given NGOs (all by default) by `value_column` within the cohort defined by `cohort_keys`.
+        Returns a row per NGO and cohort, with its percentile, quintile, cohort size and cohort mean.
+        """
+        cache_key = (tuple(cohort_keys), value_column)
+        if cache_key not in self._cohort_ranks:
+            logger.debug("Computing cohort ranks for %s", cache_key)
+            self._cohort_ranks[cache_key] = self._compute_cohort_ranks(*cache_key)
+
+        cohort_ranks = self._cohort_ranks[cache_key]
+        if ngo_ids is None:
+            return cohort_ranks
+        return cohort_ranks[cohort_ranks["ngo_id"].isin(list(ngo_ids))]
@@ -0,0 +1,77 @@
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable
+
+import attr
+import numpy as np
+import pandas as pd
+
+# Ranks the reports of a single year against an ngo_id x report_year turnover matrix
+RankYearFn = Callable[[pd.DataFrame, pd.DataFrame, int], pd.DataFrame]
+
+
+@attr.s(frozen=True, auto_attribs=True)
+class MemmappedMatrix:
+    """Location of a matrix written to disk, so workers can map it instead of unpickling a copy"""
+
+    values_path: str
+    index_path: str
+    columns: list[int]
+
+    @classmethod
+    def write(cls, matrix: pd.DataFrame, directory: str) -> "MemmappedMatrix":
+        values_path = os.path.join(directory, "values.npy")
+        index_path = os.path.join(directory, "index.npy")
+        np.save(values_path, matrix.to_numpy(dtype=float))
+        np.save(index_path, matrix.index.to_numpy())
+        return cls(
+            values_path=values_path,
+            index_path=index_path,
+            columns=matrix.columns.tolist(),
+        )
+
+    def load(self) -> pd.DataFrame:
+        # Pages are shared between all the workers through the OS page cache
+        values = np.load(self.values_path, mmap_mode="r")
+        index = np.load(self.index_path, mmap_mode="r")
+        return pd.DataFrame(
+            values,
+            index=pd.Index(index, name="ngo_id"),
+            columns=pd.Index(self.columns, name="report_year"),
+            copy=False,
+        )
+
+
+def _rank_year_with_shared_matrix(
+    rank_year_fn: RankYearFn,
+    shared_matrix: MemmappedMatrix,
+    year_reports: pd.DataFrame,
+    year: int,
+) -> pd.DataFrame:
+    return rank_year_fn(year_reports, shared_matrix.load(), year)
+
+
+def rank_years_in_processes(
+    rank_year_fn: RankYearFn,
+    turnover_matrix: pd.DataFrame,
+    year_reports: dict[int, pd.DataFrame],
+    max_workers: int,
+) -> list[pd.DataFrame]:
+    """Rank each year in a process pool, returned in the order of `year_reports`.
+    Workers only receive the reports of their own year, the turnover matrix is memory-mapped.
+    """
+    with tempfile.TemporaryDirectory() as matrix_dir:
+        shared_matrix = MemmappedMatrix.write(turnover_matrix, matrix_dir)
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(
+                    _rank_year_with_shared_matrix,
+                    rank_year_fn,
+                    shared_matrix,
+                    reports,
+                    year,
+                )
+                for year, reports in year_reports.items()
+            ]
+            return [future.result() for future in futures]
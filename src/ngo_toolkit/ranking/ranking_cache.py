@@ -0,0 +1,66 @@
+import hashlib
+import json
+import logging
+import os
+from typing import Optional
+
+import pandas as pd
+from pandas.core.groupby.generic import DataFrameGroupBy
+
+logger = logging.getLogger(__name__)
+
+RANKING_CACHE_DIR = "data/ranking_cache"
+# Bump when the ranking logic changes, to invalidate all the cached years
+RANKING_CACHE_VERSION = 1
+
+
+def _hash_frame(df: pd.DataFrame) -> bytes:
+    # Rows and columns order shouldn't affect the fingerprint
+    df = df[sorted(df.columns)].sort_values("ngo_id", kind="stable")
+    return pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes()
+
+
+def year_inputs_fingerprint(financial_df: DataFrameGroupBy, year: int) -> str:
+    """Fingerprint the inputs the ranking of a year depends on:
+    the reports of that year, and the turnovers of the two years before it.
+    """
+    digest = hashlib.sha256(f"{RANKING_CACHE_VERSION}:{year}".encode())
+    digest.update(_hash_frame(financial_df.get_group((year,))))
+    for previous_year in (year - 1, year - 2):
+        digest.update(f"|{previous_year}|".encode())
+        if previous_year in financial_df.groups:
+            previous_reports = financial_df.get_group((previous_year,))
+            digest.update(_hash_frame(previous_reports[["ngo_id", "yearly_turnover"]]))
+    return digest.hexdigest()
+
+
+class RankingCache:
+    """Per-year ranked outputs, stored with the fingerprint of the inputs they were computed from"""
+
+    def __init__(self, cache_dir: str = RANKING_CACHE_DIR) -> None:
+        self.cache_dir = cache_dir
+        self.manifest_path = os.path.join(cache_dir, "manifest.json")
+        os.makedirs(cache_dir, exist_ok=True)
+        self._fingerprints: dict[str, str] = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, encoding="utf-8") as manifest_file:
+                self._fingerprints = json.load(manifest_file)
+
+    def _year_path(self, year: int) -> str:
+        return os.path.join(self.cache_dir, f"{year}.pkl")
+
+    def get(self, year: int, fingerprint: str) -> Optional[pd.DataFrame]:
+        if self._fingerprints.get(str(year)) != fingerprint:
+            return None
+        if not os.path.exists(self._year_path(year)):
+            return None
+        logger.debug("Using cached ranks for %s", year)
+        return pd.read_pickle(self._year_path(year))
+
+    def put(self, year: int, fingerprint: str, ranked_df: pd.DataFrame) -> None:
+        ranked_df.to_pickle(self._year_path(year))
+        self._fingerprints[str(year)] = fingerprint
+
+    def save(self) -> None:
+        with open(self.manifest_path, "w", encoding="utf-8") as manifest_file:
+            json.dump(self._fingerprints, manifest_file, indent=2)
@@ -1,8 +1,12 @@
+import bisect
 from typing import List, Optional
 import pandas as pd
 import numpy as np
 from pandas.core.groupby.generic import DataFrameGroupBy
 
+from ngo_toolkit.ranking.parallel_ranking import rank_years_in_processes
+from ngo_toolkit.ranking.ranking_cache import RankingCache, year_inputs_fingerprint
+
 
 class Rank:
     d = 40
@@ -11,34 +15,40 @@ class Rank:
     a = 100
 
 
+# A ratio is ranked by the bucket it falls in: [-inf, t0), [t0, t1), ..., [tn, inf).
+# NaN ratios fall in the last bucket.
+GROWTH_RANK_THRESHOLDS = (-0.1, -0.05, 0.05)
+GROWTH_RANKS = (Rank.d, Rank.c, Rank.b, Rank.a)
+BALANCE_RANK_THRESHOLDS = (-0.1, -0.05, 0.05)
+BALANCE_RANKS = (Rank.d, Rank.c, Rank.b, Rank.a)
+STABILITY_RANK_THRESHOLDS = (0.5, 0.7, 0.9)
+STABILITY_RANKS = (Rank.a, Rank.b, Rank.c, Rank.d)
+
+# Weights of the sub ranks in the main rank
+GROWTH_RANK_WEIGHT = 0.4
+BALANCE_RANK_WEIGHT = 0.4
+STABILITY_RANK_WEIGHT = 0.2
+
+
+def _bucket_rank(ratio: float, thresholds: tuple, ranks: tuple) -> int:
+    return ranks[bisect.bisect_right(thresholds, ratio)]
+
+
+def bucket_ranks(ratios: pd.Series, thresholds: tuple, ranks: tuple) -> np.ndarray:
+    """Vectorized `_bucket_rank`"""
+    return np.asarray(ranks)[np.digitize(ratios, thresholds)]
+
+
 def growth_rank(growth_ratio: float) -> int:
-    if growth_ratio < -0.1:
-        return Rank.d
-    if growth_ratio < -0.05:
-        return Rank.c
-    if growth_ratio < 0.05:
-        return Rank.b
-    return Rank.a
+    return _bucket_rank(growth_ratio, GROWTH_RANK_THRESHOLDS, GROWTH_RANKS)
 
 
 def balance_rank(balance_ratio: float) -> int:
-    if balance_ratio < -0.1:
-        return Rank.d
-    if balance_ratio < -0.05:
-        return Rank.c
-    if balance_ratio < 0.05:
-        return Rank.b
-    return Rank.a
+    return _bucket_rank(balance_ratio, BALANCE_RANK_THRESHOLDS, BALANCE_RANKS)
 
 
 def stability_rank(max_income_ratio: float) -> int:
-    if max_income_ratio < 0.5:
-        return Rank.a
-    if max_income_ratio < 0.7:
-        return Rank.b
-    if max_income_ratio < 0.9:
-        return Rank.c
-    return Rank.d
+    return _bucket_rank(max_income_ratio, STABILITY_RANK_THRESHOLDS, STABILITY_RANKS)
 
 
 def compute_turnover_growth_ratio(
@@ -72,149 +82,361 @@ def compute_turnover_growth_ratio(
     return (last_turnover / old_turnover) ** (1 / years_diff) - 1
 
 
+def compute_turnover_growth_ratios(
+    *,
+    last_turnover: np.ndarray,
+    previous_turnover: np.ndarray,
+    previous_previous_turnover: np.ndarray,
+) -> np.ndarray:
+    """Vectorized `compute_turnover_growth_ratio` over aligned turnover arrays.
+    Missing turnovers are given as NaN, and are treated like None in the scalar version.
+    """
+    last_turnover = np.asarray(last_turnover, dtype=float)
+    previous_turnover = np.asarray(previous_turnover, dtype=float)
+    previous_previous_turnover = np.asarray(previous_previous_turnover, dtype=float)
+
+    last_turnover_missing = np.isnan(last_turnover) | (last_turnover == 0)
+    # Old financial report is 2 years ago if possible, otherwise 1 year ago
+    use_previous_previous = previous_previous_turnover > 25_000
+    use_previous = ~use_previous_previous & (previous_turnover > 25_000)
+
+    old_turnover = np.where(
+        use_previous_previous,
+        previous_previous_turnover,
+        np.where(use_previous, previous_turnover, np.nan),
+    )
+    years_diff = np.where(use_previous_previous, 2.0, 1.0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        growth_ratios = (last_turnover / old_turnover) ** (1 / years_diff) - 1
+
+    return np.select(
+        [last_turnover_missing, use_previous_previous | use_previous],
+        [-0.25, growth_ratios],
+        default=1.0,
+    )
+
+
+def build_turnover_matrix(financial_reports: pd.DataFrame) -> pd.DataFrame:
+    """Pivot the financial reports to an ngo_id x report_year matrix of yearly turnovers"""
+    financial_reports = financial_reports.drop_duplicates(
+        ["ngo_id", "report_year"], keep="last"
+    )
+    return financial_reports.pivot(
+        index="ngo_id", columns="report_year", values="yearly_turnover"
+    )
+
+
+# Percentile `n` is labeled by PERCENTILE_LABELS[n - 1]
+PERCENTILE_LABELS = (
+    "נמוך מאוד ביחס לקט' מחזור",
+    "נמוך ביחס לקט' מחזור",
+    "דומה ביחס לקט' מחזור",
+    "גבוה ביחס לקט' מחזור",
+    "גבוה מאוד ביחס לקט' מחזור",
+)
+
+# Benchmark column: the ratio averaged over each turnover category
+BENCHMARK_COLUMNS = {
+    "admin_expense_benchmark": "admin_expense_ratio",
+    "growth_benchmark": "growth_ratio",
+    "balance_benchmark": "balance_ratio",
+    "max_income_benchmark": "max_income_ratio",
+    # The mean for the main rank for each turnover category
+    "main_rank_benchmark": "main_rank",
+}
+
+
 def percentile_label(percentile: int) -> str:
-    match percentile:
-        case 1:
-            return "נמוך מאוד ביחס לקט' מחזור"
-        case 2:
-            return "נמוך ביחס לקט' מחזור"
-        case 3:
-            return "דומה ביחס לקט' מחזור"
-        case 4:
-            return "גבוה ביחס לקט' מחזור"
-        case 5:
-            return "גבוה מאוד ביחס לקט' מחזור"
-        case _:
-            raise ValueError("No matching percentile: ", percentile)
-
-
-def rank_ngos(financial_df: DataFrameGroupBy) -> List[pd.DataFrame]:
-    """Rank the NGOs based on their financial reports.
-    The ranks are calculated for each year and for each ratio,
-    based on the NGO's turnover category.
-    The given financial_df is a grouped dataframe,
-    where each group represents the financial reports of a single year.
+    if percentile not in range(1, len(PERCENTILE_LABELS) + 1):
+        raise ValueError("No matching percentile: ", percentile)
+    return PERCENTILE_LABELS[percentile - 1]
+
+
+def percentile_labels(percentiles: pd.Series) -> pd.Series:
+    """Vectorized `percentile_label`"""
+    if not percentiles.between(1, len(PERCENTILE_LABELS)).all():
+        raise ValueError("No matching percentile: ", percentiles.unique())
+    labels = pd.Categorical.from_codes(percentiles - 1, categories=PERCENTILE_LABELS)
+    return pd.Series(labels, index=percentiles.index).astype(object)
 
-    """
-    # To fixSettingWithCopyWarning:  https://stackoverflow.com/questions/20625582/how-to-deal-with-settingwithcopywarning-in-pandas
-    pd.options.mode.chained_assignment = None  # default='warn'
 
+def _years_to_rank(financial_df: DataFrameGroupBy) -> range:
     max_year = max(financial_df.groups.keys())
-    # Merge the financial reports in order to calculate the ratios
-    merged_df = pd.DataFrame()
-    # Merge the grouped financial reports for each year
-    for year in financial_df.groups.keys():
-        group = financial_df.get_group((year,))
-        # Get the financial reports for the current year
-        if merged_df.empty:
-            merged_df = group
-        else:
-            # Merge the current year financial reports with the previous years
-            merged_df = merged_df.merge(
-                group, on="ngo_id", how="outer", suffixes=("", f"_{year}")
-            )
-
-    financial_infos = []
     # Define for how many years including the last one we want to calculate the ranks for.
     num_of_years_to_rank = 3
-    years_to_rank = range(max_year, max_year - num_of_years_to_rank, -1)
-
-    for year in years_to_rank:
-        # Get the financial reports for the current year
-        financial_info = financial_df.get_group((year,))
-        # Add Multi-years ratios
-        growth_ratios = merged_df.apply(
-            lambda row: compute_turnover_growth_ratio(
-                last_turnover=row.get(f"yearly_turnover_{year}", None),
-                previous_turnover=row.get(f"yearly_turnover_{year - 1}", None),
-                previous_previous_turnover=row.get(f"yearly_turnover_{year - 2}", None),
-            ),
-            axis=1,
-        )
-        # Merge it with the multi-years ratios
-        financial_info = financial_info.merge(
-            pd.DataFrame(
-                {"ngo_id": merged_df["ngo_id"], "growth_ratio": growth_ratios}
-            ),
-            on="ngo_id",
-            how="left",
+    return range(max_year, max_year - num_of_years_to_rank, -1)
+
+
+def _add_ranks(financial_info: pd.DataFrame) -> None:
+    """Rank the ngo based on its ratios"""
+    financial_info["growth_rank"] = bucket_ranks(
+        financial_info["growth_ratio"], GROWTH_RANK_THRESHOLDS, GROWTH_RANKS
+    ).astype(int)
+    financial_info["balance_rank"] = bucket_ranks(
+        financial_info["balance_ratio"], BALANCE_RANK_THRESHOLDS, BALANCE_RANKS
+    ).astype(int)
+    financial_info["stability_rank"] = bucket_ranks(
+        financial_info["max_income_ratio"],
+        STABILITY_RANK_THRESHOLDS,
+        STABILITY_RANKS,
+    ).astype(int)
+
+    # Calculate the main rank
+    financial_info["main_rank"] = (
+        GROWTH_RANK_WEIGHT * financial_info["growth_rank"]
+        + BALANCE_RANK_WEIGHT * financial_info["balance_rank"]
+        + STABILITY_RANK_WEIGHT * financial_info["stability_rank"]
+    ).astype(int)
+
+
+def _add_category_stats(financial_info: pd.DataFrame, group_keys: list[str]) -> None:
+    """Add means and percentile relative to the turnover category.
+    `group_keys` ends with the turnover category, and may start with the report year.
+    """
+    # Calculate the percentile
+    grouped_df = financial_info.groupby(group_keys)
+    financial_info["percentile_num"] = np.ceil(
+        grouped_df["main_rank"].transform("rank", pct=True).values / 0.2
+    ).astype(int)
+    financial_info["percentile_label"] = percentile_labels(
+        financial_info["percentile_num"]
+    )
+
+    # Add the means for each ratio for each turnover category, in a single aggregation
+    category_means = grouped_df[list(BENCHMARK_COLUMNS.values())].mean()
+    if len(group_keys) == 1:
+        category_keys = financial_info[group_keys[0]]
+    else:
+        category_keys = pd.MultiIndex.from_frame(financial_info[group_keys])
+    benchmarks = category_means.reindex(category_keys)
+    for benchmark_column, ratio_column in BENCHMARK_COLUMNS.items():
+        financial_info[benchmark_column] = benchmarks[ratio_column].to_numpy()
+
+
+def _rank_year(
+    year_reports: pd.DataFrame, turnover_matrix: pd.DataFrame, year: int
+) -> pd.DataFrame:
+    """Rank the NGOs that reported for the given year, relative to their turnover category"""
+    # Get the financial reports for the current year
+    financial_info = year_reports.reset_index(drop=True)
+    # Turnovers of the current year and the two before it, missing years are NaN
+    turnovers = turnover_matrix.reindex(
+        index=financial_info["ngo_id"], columns=[year, year - 1, year - 2]
+    )
+    # Add Multi-years ratios
+    financial_info["growth_ratio"] = compute_turnover_growth_ratios(
+        last_turnover=turnovers[year].to_numpy(),
+        previous_turnover=turnovers[year - 1].to_numpy(),
+        previous_previous_turnover=turnovers[year - 2].to_numpy(),
+    )
+    for i in range(1, 3):
+        financial_info[f"yearly_turnover_{year-i}"] = turnovers[year - i].to_numpy()
+
+    _add_ranks(financial_info)
+    _add_category_stats(financial_info, ["yearly_turnover_category"])
+
+    return financial_info
+
+
+# Ranks compared with the previous year's ranks of the same NGO
+RANK_DELTA_COLUMNS = ["main_rank", "growth_rank", "balance_rank", "stability_rank"]
+
+
+def _matrix_lookup(
+    matrix: pd.DataFrame, ngo_ids: pd.Series, years: pd.Series
+) -> np.ndarray:
+    """Gather matrix[ngo_id, year] for each (ngo_id, year) pair, NaN where the year is missing"""
+    rows = matrix.index.get_indexer(ngo_ids)
+    cols = matrix.columns.get_indexer(years)
+    values = matrix.to_numpy(dtype=float)[rows, np.maximum(cols, 0)]
+    values[cols < 0] = np.nan
+    return values
+
+
+def _rank_year_over_year(ranks: pd.DataFrame) -> pd.DataFrame:
+    """Compare each (ngo_id, report_year) ranks row with the ranks of the same NGO on the previous year.
+    Rows are joined on ngo_id across all the years at once, using ngo_id x year rank matrices.
+    Returns a frame aligned with `ranks`, holding the rank deltas (NaN if the NGO wasn't ranked
+    on the previous year) and the `is_new_this_year`/`is_dropped_next_year` flags
+    (NA when the previous/next year is outside the given years).
+    """
+    unique_ranks = ranks.drop_duplicates(["ngo_id", "report_year"], keep="last")
+    years = range(ranks["report_year"].min(), ranks["report_year"].max() + 1)
+    year_over_year = pd.DataFrame(index=ranks.index)
+
+    for rank_column in RANK_DELTA_COLUMNS:
+        rank_matrix = unique_ranks.pivot(
+            index="ngo_id", columns="report_year", values=rank_column
+        ).reindex(columns=years)
+        year_over_year[f"{rank_column}_vs_previous_year_rank"] = _matrix_lookup(
+            rank_matrix - rank_matrix.shift(1, axis=1),
+            ranks["ngo_id"],
+            ranks["report_year"],
         )
 
-        # Merge the financial reports for the current year with the multi-years ratios
-        for i in range(1, 3):
-            financial_info = financial_info.merge(
-                merged_df[["ngo_id", f"yearly_turnover_{year-i}"]],
-                on="ngo_id",
-                how="left",
-            )
-
-        # Rank the ngo based on the ratios for each year
-        financial_info["growth_rank"] = (
-            financial_info["growth_ratio"].apply(growth_rank).astype(int)
-        )
-        financial_info["balance_rank"] = (
-            financial_info["balance_ratio"].apply(balance_rank).astype(int)
+    # 1.0 where the NGO is ranked on that year, NaN shifted in outside the given years
+    ranked_matrix = rank_matrix.notna().astype(float)
+    for flag_column, shift in (("is_new_this_year", 1), ("is_dropped_next_year", -1)):
+        neighbour_ranked = _matrix_lookup(
+            ranked_matrix.shift(shift, axis=1), ranks["ngo_id"], ranks["report_year"]
         )
-        financial_info["stability_rank"] = (
-            financial_info["max_income_ratio"].apply(stability_rank).astype(int)
+        year_over_year[flag_column] = pd.array(
+            np.where(np.isnan(neighbour_ranked), None, neighbour_ranked == 0),
+            dtype="boolean",
         )
 
-        # Calculate the main rank for each year
-        financial_info["main_rank"] = (
-            0.4 * financial_info["growth_rank"]
-            + 0.4 * financial_info["balance_rank"]
-            + 0.2 * financial_info["stability_rank"]
-        ).astype(int)
-
-        # Add means and percentile relative to the turnover category.
-
-        # Calculate the percentile
-        grouped_df = financial_info.groupby("yearly_turnover_category")
-        financial_info["percentile_num"] = np.ceil(
-            grouped_df["main_rank"].transform("rank", pct=True).values / 0.2
-        ).astype(int)
-        financial_info["percentile_label"] = financial_info["percentile_num"].apply(
-            percentile_label
-        )
+    return year_over_year
 
-        # Add the means for each ratio for each turnover category
-        financial_info["admin_expense_benchmark"] = grouped_df[
-            "admin_expense_ratio"
-        ].transform("mean")
-        financial_info["growth_benchmark"] = grouped_df["growth_ratio"].transform(
-            "mean"
-        )
-        financial_info["balance_benchmark"] = grouped_df["balance_ratio"].transform(
-            "mean"
-        )
-        financial_info["max_income_benchmark"] = grouped_df[
-            "max_income_ratio"
-        ].transform("mean")
-        # Add the mean for the main rank for each turnover category
-        financial_info["main_rank_benchmark"] = grouped_df["main_rank"].transform(
-            "mean"
+
+def _add_rank_deltas(financial_infos: List[pd.DataFrame]) -> None:
+    """Add the differences between the yearly ranks (21vs20, 20vs19 etc), given the ranks from the latest year.
+    The oldest year has no deltas nor "new" flags, and the latest year has no "dropped" flag.
+    """
+    if not financial_infos:
+        return
+
+    ranks = pd.concat(
+        [
+            financial_info[["ngo_id", "report_year", *RANK_DELTA_COLUMNS]]
+            for financial_info in financial_infos
+        ],
+        ignore_index=True,
+    )
+    year_over_year = _rank_year_over_year(ranks)
+
+    offsets = np.cumsum([0] + [len(financial_info) for financial_info in financial_infos])
+    last_idx = len(financial_infos) - 1
+    for idx, financial_info in enumerate(financial_infos):
+        year_rows = year_over_year.iloc[offsets[idx] : offsets[idx + 1]]
+        for column in year_over_year.columns:
+            if idx == last_idx and column != "is_dropped_next_year":
+                continue
+            if idx == 0 and column == "is_dropped_next_year":
+                continue
+            financial_info[column] = year_rows[column].to_numpy()
+
+
+def _rank_years(
+    financial_df: DataFrameGroupBy, years: List[int], workers: int = 1
+) -> List[pd.DataFrame]:
+    """Rank the given years, in a process pool when `workers` > 1"""
+    if not years:
+        return []
+
+    # Turnovers of all the years, so per-year lookups are aligned column slices
+    turnover_matrix = build_turnover_matrix(financial_df.obj)
+    year_reports = {year: financial_df.get_group((year,)) for year in years}
+    if workers > 1 and len(years) > 1:
+        return rank_years_in_processes(
+            _rank_year, turnover_matrix, year_reports, max_workers=workers
         )
+    return [
+        _rank_year(reports, turnover_matrix, year)
+        for year, reports in year_reports.items()
+    ]
 
-        financial_infos.append(financial_info)
 
-    # Calculate the differences between the yearly ranks (21vs20, 20vs19 etc).
-    for idx, financial_info in enumerate(financial_infos[: len(financial_infos) - 1]):
-        year = financial_info["report_year"]
-        previous_financial_info = financial_infos[idx + 1]
+def rank_ngos(financial_df: DataFrameGroupBy, workers: int = 1) -> List[pd.DataFrame]:
+    """Rank the NGOs based on their financial reports.
+    The ranks are calculated for each year and for each ratio,
+    based on the NGO's turnover category.
+    The given financial_df is a grouped dataframe,
+    where each group represents the financial reports of a single year.
+    Years are ranked in `workers` processes.
 
-        year_diff_suffix = "_vs_previous_year_rank"
+    """
+    # To fixSettingWithCopyWarning:  https://stackoverflow.com/questions/20625582/how-to-deal-with-settingwithcopywarning-in-pandas
+    pd.options.mode.chained_assignment = None  # default='warn'
 
-        financial_info[f"main_rank{year_diff_suffix}"] = (
-            financial_info["main_rank"] - previous_financial_info["main_rank"]
-        )
-        financial_info[f"growth_rank{year_diff_suffix}"] = (
-            financial_info["growth_rank"] - previous_financial_info["growth_rank"]
-        )
-        financial_info[f"balance_rank{year_diff_suffix}"] = (
-            financial_info["balance_rank"] - previous_financial_info["balance_rank"]
-        )
-        financial_info[f"stability_rank{year_diff_suffix}"] = (
-            financial_info["stability_rank"] - previous_financial_info["stability_rank"]
-        )
+    financial_infos = _rank_years(
+        financial_df, list(_years_to_rank(financial_df)), workers
+    )
+    _add_rank_deltas(financial_infos)
 
     return financial_infos
+
+
+def rank_ngos_incremental(
+    financial_df: DataFrameGroupBy, cache: RankingCache, workers: int = 1
+) -> tuple[List[pd.DataFrame], set[int]]:
+    """Same as `rank_ngos`, but only recomputes the years whose inputs changed since they were cached.
+    Returns the ranked years and the years whose output changed: the recomputed years,
+    the years following them (their rank deltas changed) and the years preceding them
+    (their `is_dropped_next_year` flags changed).
+    """
+    pd.options.mode.chained_assignment = None  # default='warn'
+
+    years_to_rank = list(_years_to_rank(financial_df))
+    fingerprints = {
+        year: year_inputs_fingerprint(financial_df, year) for year in years_to_rank
+    }
+    ranked_years = {year: cache.get(year, fingerprints[year]) for year in years_to_rank}
+
+    recomputed_years = [year for year, ranked in ranked_years.items() if ranked is None]
+    for year, financial_info in zip(
+        recomputed_years, _rank_years(financial_df, recomputed_years, workers)
+    ):
+        # Cached before the deltas are added, they depend on the other years
+        cache.put(year, fingerprints[year], financial_info)
+        ranked_years[year] = financial_info
+    cache.save()
+
+    financial_infos = [ranked_years[year] for year in years_to_rank]
+
+    _add_rank_deltas(financial_infos)
+
+    changed_years = {
+        changed_year
+        for year in recomputed_years
+        for changed_year in (year - 1, year, year + 1)
+    }
+    return financial_infos, changed_years & set(years_to_rank)
+
+
+def rank_ngos_backfill(financial_reports: pd.DataFrame) -> pd.DataFrame:
+    """Rank every report year at once, for historical rank series.
+    Works on a single ngo_id x report_year matrix, so the growth lookbacks and the
+    year-over-year deltas are whole-matrix shifts instead of per-year merges.
+    Rows also get the `is_new_this_year`/`is_dropped_next_year` flags.
+    Returns a long-format frame, one row per (ngo_id, report_year), with the same
+    ranking columns as `rank_ngos`. The turnovers of the two previous years are named
+    `previous_yearly_turnover` and `previous_previous_yearly_turnover`.
+    """
+    ranked = financial_reports.drop_duplicates(
+        ["ngo_id", "report_year"], keep="last"
+    ).reset_index(drop=True)
+
+    # Contiguous years, so shifting a column by one is exactly one year back
+    turnover_matrix = build_turnover_matrix(ranked)
+    all_years = range(turnover_matrix.columns.min(), turnover_matrix.columns.max() + 1)
+    turnover_matrix = turnover_matrix.reindex(columns=all_years)
+    previous_turnover_matrix = turnover_matrix.shift(1, axis=1)
+    previous_previous_turnover_matrix = turnover_matrix.shift(2, axis=1)
+
+    growth_matrix = pd.DataFrame(
+        compute_turnover_growth_ratios(
+            last_turnover=turnover_matrix.to_numpy(),
+            previous_turnover=previous_turnover_matrix.to_numpy(),
+            previous_previous_turnover=previous_previous_turnover_matrix.to_numpy(),
+        ),
+        index=turnover_matrix.index,
+        columns=turnover_matrix.columns,
+    )
+    ranked["growth_ratio"] = _matrix_lookup(
+        growth_matrix, ranked["ngo_id"], ranked["report_year"]
+    )
+    ranked["previous_yearly_turnover"] = _matrix_lookup(
+        previous_turnover_matrix, ranked["ngo_id"], ranked["report_year"]
+    )
+    ranked["previous_previous_yearly_turnover"] = _matrix_lookup(
+        previous_previous_turnover_matrix, ranked["ngo_id"], ranked["report_year"]
+    )
+
+    _add_ranks(ranked)
+    _add_category_stats(ranked, ["report_year", "yearly_turnover_category"])
+
+    year_over_year = _rank_year_over_year(ranked)
+    for column in year_over_year.columns:
+        ranked[column] = year_over_year[column].to_numpy()
+
+    return ranked.sort_values(["report_year", "ngo_id"], ignore_index=True)
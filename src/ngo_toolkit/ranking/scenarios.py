@@ -0,0 +1,155 @@
+from typing import List
+
+import attr
+import numpy as np
+import pandas as pd
+
+from ngo_toolkit.ranking.ranking_service import (
+    BALANCE_RANK_THRESHOLDS,
+    BALANCE_RANK_WEIGHT,
+    BALANCE_RANKS,
+    GROWTH_RANK_THRESHOLDS,
+    GROWTH_RANK_WEIGHT,
+    GROWTH_RANKS,
+    STABILITY_RANK_THRESHOLDS,
+    STABILITY_RANK_WEIGHT,
+    STABILITY_RANKS,
+)
+
+# Ratios each scenario is evaluated on, as computed by `rank_ngos`
+SCENARIO_RATIO_COLUMNS = [
+    "ngo_id",
+    "growth_ratio",
+    "balance_ratio",
+    "max_income_ratio",
+    "yearly_turnover_category",
+]
+
+
+@attr.s(frozen=True, auto_attribs=True)
+class RankingScenario:
+    """A set of ranking parameters. Defaults to the parameters used by `rank_ngos`"""
+
+    name: str
+    growth_weight: float = GROWTH_RANK_WEIGHT
+    balance_weight: float = BALANCE_RANK_WEIGHT
+    stability_weight: float = STABILITY_RANK_WEIGHT
+    growth_thresholds: tuple = GROWTH_RANK_THRESHOLDS
+    balance_thresholds: tuple = BALANCE_RANK_THRESHOLDS
+    stability_thresholds: tuple = STABILITY_RANK_THRESHOLDS
+
+
+BASELINE_SCENARIO = RankingScenario(name="baseline")
+
+
+@attr.s(frozen=True, auto_attribs=True, eq=False)
+class ScenarioResults:
+    # scenario x ngo_id
+    main_ranks: pd.DataFrame
+    percentiles: pd.DataFrame
+    # scenario x main rank value, number of NGOs with that main rank
+    rank_distribution: pd.DataFrame
+    # Per scenario, compared with the baseline scenario
+    summary: pd.DataFrame
+
+
+def _bucket_ranks_per_scenario(
+    ratios: np.ndarray, thresholds: np.ndarray, ranks: tuple
+) -> np.ndarray:
+    """(K x N) version of `bucket_ranks`, for K threshold sets of the same length.
+    NaN ratios fall in the last bucket, as in `bucket_ranks`.
+    """
+    # Number of thresholds <= ratio is the bucket index, same as bisect_right
+    buckets = (ratios[None, :, None] >= thresholds[:, None, :]).sum(axis=2)
+    buckets = np.where(np.isnan(ratios)[None, :], thresholds.shape[1], buckets)
+    return np.asarray(ranks)[buckets]
+
+
+def _percentiles_per_scenario(
+    main_ranks: np.ndarray, categories: pd.Series
+) -> np.ndarray:
+    """Quintile of each NGO's main rank within its turnover category, for every scenario"""
+    percentiles = np.zeros(main_ranks.shape, dtype=int)
+    for category_idx in categories.groupby(categories).indices.values():
+        # Ranked along the NGOs of the category, for all the scenarios at once
+        pct_ranks = pd.DataFrame(main_ranks[:, category_idx]).rank(axis=1, pct=True)
+        percentiles[:, category_idx] = np.ceil(pct_ranks.to_numpy() / 0.2).astype(int)
+    return percentiles
+
+
+def evaluate_scenarios(
+    ratios: pd.DataFrame,
+    scenarios: List[RankingScenario],
+    baseline: RankingScenario = BASELINE_SCENARIO,
+) -> ScenarioResults:
+    """Rank the same NGOs under each scenario, as a single (scenarios x NGOs) computation.
+    `ratios` holds `SCENARIO_RATIO_COLUMNS`, e.g. a year ranked by `rank_ngos`.
+    """
+    scenarios = [baseline] + [
+        scenario for scenario in scenarios if scenario.name != baseline.name
+    ]
+    ratios = ratios[SCENARIO_RATIO_COLUMNS].reset_index(drop=True)
+
+    def scenario_params(param: str) -> np.ndarray:
+        return np.array([getattr(scenario, param) for scenario in scenarios], dtype=float)
+
+    growth_ranks = _bucket_ranks_per_scenario(
+        ratios["growth_ratio"].to_numpy(dtype=float),
+        scenario_params("growth_thresholds"),
+        GROWTH_RANKS,
+    )
+    balance_ranks = _bucket_ranks_per_scenario(
+        ratios["balance_ratio"].to_numpy(dtype=float),
+        scenario_params("balance_thresholds"),
+        BALANCE_RANKS,
+    )
+    stability_ranks = _bucket_ranks_per_scenario(
+        ratios["max_income_ratio"].to_numpy(dtype=float),
+        scenario_params("stability_thresholds"),
+        STABILITY_RANKS,
+    )
+    main_ranks = (
+        scenario_params("growth_weight")[:, None] * growth_ranks
+        + scenario_params("balance_weight")[:, None] * balance_ranks
+        + scenario_params("stability_weight")[:, None] * stability_ranks
+    ).astype(int)
+    percentiles = _percentiles_per_scenario(
+        main_ranks, ratios["yearly_turnover_category"]
+    )
+
+    scenario_names = pd.Index([scenario.name for scenario in scenarios], name="scenario")
+    ngo_ids = pd.Index(ratios["ngo_id"], name="ngo_id")
+
+    rank_values, rank_value_idx = np.unique(main_ranks, return_inverse=True)
+    rank_value_idx = rank_value_idx.reshape(main_ranks.shape)
+    rank_distribution = np.zeros((len(scenarios), len(rank_values)), dtype=int)
+    for scenario_idx in range(len(scenarios)):
+        rank_distribution[scenario_idx] = np.bincount(
+            rank_value_idx[scenario_idx], minlength=len(rank_values)
+        )
+
+    # The baseline is always the first scenario
+    rank_changes = main_ranks - main_ranks[0]
+    percentile_changes = percentiles - percentiles[0]
+    summary = pd.DataFrame(
+        {
+            "mean_main_rank": main_ranks.mean(axis=1),
+            "mean_rank_change": rank_changes.mean(axis=1),
+            "mean_abs_rank_change": np.abs(rank_changes).mean(axis=1),
+            "share_rank_up": (rank_changes > 0).mean(axis=1),
+            "share_rank_down": (rank_changes < 0).mean(axis=1),
+            "share_percentile_changed": (percentile_changes != 0).mean(axis=1),
+        },
+        index=scenario_names,
+    )
+
+    return ScenarioResults(
+        main_ranks=pd.DataFrame(main_ranks, index=scenario_names, columns=ngo_ids),
+        percentiles=pd.DataFrame(percentiles, index=scenario_names, columns=ngo_ids),
+        rank_distribution=pd.DataFrame(
+            rank_distribution,
+            index=scenario_names,
+            columns=pd.Index(rank_values, name="main_rank"),
+        ),
+        summary=summary,
+    )
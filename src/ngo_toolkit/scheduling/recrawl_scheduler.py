@@ -0,0 +1,63 @@
+import logging
+from datetime import datetime, timedelta
+from typing import Optional
+
+from ngo_toolkit.scheduling.scrape_state import (
+    FilterReason,
+    NgoScrapeState,
+    ScrapeOutcome,
+    ScrapeStateStore,
+)
+from ngo_toolkit.settings import settings
+
+logger = logging.getLogger(__name__)
+
+
+def _filtered_recrawl_days(filter_reason: Optional[FilterReason]) -> int:
+    if filter_reason == FilterReason.LOW_TURNOVER:
+        return settings.RECRAWL_LOW_TURNOVER_DAYS
+    if filter_reason == FilterReason.MISSING:
+        return settings.RECRAWL_MISSING_DAYS
+    # Also the states saved before filter reasons were kept
+    return settings.RECRAWL_NO_FINANCES_DAYS
+
+
+def _recrawl_interval(state: NgoScrapeState, now: datetime) -> timedelta:
+    """How long to wait before scraping an NGO again, based on its last scrape"""
+    if state.last_outcome == ScrapeOutcome.FAILED:
+        return timedelta(0)
+    if state.last_outcome == ScrapeOutcome.FILTERED:
+        return timedelta(days=_filtered_recrawl_days(state.filter_reason))
+    if state.last_report_year and state.last_report_year >= now.year - 1:
+        # The latest report is already for last year, the next one isn't due soon
+        return timedelta(days=settings.RECRAWL_UP_TO_DATE_DAYS)
+    return timedelta(days=settings.RECRAWL_OUTDATED_DAYS)
+
+
+def is_due_for_scrape(state: Optional[NgoScrapeState], now: datetime) -> bool:
+    if state is None:
+        # Never scraped
+        return True
+    return now - state.last_scraped_at >= _recrawl_interval(state, now)
+
+
+def select_ngos_to_scrape(
+    ngo_ids: list[int],
+    store: ScrapeStateStore,
+    now: Optional[datetime] = None,
+    full: bool = False,
+) -> list[int]:
+    """Select the NGOs that are likely to have new reports since they were last scraped.
+    When `full` is set, all the given NGOs are selected.
+    """
+    if full:
+        return list(ngo_ids)
+
+    now = now or datetime.now()
+    due_ngo_ids = [
+        ngo_id for ngo_id in ngo_ids if is_due_for_scrape(store.get(ngo_id), now)
+    ]
+    logger.info(
+        "Selected %s out of %s NGOs for scraping", len(due_ngo_ids), len(ngo_ids)
+    )
+    return due_ngo_ids
@@ -0,0 +1,92 @@
+import logging
+import os
+from typing import Optional
+
+import attr
+import numpy as np
+import pandas as pd
+
+from ngo_toolkit.scrapers.api_interaction import NGO_ID_FIELD
+
+logger = logging.getLogger(__name__)
+
+# The registry as it was on the last completed crawl
+REGISTRY_BASELINE_PATH = "data/registry_baseline.npz"
+
+
+@attr.s(frozen=True, auto_attribs=True, eq=False)
+class RegistrySnapshot:
+    """Compact form of the registry: sorted unique NGO ids, aligned with a hash of each registry row"""
+
+    ngo_ids: np.ndarray
+    row_hashes: np.ndarray
+
+    @classmethod
+    def from_records(cls, records: list[dict]) -> "RegistrySnapshot":
+        registry_df = pd.DataFrame.from_records(records)
+        registry_df[NGO_ID_FIELD] = registry_df[NGO_ID_FIELD].astype(np.int64)
+        registry_df = registry_df.drop_duplicates(NGO_ID_FIELD, keep="last")
+        registry_df = registry_df.sort_values(NGO_ID_FIELD)
+        # The hash shouldn't depend on the order of the registry columns
+        registry_df = registry_df[sorted(registry_df.columns)]
+        row_hashes = pd.util.hash_pandas_object(registry_df.astype(str), index=False)
+        return cls(
+            ngo_ids=registry_df[NGO_ID_FIELD].to_numpy(),
+            row_hashes=row_hashes.to_numpy(),
+        )
+
+    @classmethod
+    def load(cls, path: str = REGISTRY_BASELINE_PATH) -> Optional["RegistrySnapshot"]:
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as baseline:
+            return cls(ngo_ids=baseline["ngo_ids"], row_hashes=baseline["row_hashes"])
+
+    def save(self, path: str = REGISTRY_BASELINE_PATH) -> None:
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as baseline_file:
+            np.savez(baseline_file, ngo_ids=self.ngo_ids, row_hashes=self.row_hashes)
+        os.replace(tmp_path, path)
+
+
+@attr.s(frozen=True, auto_attribs=True, eq=False)
+class RegistryDelta:
+    new_ngo_ids: np.ndarray
+    removed_ngo_ids: np.ndarray
+    changed_ngo_ids: np.ndarray
+
+    @property
+    def ngo_ids_to_scrape(self) -> np.ndarray:
+        return np.union1d(self.new_ngo_ids, self.changed_ngo_ids)
+
+
+def compute_registry_delta(
+    previous: Optional[RegistrySnapshot], current: RegistrySnapshot
+) -> RegistryDelta:
+    """Diff two registry snapshots using their sorted id arrays.
+    Without a previous snapshot, all the NGOs are new.
+    """
+    if previous is None:
+        empty = np.array([], dtype=current.ngo_ids.dtype)
+        return RegistryDelta(
+            new_ngo_ids=current.ngo_ids, removed_ngo_ids=empty, changed_ngo_ids=empty
+        )
+
+    common_ngo_ids, current_idx, previous_idx = np.intersect1d(
+        current.ngo_ids, previous.ngo_ids, assume_unique=True, return_indices=True
+    )
+    changed = current.row_hashes[current_idx] != previous.row_hashes[previous_idx]
+    delta = RegistryDelta(
+        new_ngo_ids=np.setdiff1d(current.ngo_ids, previous.ngo_ids, assume_unique=True),
+        removed_ngo_ids=np.setdiff1d(
+            previous.ngo_ids, current.ngo_ids, assume_unique=True
+        ),
+        changed_ngo_ids=common_ngo_ids[changed],
+    )
+    logger.info(
+        "Registry delta: %s new, %s removed, %s changed NGOs",
+        len(delta.new_ngo_ids),
+        len(delta.removed_ngo_ids),
+        len(delta.changed_ngo_ids),
+    )
+    return delta
@@ -0,0 +1,147 @@
+import csv
+import logging
+import os
+from datetime import datetime
+from enum import Enum
+from typing import Callable, Iterator, Optional
+
+import attr
+
+logger = logging.getLogger(__name__)
+
+SCRAPE_STATE_FILENAME = "NgoScrapeState.csv"
+SCRAPE_STATE_PATH = os.path.join("data", SCRAPE_STATE_FILENAME)
+
+
+class ScrapeOutcome(Enum):
+    """The result of the last scrape of an NGO"""
+
+    OK = "ok"
+    FILTERED = "filtered"
+    FAILED = "failed"
+
+
+class FilterReason(Enum):
+    """Why a filtered NGO is not worth scraping for a while, each waits its own interval"""
+
+    NO_FINANCES = "no_finances"  # No financial report on GuideStar
+    LOW_TURNOVER = "low_turnover"  # Filtered out by its yearly turnover
+    MISSING = "missing"  # GuideStar doesn't know it (404/410 page, "not found" reply)
+
+
+@attr.s(frozen=True, auto_attribs=True)
+class NgoScrapeState:
+    ngo_id: int = attr.ib(converter=int)
+    last_scraped_at: datetime
+    last_outcome: ScrapeOutcome
+    # The latest financial report year seen on GuideStar
+    last_report_year: Optional[int] = None
+    # Set when the last outcome is FILTERED
+    filter_reason: Optional[FilterReason] = None
+
+
+class ScrapeStateStore:
+    """Persistent per-NGO scrape state, kept as a csv file keyed by ngo_id"""
+
+    fieldnames = [
+        "ngo_id",
+        "last_scraped_at",
+        "last_outcome",
+        "last_report_year",
+        "filter_reason",
+    ]
+
+    def __init__(self, path: str = SCRAPE_STATE_PATH) -> None:
+        self.path = path
+        self._states: dict[int, NgoScrapeState] = {}
+
+    @classmethod
+    def load(cls, path: str = SCRAPE_STATE_PATH) -> "ScrapeStateStore":
+        store = cls(path)
+        if not os.path.exists(path):
+            logger.info("No scrape state found at %s, starting fresh", path)
+            return store
+
+        with open(path, newline="", encoding="utf-8") as state_file:
+            for row in csv.DictReader(state_file):
+                state = NgoScrapeState(
+                    ngo_id=row["ngo_id"],
+                    last_scraped_at=datetime.fromisoformat(row["last_scraped_at"]),
+                    last_outcome=ScrapeOutcome(row["last_outcome"]),
+                    last_report_year=(
+                        int(row["last_report_year"]) if row["last_report_year"] else None
+                    ),
+                    # Missing from the states saved before filter reasons were kept
+                    filter_reason=(
+                        FilterReason(row["filter_reason"])
+                        if row.get("filter_reason")
+                        else None
+                    ),
+                )
+                store._states[state.ngo_id] = state
+        return store
+
+    def __len__(self) -> int:
+        return len(self._states)
+
+    def __iter__(self) -> Iterator[NgoScrapeState]:
+        return iter(self._states.values())
+
+    def get(self, ngo_id: int) -> Optional[NgoScrapeState]:
+        return self._states.get(ngo_id)
+
+    def record(
+        self,
+        ngo_id: int,
+        outcome: ScrapeOutcome,
+        report_year: Optional[int] = None,
+        scraped_at: Optional[datetime] = None,
+        filter_reason: Optional[FilterReason] = None,
+    ) -> None:
+        previous_state = self._states.get(ngo_id)
+        if report_year is None and previous_state:
+            # Keep the last known report year if this scrape didn't return one
+            report_year = previous_state.last_report_year
+
+        self._states[ngo_id] = NgoScrapeState(
+            ngo_id=ngo_id,
+            last_scraped_at=scraped_at or datetime.now(),
+            last_outcome=outcome,
+            last_report_year=report_year,
+            filter_reason=filter_reason,
+        )
+
+    def merge_partition(
+        self, other: "ScrapeStateStore", in_partition: Callable[[int], bool]
+    ) -> None:
+        """Take the states of the NGOs `in_partition` from `other`, e.g. the store of a crawl shard"""
+        self._states = {
+            ngo_id: state
+            for ngo_id, state in self._states.items()
+            if not in_partition(ngo_id)
+        }
+        self._states.update(
+            (ngo_id, state)
+            for ngo_id, state in other._states.items()
+            if in_partition(ngo_id)
+        )
+
+    def save(self) -> None:
+        # Write to a temporary file first, so a crash never leaves a truncated state
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", newline="", encoding="utf-8") as state_file:
+            writer = csv.DictWriter(state_file, fieldnames=self.fieldnames)
+            writer.writeheader()
+            for state in self._states.values():
+                writer.writerow(
+                    {
+                        "ngo_id": state.ngo_id,
+                        "last_scraped_at": state.last_scraped_at.isoformat(),
+                        "last_outcome": state.last_outcome.value,
+                        "last_report_year": state.last_report_year or "",
+                        "filter_reason": (
+                            state.filter_reason.value if state.filter_reason else ""
+                        ),
+                    }
+                )
+        os.replace(tmp_path, self.path)
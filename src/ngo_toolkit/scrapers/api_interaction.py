@@ -1,45 +1,305 @@
 # Download latest registered NGOs from https://data.gov.il/dataset/moj-amutot:
+import csv
+import json
+import os
+from datetime import datetime, timedelta
 import requests
-from typing import List
+from requests.adapters import HTTPAdapter
+from typing import Iterator, List, Optional
+from urllib3.util.retry import Retry
 import logging
 
 logger = logging.getLogger(__name__)
 
+DATASTORE_SEARCH_URL = "https://data.gov.il/api/3/action/datastore_search"
+RESOURCE_SHOW_URL = "https://data.gov.il/api/3/action/resource_show"
+REGISTRY_RESOURCE_ID = "be5b7935-3922-45d4-9638-08871b17ec95"
+NGO_ID_FIELD = "מספר עמותה"
 
-def download_registered_ngos_ids() -> List[int]:
+# Datastore bookkeeping columns, not part of the registry itself
+DATASTORE_INTERNAL_FIELDS = ("_id", "rank", "_full_text")
+
+REGISTRY_SNAPSHOT_PATH = "data/registry_snapshot.csv"
+REGISTRY_FULL_SNAPSHOT_PATH = "data/registry_full_snapshot.csv"
+# Reruns within the TTL use the local snapshot without hitting the network
+REGISTRY_SNAPSHOT_TTL = timedelta(hours=20)
+REGISTRY_PAGE_SIZE = 50_000
+
+
+class RegistryDownloadError(Exception):
+    """Raised when the registered NGOs can't be downloaded nor loaded from a snapshot"""
+
+
+def _registry_session() -> requests.Session:
+    session = requests.Session()
+    retry = Retry(
+        total=5,
+        backoff_factor=1,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["GET", "POST"],
+    )
+    session.mount("https://", HTTPAdapter(max_retries=retry))
+    return session
+
+
+class RegistryClient:
+    """Pages through the data.gov.il NGO registry and keeps a local csv snapshot of it.
+    Only the given `fields` are downloaded, or every registry field if None.
+
+    The snapshot is written next to a json metadata file holding the download time and
+    the registry resource version (its `last_modified` and HTTP ETag).
+    An interrupted download is resumed from its last complete page.
+    """
+
+    def __init__(
+        self,
+        fields: Optional[list[str]] = None,
+        snapshot_path: str = REGISTRY_SNAPSHOT_PATH,
+        ttl: timedelta = REGISTRY_SNAPSHOT_TTL,
+        page_size: int = REGISTRY_PAGE_SIZE,
+        session: Optional[requests.Session] = None,
+    ) -> None:
+        self.fields = fields
+        self.snapshot_path = snapshot_path
+        self.meta_path = f"{os.path.splitext(snapshot_path)[0]}.json"
+        self.partial_path = f"{snapshot_path}.partial"
+        self.partial_meta_path = f"{self.meta_path}.partial"
+        self.ttl = ttl
+        self.page_size = page_size
+        self.session = session or _registry_session()
+
+    # ------------ Network ------------
+    def _fetch_page(self, offset: int) -> tuple[list[dict], Optional[int]]:
+        payload = {
+            "resource_id": REGISTRY_RESOURCE_ID,
+            "filters": {},
+            "q": "",
+            "plain": True,
+            "limit": self.page_size,
+            "offset": offset,
+            # A stable order is required for paging
+            "sort": f'"{NGO_ID_FIELD}"',
+            "include_total": True,
+            "records_format": "objects",
+        }
+        if self.fields:
+            payload.update(fields=self.fields, distinct=True)
+        try:
+            response = self.session.post(
+                DATASTORE_SEARCH_URL, json=payload, stream=True, timeout=60
+            )
+        except requests.RequestException as err:
+            raise RegistryDownloadError(f"Registry request failed: {err}") from err
+
+        with response:
+            if response.status_code != 200:
+                raise RegistryDownloadError(
+                    f"Registry request failed with status code {response.status_code}"
+                )
+            # Parsed from the decompressed stream, but the whole page is still read into
+            # memory before decoding, so memory is bounded by `page_size`
+            response.raw.decode_content = True
+            result = json.load(response.raw).get("result", {})
+        return result.get("records", []), result.get("total")
+
+    def iter_records(self, offset: int = 0) -> Iterator[list[dict]]:
+        """Yield the registry records page by page, starting at `offset`.
+        A page may be shorter than `page_size` without being the last one, CKAN caps the
+        page size at its `ckan.datastore.search.rows_max`. So paging ends only once `total`
+        records were read, or on an empty page when the total is unknown.
+        """
+        while True:
+            records, total = self._fetch_page(offset)
+            if not records:
+                if total is not None and offset < total:
+                    raise RegistryDownloadError(
+                        f"The registry returned no records at offset {offset} of {total}"
+                    )
+                return
+            yield records
+            offset += len(records)
+            if total is not None and offset >= total:
+                return
+
+    def _resource_version(self, etag: Optional[str]) -> Optional[dict]:
+        """Get the registry resource version, None if it couldn't be checked"""
+        headers = {"If-None-Match": etag} if etag else {}
+        try:
+            response = self.session.get(
+                RESOURCE_SHOW_URL,
+                params={"id": REGISTRY_RESOURCE_ID},
+                headers=headers,
+                timeout=30,
+            )
+        except requests.RequestException:
+            logger.warning("Could not check the registry version", exc_info=True)
+            return None
+
+        if response.status_code == 304:
+            return {"etag": etag, "last_modified": None, "not_modified": True}
+        if response.status_code != 200:
+            logger.warning(
+                "Could not check the registry version, status code %s",
+                response.status_code,
+            )
+            return None
+        return {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.json()
+            .get("result", {})
+            .get("last_modified"),
+            "not_modified": False,
+        }
+
+    # ------------ Snapshot ------------
+    @staticmethod
+    def _read_json(path: str) -> Optional[dict]:
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding="utf-8") as json_file:
+            return json.load(json_file)
+
+    @staticmethod
+    def _write_json(path: str, data: dict) -> None:
+        # Replaced at once, a crash never leaves a truncated metadata file
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as json_file:
+            json.dump(data, json_file, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def _read_snapshot(self) -> list[dict]:
+        with open(self.snapshot_path, newline="", encoding="utf-8") as snapshot_file:
+            return list(csv.DictReader(snapshot_file))
+
+    def _snapshot_meta(self) -> Optional[dict]:
+        meta = self._read_json(self.meta_path)
+        if not meta or not os.path.exists(self.snapshot_path):
+            return None
+        if meta.get("fields") != self.fields:
+            # Snapshot was taken with different fields
+            return None
+        return meta
+
+    def _is_same_version(self, meta: dict, version: Optional[dict]) -> bool:
+        if version is None:
+            return False
+        if version["not_modified"]:
+            return True
+        return bool(
+            version["last_modified"]
+            and version["last_modified"] == meta.get("last_modified")
+        )
+
+    def _download_snapshot(self, version: Optional[dict]) -> None:
+        version = version or {}
+        partial_meta = self._read_json(self.partial_meta_path)
+        offset = 0
+        fieldnames = self.fields
+        if (
+            partial_meta
+            and os.path.exists(self.partial_path)
+            and partial_meta["fields"] == self.fields
+            and partial_meta.get("last_modified") == version.get("last_modified")
+            and "size" in partial_meta
+        ):
+            offset = partial_meta["offset"]
+            # Drop a page appended after the metadata was last written (a crash in between),
+            # it is downloaded again from `offset`
+            with open(self.partial_path, "r+b") as partial:
+                partial.truncate(partial_meta["size"])
+            with open(self.partial_path, newline="", encoding="utf-8") as partial:
+                fieldnames = next(csv.reader(partial), fieldnames)
+            logger.info("Resuming registry download from offset %s", offset)
+        else:
+            open(self.partial_path, "w").close()
+
+        for records in self.iter_records(offset):
+            if fieldnames is None:
+                fieldnames = [
+                    field
+                    for field in records[0]
+                    if field not in DATASTORE_INTERNAL_FIELDS
+                ]
+            with open(self.partial_path, "a", newline="", encoding="utf-8") as partial:
+                writer = csv.DictWriter(
+                    partial, fieldnames=fieldnames, extrasaction="ignore"
+                )
+                if partial.tell() == 0:
+                    writer.writeheader()
+                writer.writerows(records)
+                size = partial.tell()
+            offset += len(records)
+            # Only written once the page is on disk, so a resume never skips records.
+            # `size` is where the page ends, so a resume never duplicates them either.
+            self._write_json(
+                self.partial_meta_path,
+                {
+                    "fields": self.fields,
+                    "offset": offset,
+                    "size": size,
+                    "last_modified": version.get("last_modified"),
+                },
+            )
+            logger.debug("Downloaded %s registry records", offset)
+
+        os.replace(self.partial_path, self.snapshot_path)
+        if os.path.exists(self.partial_meta_path):
+            os.remove(self.partial_meta_path)
+        self._write_json(
+            self.meta_path,
+            {
+                "fields": self.fields,
+                "fetched_at": datetime.now().isoformat(),
+                "etag": version.get("etag"),
+                "last_modified": version.get("last_modified"),
+            },
+        )
+
+    def load_records(self, offline: bool = False) -> list[dict]:
+        """Load the registry records, downloading them only if the snapshot is outdated.
+        In offline mode, the records are read from the snapshot only.
+        """
+        meta = self._snapshot_meta()
+        if offline:
+            if meta is None:
+                raise RegistryDownloadError(
+                    f"Offline mode, but no registry snapshot at {self.snapshot_path}"
+                )
+            return self._read_snapshot()
+
+        if meta and datetime.now() - datetime.fromisoformat(meta["fetched_at"]) < self.ttl:
+            logger.info("Using registry snapshot from %s", meta["fetched_at"])
+            return self._read_snapshot()
+
+        version = self._resource_version(meta.get("etag") if meta else None)
+        if meta and self._is_same_version(meta, version):
+            logger.info("Registry didn't change since %s", meta["fetched_at"])
+            meta["fetched_at"] = datetime.now().isoformat()
+            self._write_json(self.meta_path, meta)
+            return self._read_snapshot()
+
+        self._download_snapshot(version)
+        return self._read_snapshot()
+
+
+def download_registered_ngos_ids(offline: bool = False) -> List[int]:
     """
     Download latest registered NGOs from https://data.gov.il/dataset/moj-amutot
-    Using their API to get the list of registered NGOs
+    Using their API to get the list of registered NGOs.
+    A local snapshot is reused when it's recent enough, or when `offline` is set.
     """
+    records = RegistryClient(fields=[NGO_ID_FIELD]).load_records(offline=offline)
+    if not records:
+        raise RegistryDownloadError("The registry returned no NGOs")
+    # Convert the IDs to integers and return as a list
+    return [int(record[NGO_ID_FIELD]) for record in records]
+
 
-    # Define the endpoint URL
-    url = "https://data.gov.il/api/3/action/datastore_search"
-
-    # Define the payload
-    payload = {
-        "resource_id": "be5b7935-3922-45d4-9638-08871b17ec95",
-        "filters": {},
-        "q": "",
-        "distinct": True,
-        "plain": True,
-        "limit": 1000000,
-        "offset": 0,
-        "fields": ["מספר עמותה"],
-        "sort": "",
-        "include_total": True,
-        "records_format": "objects",
-    }
-
-    # Make the POST request to the API
-    response = requests.post(url, json=payload)
-
-    # Check if the request was successful
-    if response.status_code == 200:
-        # Parse the JSON response to extract NGO IDs
-        data = response.json()
-        records = data.get("result", {}).get("records", [])
-        # Convert the IDs to integers and return as a list
-        return [int(record["מספר עמותה"]) for record in records]
-    else:
-        logger.error(f"Request failed with status code {response.status_code}")
-        return []
+def download_registry_records(offline: bool = False) -> list[dict]:
+    """Download all the fields of the registered NGOs, used to detect registry changes"""
+    records = RegistryClient(snapshot_path=REGISTRY_FULL_SNAPSHOT_PATH).load_records(
+        offline=offline
+    )
+    if not records:
+        raise RegistryDownloadError("The registry returned no NGOs")
+    return records
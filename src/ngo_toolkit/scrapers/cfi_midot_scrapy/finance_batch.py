@@ -0,0 +1,252 @@
+from functools import cached_property
+from typing import Iterable
+
+import attr
+import numpy as np
+import pandas as pd
+
+from ngo_toolkit.scrapers.cfi_midot_scrapy.items import (
+    _TURNOVER_CATEGORIES,
+    _TURNOVER_CATEGORY_MIN_VALUES,
+    IncomeSourceRatioLabels,
+    NgoFinanceInfo,
+    NgoFinanceInfoSchema,
+)
+
+# Raw income / expense fields of `NgoFinanceInfo`, the inputs of every computed value
+FINANCE_INPUT_FIELDS = [
+    field.name
+    for field in attr.fields(NgoFinanceInfo)
+    if field.init and field.name not in ("ngo_id", "report_year")
+]
+# Same order as `NgoFinanceInfo.income_source_ratios`, so argmax ties resolve the same way
+INCOME_SOURCE_RATIO_KEYS = [
+    "total_allocations_income_ratio",
+    "total_donations_income_ratio",
+    "total_service_income_ratio",
+    "total_other_income_ratio",
+]
+INCOME_SOURCE_LABELS = np.array(
+    [
+        IncomeSourceRatioLabels[key].value.replace("אחוז ", "")
+        for key in INCOME_SOURCE_RATIO_KEYS
+    ],
+    dtype=object,
+)
+
+_TURNOVER_CATEGORY_MAX_VALUES = np.array(
+    [category.max_value for category in _TURNOVER_CATEGORIES]
+)
+# Index -1 (no category) picks the trailing None
+_TURNOVER_CATEGORY_NAMES = np.array(
+    [category.name for category in _TURNOVER_CATEGORIES] + [None], dtype=object
+)
+_TURNOVER_CATEGORY_LABELS = np.array(
+    [category.label for category in _TURNOVER_CATEGORIES] + [None], dtype=object
+)
+
+
+def categorize_turnovers(turnovers: np.ndarray) -> np.ndarray:
+    """Vectorized `TurnoverCategory.from_value`, returns the index of each turnover's
+    category in `_TURNOVER_CATEGORIES`, or -1 if it has no category (negative, NaN, too large)
+    """
+    turnovers = np.asarray(turnovers, dtype=float)
+    category_idx = (
+        np.searchsorted(_TURNOVER_CATEGORY_MIN_VALUES, turnovers, side="right") - 1
+    )
+    has_category = (category_idx >= 0) & (
+        turnovers < _TURNOVER_CATEGORY_MAX_VALUES[np.maximum(category_idx, 0)]
+    )
+    return np.where(has_category, category_idx, -1)
+
+
+def _ratio_or_zero(numerator: np.ndarray, denominator: np.ndarray) -> np.ndarray:
+    # 0 where the denominator is 0, like the `if not ...: return 0` guards of `NgoFinanceInfo`
+    out = np.zeros(len(numerator))
+    np.divide(numerator, denominator, out=out, where=denominator != 0)
+    return out
+
+
+@attr.s(frozen=True, auto_attribs=True, eq=False)
+class NgoFinanceBatch:
+    """Many financial reports as columns, one array per `NgoFinanceInfo` field.
+    Computes the same totals and ratios as `NgoFinanceInfo`, for all the reports at once.
+    Ratios `NgoFinanceInfo` returns None for are NaN.
+    """
+
+    ngo_id: np.ndarray
+    report_year: np.ndarray
+    # FINANCE_INPUT_FIELDS -> float64 column
+    columns: dict[str, np.ndarray]
+
+    @classmethod
+    def from_reports(cls, reports: Iterable[NgoFinanceInfo]) -> "NgoFinanceBatch":
+        reports = list(reports)
+        return cls(
+            ngo_id=np.fromiter((report.ngo_id for report in reports), dtype=np.int64),
+            report_year=np.fromiter(
+                (report.report_year for report in reports), dtype=np.int64
+            ),
+            columns={
+                name: np.fromiter(
+                    (getattr(report, name) for report in reports), dtype=float
+                )
+                for name in FINANCE_INPUT_FIELDS
+            },
+        )
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame) -> "NgoFinanceBatch":
+        """From a frame of raw fields, e.g. the financial reports csv. Missing fields default to 0"""
+        return cls(
+            ngo_id=df["ngo_id"].to_numpy(dtype=np.int64),
+            report_year=df["report_year"].to_numpy(dtype=np.int64),
+            columns={
+                name: (
+                    df[name].fillna(0).to_numpy(dtype=float)
+                    if name in df
+                    else np.zeros(len(df))
+                )
+                for name in FINANCE_INPUT_FIELDS
+            },
+        )
+
+    def __len__(self) -> int:
+        return len(self.ngo_id)
+
+    def _sum(self, *names: str) -> np.ndarray:
+        return np.sum([self.columns[name] for name in names], axis=0)
+
+    # ------------ Totals ------------
+    @cached_property
+    def total_allocations_income(self) -> np.ndarray:
+        return self._sum(
+            "allocations_from_government",
+            "allocations_from_local_authority",
+            "allocations_from_other_sources",
+        )
+
+    @cached_property
+    def total_donations_income(self) -> np.ndarray:
+        return self._sum(
+            "donations_from_aboard",
+            "donations_from_israel",
+            "donations_of_monetary_value",
+        )
+
+    @cached_property
+    def total_service_income(self) -> np.ndarray:
+        return self._sum(
+            "service_income_from_country",
+            "service_income_from_local_authority",
+            "service_income_from_other",
+        )
+
+    @cached_property
+    def total_other_income(self) -> np.ndarray:
+        return self._sum("other_income_from_other_sources", "other_income_members_fee")
+
+    @cached_property
+    def total_expenses(self) -> np.ndarray:
+        return self._sum(
+            "expenses_other",
+            "other_expenses_for_activities",
+            "expenses_for_activities",
+            "expenses_for_management",
+            "expenses_salary_for_management",
+            "expenses_salary_for_activities",
+        )
+
+    @cached_property
+    def yearly_turnover(self) -> np.ndarray:
+        return (
+            self.total_allocations_income
+            + self.total_donations_income
+            + self.total_service_income
+            + self.total_other_income
+        )
+
+    @cached_property
+    def annual_balance(self) -> np.ndarray:
+        # 0 when there is no turnover
+        return np.where(
+            self.yearly_turnover != 0, self.yearly_turnover - self.total_expenses, 0
+        )
+
+    # ------------ Categories ------------
+    @cached_property
+    def _turnover_category_idx(self) -> np.ndarray:
+        return categorize_turnovers(self.yearly_turnover)
+
+    @cached_property
+    def yearly_turnover_category(self) -> np.ndarray:
+        # Category names, as exported. None for turnovers without a category
+        return _TURNOVER_CATEGORY_NAMES[self._turnover_category_idx]
+
+    @cached_property
+    def yearly_turnover_category_label(self) -> np.ndarray:
+        return _TURNOVER_CATEGORY_LABELS[self._turnover_category_idx]
+
+    # ------------ Ratios ------------
+    @cached_property
+    def total_allocations_income_ratio(self) -> np.ndarray:
+        return _ratio_or_zero(self.total_allocations_income, self.yearly_turnover)
+
+    @cached_property
+    def total_donations_income_ratio(self) -> np.ndarray:
+        return _ratio_or_zero(self.total_donations_income, self.yearly_turnover)
+
+    @cached_property
+    def total_service_income_ratio(self) -> np.ndarray:
+        return _ratio_or_zero(self.total_service_income, self.yearly_turnover)
+
+    @cached_property
+    def total_other_income_ratio(self) -> np.ndarray:
+        return _ratio_or_zero(self.total_other_income, self.yearly_turnover)
+
+    @cached_property
+    def income_source_ratios(self) -> np.ndarray:
+        # (reports x income sources), columns ordered as `INCOME_SOURCE_RATIO_KEYS`
+        return np.column_stack([getattr(self, key) for key in INCOME_SOURCE_RATIO_KEYS])
+
+    @cached_property
+    def max_income_ratio(self) -> np.ndarray:
+        return self.income_source_ratios.max(axis=1)
+
+    @cached_property
+    def max_income_source_label(self) -> np.ndarray:
+        # argmax picks the first maximum, like `max` over the ratios dict
+        return INCOME_SOURCE_LABELS[self.income_source_ratios.argmax(axis=1)]
+
+    @cached_property
+    def balance_ratio(self) -> np.ndarray:
+        return _ratio_or_zero(self.annual_balance, self.yearly_turnover)
+
+    @cached_property
+    def program_expense_ratio(self) -> np.ndarray:
+        total_program_expenses = (
+            self.columns["other_expenses_for_activities"]
+            + self.columns["expenses_salary_for_activities"]
+        )
+        ratio = np.full(len(self), np.nan)
+        has_ratio = (total_program_expenses != 0) & (self.total_expenses != 0)
+        np.divide(total_program_expenses, self.total_expenses, out=ratio, where=has_ratio)
+        return ratio
+
+    @cached_property
+    def admin_expense_ratio(self) -> np.ndarray:
+        total_administrative_expenses = (
+            self.columns["expenses_salary_for_management"]
+            + self.columns["expenses_for_management"]
+        )
+        return _ratio_or_zero(total_administrative_expenses, self.yearly_turnover)
+
+    def to_frame(self) -> pd.DataFrame:
+        """Same columns as `NgoFinanceInfoSchema` dumps, program_expense_ratio None is NaN"""
+        columns = {"ngo_id": self.ngo_id, "report_year": self.report_year}
+        for name in NgoFinanceInfoSchema._declared_fields:
+            if name not in columns:
+                columns[name] = (
+                    self.columns[name] if name in self.columns else getattr(self, name)
+                )
+        return pd.DataFrame(columns)
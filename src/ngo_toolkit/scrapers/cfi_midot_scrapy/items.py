@@ -4,16 +4,24 @@
 # https://docs.scrapy.org/en/latest/topics/items.html
 
 from functools import cached_property
+import bisect
+import os
 import sys
 from datetime import datetime
 from enum import Enum
-from typing import Optional, Union
+from types import UnionType
+from typing import Any, Callable, Optional, Union, get_args, get_origin
 
 import attr
-from attrs_strict import type_validator
+from attrs_strict import AttributeTypeError, type_validator
 from marshmallow import Schema, SchemaOpts, fields, post_dump
 from marshmallow_enum import EnumField
 
+# Runtime type checks of scraped items: "strict" (attrs_strict), "fast" (precompiled isinstance
+# checks) or "off". Read from the environment, the item classes are built once at import.
+ITEMS_TYPE_VALIDATION_MODES = ("strict", "fast", "off")
+ITEMS_TYPE_VALIDATION = os.environ.get("ITEMS_TYPE_VALIDATION", "strict")
+
 
 class IncomeSourceLabels(Enum):
     """Maps income source ratio keys to labels. Used for display purposes."""
@@ -54,39 +62,102 @@ class TurnoverCategory(Enum):
 
     @classmethod
     def from_value(cls, value: int | float) -> "TurnoverCategory":
-        for turnover_category in cls:
-            if (
-                value >= turnover_category.min_value
-                and value < turnover_category.max_value
-            ):
+        category_idx = bisect.bisect_right(_TURNOVER_CATEGORY_MIN_VALUES, value) - 1
+        if category_idx >= 0:
+            turnover_category = _TURNOVER_CATEGORIES[category_idx]
+            if turnover_category.min_value <= value < turnover_category.max_value:
                 return turnover_category
         raise ValueError(f"Could not find turnover category for value: {value}")
 
 
-def _add_type_validator(cls, fields):
-    validated_fields = []
-    for field in fields:
-        if field.validator is not None:
-            validated_fields.append(field)
-            continue
-        validated_fields.append(field.evolve(validator=type_validator()))
-    return validated_fields
+# Categories are contiguous and sorted by min_value, so a value's category is found by bisection
+_TURNOVER_CATEGORIES = tuple(sorted(TurnoverCategory))
+_TURNOVER_CATEGORY_MIN_VALUES = [category.min_value for category in _TURNOVER_CATEGORIES]
+
+
+def _compile_type_check(annotation: Any) -> Callable[[Any], bool]:
+    """Turns a field annotation into a plain isinstance check, resolved once per field"""
+    if annotation is Any:
+        return lambda value: True
+    origin = get_origin(annotation)
+    if origin is None:
+        return lambda value: isinstance(value, annotation)
+    if origin in (Union, UnionType):
+        args = get_args(annotation)
+        plain_types = tuple(arg for arg in args if get_origin(arg) is None)
+        generic_checks = [
+            _compile_type_check(arg) for arg in args if get_origin(arg) is not None
+        ]
+        if not generic_checks:
+            return lambda value: isinstance(value, plain_types)
+        return lambda value: isinstance(value, plain_types) or any(
+            check(value) for check in generic_checks
+        )
+    if origin is list:
+        item_check = _compile_type_check(get_args(annotation)[0])
+        return lambda value: isinstance(value, list) and all(map(item_check, value))
+    return lambda value: isinstance(value, origin)
+
+
+def _fast_type_validator(annotation: Any):
+    type_check = _compile_type_check(annotation)
+
+    def validate(instance, attribute, value):
+        # Same error as attrs_strict, so the modes are interchangeable for callers
+        if not type_check(value):
+            raise AttributeTypeError(value, attribute)
+
+    return validate
+
+
+def type_validators_transformer(mode: str) -> Callable:
+    """attrs `field_transformer` adding a type validator of the given mode to each field without one"""
+    if mode not in ITEMS_TYPE_VALIDATION_MODES:
+        raise ValueError(
+            f"Unknown items type validation: {mode}, expected one of {ITEMS_TYPE_VALIDATION_MODES}"
+        )
+
+    def add_type_validators(cls, fields):
+        if mode == "off":
+            return fields
+        validated_fields = []
+        for field in fields:
+            if field.validator is not None:
+                validated_fields.append(field)
+                continue
+            if mode == "fast":
+                validator = _fast_type_validator(field.type)
+            else:
+                validator = type_validator()
+            validated_fields.append(field.evolve(validator=validator))
+        return validated_fields
+
+    return add_type_validators
+
 
+_add_type_validator = type_validators_transformer(ITEMS_TYPE_VALIDATION)
 
-@attr.s(frozen=True, auto_attribs=True, field_transformer=_add_type_validator)
+
+@attr.s(
+    frozen=True, slots=True, auto_attribs=True, field_transformer=_add_type_validator
+)
 class NgoTopRecipientSalary:
     recipient_title: str
     gross_salary_in_nis: float
 
 
-@attr.s(frozen=True, auto_attribs=True, field_transformer=_add_type_validator)
+@attr.s(
+    frozen=True, slots=True, auto_attribs=True, field_transformer=_add_type_validator
+)
 class NgoTopRecipientsSalaries:
     ngo_id: int = attr.ib(converter=int)
     report_year: int = attr.ib(converter=int)
     top_earners_salaries: list[NgoTopRecipientSalary]
 
 
-@attr.s(frozen=True, auto_attribs=True, field_transformer=_add_type_validator)
+@attr.s(
+    frozen=True, slots=True, auto_attribs=True, field_transformer=_add_type_validator
+)
 class NgoGeneralInfo:
     ngo_id: int = attr.ib(converter=int)
     ngo_name: str
@@ -102,7 +173,11 @@ class NgoGeneralInfo:
 
 
 @attr.s(
-    frozen=True, auto_attribs=True, kw_only=True, field_transformer=_add_type_validator
+    frozen=True,
+    slots=True,
+    auto_attribs=True,
+    kw_only=True,
+    field_transformer=_add_type_validator,
 )
 class NgoFinanceInfo:
     report_year: int = attr.ib(converter=int)
@@ -147,7 +222,6 @@ class NgoFinanceInfo:
     # yearly_turnover: Union[int, float] = attr.ib(init=False)
     balance_ratio: Union[int, float] = attr.ib(init=False)
     max_income_ratio: Union[int, float] = attr.ib(init=False)
-    growth_ratio: Union[int, float] = attr.ib(init=False)
 
     @total_allocations_income.default
     def _total_allocations_income(self) -> Union[int, float]:
@@ -309,7 +383,9 @@ class NgoFinanceInfo:
         return total_administrative_expenses / self.yearly_turnover
 
 
-@attr.s(frozen=True, auto_attribs=True, field_transformer=_add_type_validator)
+@attr.s(
+    frozen=True, slots=True, auto_attribs=True, field_transformer=_add_type_validator
+)
 class NgoInfo:
     ngo_id: int
 
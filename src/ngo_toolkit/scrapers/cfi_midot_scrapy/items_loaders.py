@@ -1,4 +1,7 @@
 import logging
+from collections import Counter
+from operator import itemgetter
+from typing import Optional
 
 from ngo_toolkit.scrapers.cfi_midot_scrapy.items import (
     NgoFinanceInfo,
@@ -20,89 +23,118 @@ RESOURCE_NAME_TO_METHOD_NAME = {
 
 METHOD_NAME_RESOURCE_NAME = {v: k for k, v in RESOURCE_NAME_TO_METHOD_NAME.items()}
 
+# `filter_reason` of the NGOs filtered out by `load_ngo_info`
+FILTER_REASON_NO_FINANCES = "no_finances"
+FILTER_REASON_LOW_TURNOVER = "low_turnover"
+# NGOs GuideStar doesn't know, see `ngo_batch_parser`
+FILTER_REASON_MISSING = "missing"
+
+
+GENERAL_DATA_MAPPER = {
+    "Name": "ngo_name",
+    "orgGoal": "ngo_goal",
+    "orgYearFounded": "ngo_year_founded",
+    "volunteers": "volunteers_num",
+    "employees": "employees_num",
+    "members": "ngo_members_num",
+    "tchumPeilutMain": "main_activity_field",
+    "tchumPeilutSecondary": "activity_fields",
+    "audience": "target_audience",
+}
 
-def _map_between_scraped_and_ngo_item(data_mapper: dict, scraped_data: dict) -> dict:
-    ngo_item_data = {}
-    for malkar_attr_name, ngo_attr_name in data_mapper.items():
-        scraped_data_value = scraped_data.get(malkar_attr_name)
-        if scraped_data_value is None:
-            logger.debug("Missing %s in scraped NGO data", malkar_attr_name)
-            continue
-        ngo_item_data[ngo_attr_name] = scraped_data_value
-    return ngo_item_data
-
-
-def _malkar_details_parser(scraped_data: dict, ngo_id: int) -> NgoGeneralInfo:
-    general_data_mapper = {
-        "Name": "ngo_name",
-        "orgGoal": "ngo_goal",
-        "orgYearFounded": "ngo_year_founded",
-        "volunteers": "volunteers_num",
-        "employees": "employees_num",
-        "members": "ngo_members_num",
-        "tchumPeilutMain": "main_activity_field",
-        "tchumPeilutSecondary": "activity_fields",
-        "audience": "target_audience",
-    }
-    ngo_general = _map_between_scraped_and_ngo_item(general_data_mapper, scraped_data)
+FINANCE_DATA_MAPPER = {
+    "Allocations_Government": "allocations_from_government",
+    "Allocations_LocalAuthority": "allocations_from_local_authority",
+    "Allocations_Other": "allocations_from_other_sources",
+    "Donations_Aboard": "donations_from_aboard",
+    "Donations_Country": "donations_from_israel",
+    "Donations_ValueForMoney": "donations_of_monetary_value",
+    "Expenses_Other": "expenses_other",
+    "Expenses_Activities": "expenses_for_activities",
+    "Expenses_OtherActivities": "other_expenses_for_activities",
+    "Expenses_OtherManagement": "expenses_for_management",
+    "Expenses_Salary": "expenses_salary_for_management",
+    "Expenses_SalaryActivities": "expenses_salary_for_activities",
+    "Incomes_MembersFee": "other_income_members_fee",
+    "Incomes_OtherSource": "other_income_from_other_sources",
+    "Incomes_ServicesForCountry": "service_income_from_country",
+    "Incomes_ServicesForLocalAuthority": "service_income_from_local_authority",
+    "Incomes_ServicesForOther": "service_income_from_other",
+    "Year": "report_year",
+}
+
+# We assumes that Amount is in NIS
+EARNER_SALARY_MAPPER = {
+    "MainLabel": "recipient_title",
+    "Amount": "gross_salary_in_nis",
+}
+
+
+class _FieldMapper:
+    """Maps a scraped record to item attributes, compiled once from a `{scraped name: item name}` mapper.
+    Missing (or None) scraped fields are left out of the result and counted in `missing_fields`,
+    keyed by (mapper name, scraped name).
+    """
+
+    def __init__(self, name: str, data_mapper: dict[str, str]) -> None:
+        self.name = name
+        self._scraped_names = tuple(data_mapper)
+        self._item_names = tuple(data_mapper.values())
+        self._project = itemgetter(*self._scraped_names)
+
+    def __call__(self, scraped_data: dict, missing_fields: Counter) -> dict:
+        try:
+            values = self._project(scraped_data)
+        except KeyError:
+            values = tuple(map(scraped_data.get, self._scraped_names))
+        if None not in values:
+            return dict(zip(self._item_names, values))
+
+        ngo_item_data = {}
+        for scraped_name, item_name, value in zip(
+            self._scraped_names, self._item_names, values
+        ):
+            if value is None:
+                missing_fields[(self.name, scraped_name)] += 1
+                continue
+            ngo_item_data[item_name] = value
+        return ngo_item_data
+
+
+_map_general_data = _FieldMapper("general_info", GENERAL_DATA_MAPPER)
+_map_finance_data = _FieldMapper("financial_info", FINANCE_DATA_MAPPER)
+_map_earner_salary = _FieldMapper("top_earners_info", EARNER_SALARY_MAPPER)
+
+
+def _malkar_details_parser(
+    scraped_data: dict, ngo_id: int, missing_fields: Counter
+) -> NgoGeneralInfo:
+    ngo_general = _map_general_data(scraped_data, missing_fields)
     return NgoGeneralInfo(ngo_id=ngo_id, **ngo_general)
 
 
 def _malkar_finance_parser(
-    scraped_data: list[dict], ngo_id: int
+    scraped_data: list[dict], ngo_id: int, missing_fields: Counter
 ) -> list[NgoFinanceInfo]:
-    finance_data_mapper = {
-        "Allocations_Government": "allocations_from_government",
-        "Allocations_LocalAuthority": "allocations_from_local_authority",
-        "Allocations_Other": "allocations_from_other_sources",
-        "Donations_Aboard": "donations_from_aboard",
-        "Donations_Country": "donations_from_israel",
-        "Donations_ValueForMoney": "donations_of_monetary_value",
-        "Expenses_Other": "expenses_other",
-        "Expenses_Activities": "expenses_for_activities",
-        "Expenses_OtherActivities": "other_expenses_for_activities",
-        "Expenses_OtherManagement": "expenses_for_management",
-        "Expenses_Salary": "expenses_salary_for_management",
-        "Expenses_SalaryActivities": "expenses_salary_for_activities",
-        "Incomes_MembersFee": "other_income_members_fee",
-        "Incomes_OtherSource": "other_income_from_other_sources",
-        "Incomes_ServicesForCountry": "service_income_from_country",
-        "Incomes_ServicesForLocalAuthority": "service_income_from_local_authority",
-        "Incomes_ServicesForOther": "service_income_from_other",
-        "Year": "report_year",
-    }
-
-    ngo_finance_objects = []
-    for data in scraped_data:
-        ngo_finance_pyaload = _map_between_scraped_and_ngo_item(
-            finance_data_mapper, data
-        )
-        ngo_finance_objects.append(NgoFinanceInfo(ngo_id=ngo_id, **ngo_finance_pyaload))
-    return ngo_finance_objects
+    return [
+        NgoFinanceInfo(ngo_id=ngo_id, **_map_finance_data(data, missing_fields))
+        for data in scraped_data
+    ]
 
 
 def _malkar_wage_earners_parser(
-    scraped_data: list[dict], ngo_id: int
+    scraped_data: list[dict], ngo_id: int, missing_fields: Counter
 ) -> list[NgoTopRecipientsSalaries]:
-
-    # We assumes that Amount is in NIS
-    earner_salary_mapper = {
-        "MainLabel": "recipient_title",
-        "Amount": "gross_salary_in_nis",
-    }
-
     recipient_salaries_objects = []
     for data in scraped_data:
-        top_earners_salaries = []
         scraped_earners_salaries = data.get("Data")
         if scraped_earners_salaries is None:
             logger.debug("No information about top earners salaries for: %s", ngo_id)
             continue
-        for earner_salary in scraped_earners_salaries:
-            earner_salary_data = _map_between_scraped_and_ngo_item(
-                earner_salary_mapper, earner_salary
-            )
-            top_earners_salaries.append(NgoTopRecipientSalary(**earner_salary_data))
+        top_earners_salaries = [
+            NgoTopRecipientSalary(**_map_earner_salary(earner_salary, missing_fields))
+            for earner_salary in scraped_earners_salaries
+        ]
 
         report_year = int(data["Label"].replace(" - שכר לשנה ברוטו", ""))
         recipient_salaries_objects.append(
@@ -122,7 +154,16 @@ METHOD_NAME_TO_ITEM_PARSER = {
 }
 
 
-def load_ngo_info(ngo_id: int, ngo_scraped_result: list[dict]) -> NgoInfo | dict:
+def load_ngo_info(
+    ngo_id: int,
+    ngo_scraped_result: list[dict],
+    missing_fields: Optional[Counter] = None,
+) -> NgoInfo | dict:
+    """Build the NGO item from its scraped resources.
+    Scraped fields missing from the resources are counted in `missing_fields`, if given.
+    """
+    if missing_fields is None:
+        missing_fields = Counter()
     resource_items = {}
     for scraped_result in ngo_scraped_result:
         scraped_data = scraped_result["result"]["result"]
@@ -135,24 +176,43 @@ def load_ngo_info(ngo_id: int, ngo_scraped_result: list[dict]) -> NgoInfo | dict
             continue
 
         parser = METHOD_NAME_TO_ITEM_PARSER[scraped_result["method"]]
-        resource_item = parser(scraped_data, ngo_id)
+        resource_item = parser(scraped_data, ngo_id, missing_fields)
 
         resource_name = METHOD_NAME_RESOURCE_NAME[scraped_result["method"]]
         resource_items[resource_name] = resource_item
 
     ngo_item = NgoInfo.from_resource_items(ngo_id, resource_items)
 
-    if _should_filter_out_ngo(ngo_item):
+    filter_reason = _filter_reason(ngo_item.last_financial_info)
+    if filter_reason:
         logger.debug("Filtering out ngo %s", ngo_item.ngo_id)
-        return dict(ngo_id=ngo_item.ngo_id)
+        return dict(ngo_id=ngo_item.ngo_id, filter_reason=filter_reason)
 
     return ngo_item
 
 
-def _should_filter_out_ngo(ngo_item: NgoInfo) -> bool:
-    return (
-        not ngo_item.last_financial_info
-        or not ngo_item.last_financial_info.yearly_turnover_category
+def finance_filter_reason(
+    ngo_id: int, finance_scraped_result: dict, missing_fields: Counter
+) -> Optional[str]:
+    """Why the NGO is filtered out by `load_ngo_info`, decided from its finances alone.
+    None if it is kept. Lets the other resources be fetched only for the NGOs that are kept.
+    """
+    scraped_data = finance_scraped_result["result"]["result"]
+    if not scraped_data:
+        return FILTER_REASON_NO_FINANCES
+    finance_reports = _malkar_finance_parser(scraped_data, ngo_id, missing_fields)
+    # Same report as `NgoInfo.last_financial_info`
+    last_financial_info = sorted(finance_reports, key=lambda report: report.report_year)[-1]
+    return _filter_reason(last_financial_info)
+
+
+def _filter_reason(last_financial_info: Optional[NgoFinanceInfo]) -> Optional[str]:
+    if not last_financial_info:
+        return FILTER_REASON_NO_FINANCES
+    if (
+        not last_financial_info.yearly_turnover_category
         # or ngo_item.last_financial_report_year not in (2021, 2020)
-        or ngo_item.last_financial_info.yearly_turnover < 100_000
-    )
+        or last_financial_info.yearly_turnover < 100_000
+    ):
+        return FILTER_REASON_LOW_TURNOVER
+    return None
@@ -3,7 +3,19 @@
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
+import random
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
 from scrapy import signals
+from scrapy.downloadermiddlewares.retry import RetryMiddleware, get_retry_request
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.defer import maybe_deferred_to_future
+from scrapy.utils.response import response_status_message
+from twisted.internet.error import TimeoutError as DownloadTimeoutError
+from twisted.internet.task import LoopingCall, deferLater
 
 # useful for handling different item types with a single interface
 from itemadapter import is_item, ItemAdapter
@@ -101,3 +113,249 @@ class CfimidotDownloaderMiddleware:
 
     def spider_opened(self, spider):
         spider.logger.info('Spider opened: %s' % spider.name)
+
+
+class GuideStarRetryMiddleware(RetryMiddleware):
+    """Retries failed requests according to why they failed:
+
+    - permanent (404/410): never retried, the NGO of an organization page is counted as
+      missing (the spider filters it out)
+    - throttled (429/503): retried after the `Retry-After` delay, or an exponential backoff
+    - transient (other `RETRY_HTTP_CODES`, connection errors): retried after a jittered
+      exponential backoff
+
+    Every failed request is counted under `guidestar/wasted_requests/<class>` in the crawl stats.
+    """
+
+    PERMANENT_HTTP_CODES = (404, 410)
+    THROTTLED_HTTP_CODES = (429, 503)
+
+    def __init__(self, settings):
+        super().__init__(settings)
+        self.backoff_base = settings.getfloat("GUIDESTAR_RETRY_BACKOFF_BASE")
+        self.backoff_max = settings.getfloat("GUIDESTAR_RETRY_BACKOFF_MAX")
+
+    def _classify_response(self, response) -> Optional[str]:
+        if response.status in self.PERMANENT_HTTP_CODES:
+            return "permanent"
+        if response.status in self.THROTTLED_HTTP_CODES:
+            return "throttled"
+        if response.status in self.retry_http_codes:
+            return "transient"
+        return None
+
+    def _backoff_delay(self, request) -> float:
+        retries = request.meta.get("retry_times", 0)
+        delay = self.backoff_base * 2**retries * random.uniform(0.5, 1.5)
+        return min(delay, self.backoff_max)
+
+    def _retry_after_delay(self, response) -> Optional[float]:
+        retry_after = response.headers.get("Retry-After")
+        if not retry_after:
+            return None
+        retry_after = retry_after.decode("latin-1").strip()
+        if retry_after.isdigit():
+            return min(float(retry_after), self.backoff_max)
+        try:
+            retry_at = parsedate_to_datetime(retry_after)
+        except (TypeError, ValueError):
+            return None
+        delay = (retry_at - datetime.now(timezone.utc)).total_seconds()
+        return min(max(delay, 0), self.backoff_max)
+
+    async def _retry_after(self, request, reason, spider, failure_class, delay):
+        retry_request = get_retry_request(
+            request,
+            spider=spider,
+            reason=reason,
+            max_retry_times=request.meta.get("max_retry_times", self.max_retry_times),
+            priority_adjust=request.meta.get("priority_adjust", self.priority_adjust),
+        )
+        if retry_request is None:
+            spider.crawler.stats.inc_value(f"guidestar/gave_up/{failure_class}")
+            return None
+        if delay:
+            from twisted.internet import reactor
+
+            await maybe_deferred_to_future(deferLater(reactor, delay, lambda: None))
+        return retry_request
+
+    async def process_response(self, request, response, spider):
+        if request.meta.get("dont_retry", False):
+            return response
+        failure_class = self._classify_response(response)
+        if failure_class is None:
+            return response
+        spider.crawler.stats.inc_value(f"guidestar/wasted_requests/{failure_class}")
+
+        if failure_class == "permanent":
+            ngo_id = request.meta.get("ngo_id")
+            if ngo_id is not None:
+                spider.crawler.stats.inc_value("guidestar/ngo_missing")
+            return response
+
+        if failure_class == "throttled":
+            delay = self._retry_after_delay(response)
+            if delay is None:
+                delay = self._backoff_delay(request)
+        else:
+            delay = self._backoff_delay(request)
+        retry_request = await self._retry_after(
+            request,
+            response_status_message(response.status),
+            spider,
+            failure_class,
+            delay,
+        )
+        return retry_request or response
+
+    async def process_exception(self, request, exception, spider):
+        if not isinstance(exception, self.exceptions_to_retry) or request.meta.get(
+            "dont_retry", False
+        ):
+            return None
+        spider.crawler.stats.inc_value("guidestar/wasted_requests/transient")
+        return await self._retry_after(
+            request, exception, spider, "transient", self._backoff_delay(request)
+        )
+
+
+class _AimdSlotState:
+    def __init__(self, concurrency: float) -> None:
+        self.concurrency = concurrency
+        self.latency: Optional[float] = None  # EWMA, seconds
+        self.error_rate = 0.0  # EWMA of failed responses
+        self.last_decrease_at = 0.0
+        self.responses = 0  # Since the last stats interval
+        self.max_throughput = 0.0
+        self.best_concurrency = concurrency
+
+
+class AimdConcurrencyMiddleware:
+    """Adapts the concurrency of each download slot, additive increase / multiplicative decrease.
+
+    While the slot's latency and error rate stay under `AIMD_TARGET_LATENCY` and
+    `AIMD_TARGET_ERROR_RATE`, its concurrency grows by about `AIMD_INCREASE` per round trip.
+    A throttled (429), 5xx or timed out request multiplies it by `AIMD_DECREASE`,
+    at most once per round trip, so a burst of failures counts as a single congestion event.
+
+    The current concurrency, throughput and the concurrency of the best throughput seen
+    are reported per slot in the crawl stats, under `aimd/<slot>/`.
+    Slots configured in `DOWNLOAD_SLOTS` keep their fixed concurrency.
+    """
+
+    CONGESTION_HTTP_CODES = (429, 500, 502, 503, 504, 522, 524)
+    # Weight of the latest observation in the latency / error rate averages
+    EWMA_ALPHA = 0.1
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        if not settings.getbool("AIMD_ENABLED"):
+            raise NotConfigured
+        self.crawler = crawler
+        self.start_concurrency = settings.getint("AIMD_START_CONCURRENCY")
+        self.min_concurrency = settings.getint("AIMD_MIN_CONCURRENCY")
+        self.max_concurrency = settings.getint("AIMD_MAX_CONCURRENCY")
+        self.target_latency = settings.getfloat("AIMD_TARGET_LATENCY")
+        self.target_error_rate = settings.getfloat("AIMD_TARGET_ERROR_RATE")
+        self.increase = settings.getfloat("AIMD_INCREASE")
+        self.decrease = settings.getfloat("AIMD_DECREASE")
+        self.stats_interval = settings.getfloat("AIMD_STATS_INTERVAL")
+        self.fixed_slots = set(settings.getdict("DOWNLOAD_SLOTS"))
+        self.slots: dict[str, _AimdSlotState] = {}
+        self._stats_task = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        middleware = cls(crawler)
+        crawler.signals.connect(middleware.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(middleware.spider_closed, signal=signals.spider_closed)
+        return middleware
+
+    def spider_opened(self, spider):
+        self._stats_task = LoopingCall(self._report_stats)
+        self._stats_task.start(self.stats_interval, now=False)
+
+    def spider_closed(self, spider):
+        if self._stats_task and self._stats_task.running:
+            self._stats_task.stop()
+        self._report_stats()
+
+    def _slot(self, request) -> tuple[Optional[str], Optional[_AimdSlotState]]:
+        slot_key = request.meta.get("download_slot")
+        if slot_key is None or slot_key in self.fixed_slots:
+            return None, None
+        if slot_key not in self.slots:
+            self.slots[slot_key] = _AimdSlotState(self.start_concurrency)
+            self._apply(slot_key)
+        return slot_key, self.slots[slot_key]
+
+    def _apply(self, slot_key: str) -> None:
+        downloader_slot = self.crawler.engine.downloader.slots.get(slot_key)
+        if downloader_slot is not None:
+            downloader_slot.concurrency = int(self.slots[slot_key].concurrency)
+
+    def _on_success(self, slot_key: str, state: _AimdSlotState, latency: float) -> None:
+        state.responses += 1
+        state.error_rate *= 1 - self.EWMA_ALPHA
+        if state.latency is None:
+            state.latency = latency
+        else:
+            state.latency += self.EWMA_ALPHA * (latency - state.latency)
+        if (
+            state.latency <= self.target_latency
+            and state.error_rate <= self.target_error_rate
+        ):
+            # About `increase` more in-flight requests per round trip
+            state.concurrency = min(
+                state.concurrency + self.increase / state.concurrency,
+                self.max_concurrency,
+            )
+            self._apply(slot_key)
+
+    def _on_congestion(self, slot_key: str, state: _AimdSlotState) -> None:
+        state.error_rate += self.EWMA_ALPHA * (1 - state.error_rate)
+        now = time.monotonic()
+        if now - state.last_decrease_at < (state.latency or self.target_latency):
+            return
+        state.last_decrease_at = now
+        state.concurrency = max(state.concurrency * self.decrease, self.min_concurrency)
+        self._apply(slot_key)
+        self.crawler.stats.inc_value(f"aimd/{slot_key}/decreases")
+
+    def process_response(self, request, response, spider):
+        slot_key, state = self._slot(request)
+        if state is None:
+            return response
+        if response.status in self.CONGESTION_HTTP_CODES:
+            self._on_congestion(slot_key, state)
+        else:
+            self._on_success(
+                slot_key, state, request.meta.get("download_latency", 0.0)
+            )
+        return response
+
+    def process_exception(self, request, exception, spider):
+        slot_key, state = self._slot(request)
+        if state is not None and isinstance(exception, DownloadTimeoutError):
+            self._on_congestion(slot_key, state)
+        return None
+
+    def _report_stats(self) -> None:
+        stats = self.crawler.stats
+        for slot_key, state in self.slots.items():
+            throughput = state.responses / self.stats_interval
+            state.responses = 0
+            if throughput > state.max_throughput:
+                state.max_throughput = throughput
+                state.best_concurrency = state.concurrency
+            stats.set_value(f"aimd/{slot_key}/concurrency", int(state.concurrency))
+            stats.set_value(f"aimd/{slot_key}/throughput_rps", round(throughput, 2))
+            stats.set_value(
+                f"aimd/{slot_key}/max_throughput_rps", round(state.max_throughput, 2)
+            )
+            stats.set_value(
+                f"aimd/{slot_key}/best_concurrency", int(state.best_concurrency)
+            )
+            if state.latency is not None:
+                stats.set_value(f"aimd/{slot_key}/latency", round(state.latency, 3))
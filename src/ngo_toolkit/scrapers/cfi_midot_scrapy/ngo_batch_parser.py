@@ -0,0 +1,238 @@
+import json
+import logging
+import re
+import traceback
+from collections import Counter
+from typing import Optional
+
+import attr
+
+from ngo_toolkit.scrapers.cfi_midot_scrapy.items import NgoInfo
+from ngo_toolkit.scrapers.cfi_midot_scrapy.items_loaders import (
+    FILTER_REASON_MISSING,
+    METHOD_NAME_RESOURCE_NAME,
+    RESOURCE_NAME_TO_METHOD_NAME,
+    load_ngo_info,
+    finance_filter_reason,
+)
+from ngo_toolkit.scrapers.cfi_midot_scrapy.session_token import is_token_rejected
+
+logger = logging.getLogger(__name__)
+
+# GuideStar answers for an ngo_id it doesn't know with an error message like these
+NGO_NOT_FOUND_MESSAGE_RE = re.compile(
+    r"not found|does not exist|no such|לא נמצא|לא קיים", re.IGNORECASE
+)
+
+
+@attr.s(frozen=True, auto_attribs=True)
+class ParsedNgoBatch:
+    """Plain result of parsing a batched remoting reply, can be sent back from a worker process"""
+
+    token_rejected: bool = False
+    items: list[NgoInfo | dict] = attr.ib(factory=list)
+    # (ngo_id, error message)
+    failures: list[tuple[int, str]] = attr.ib(factory=list)
+    missing_fields: Counter = attr.ib(factory=Counter)
+    # ngo_id -> (names of its resources that failed, its resources scraped successfully so far)
+    failed_resources: dict[int, tuple[list[str], list[dict]]] = attr.ib(factory=dict)
+    # Two-phase fetch: scraped finances of the NGOs kept by the filter, by ngo_id
+    finances_passed: dict[int, list[dict]] = attr.ib(factory=dict)
+
+
+def _demultiplex_by_ngo(
+    scraped_data: list[dict], tid_to_ngo_id: dict[int, int]
+) -> dict[int, list[dict]]:
+    """Split a batched remoting reply back to the resources of each NGO"""
+    ngos_scraped_data: dict[int, list[dict]] = {
+        ngo_id: [] for ngo_id in tid_to_ngo_id.values()
+    }
+    for scraped_resource in scraped_data:
+        ngo_id = tid_to_ngo_id.get(scraped_resource.get("tid"))
+        if ngo_id is None:
+            logger.warning("Unexpected tid in GuideStar reply: %s", scraped_resource)
+            continue
+        ngos_scraped_data[ngo_id].append(scraped_resource)
+    return ngos_scraped_data
+
+
+def _is_ngo_missing(ngo_scraped_data: list[dict]) -> bool:
+    """Check if GuideStar doesn't know the NGO, which no retry would change.
+    Either a resource failed with a "not found" message, or the NGO details came back empty.
+    """
+    details_method = RESOURCE_NAME_TO_METHOD_NAME["general_info"]
+    for scraped_resource in ngo_scraped_data:
+        result = scraped_resource.get("result")
+        messages = [scraped_resource.get("message")]
+        if isinstance(result, dict):
+            messages.append(result.get("message"))
+        if any(
+            NGO_NOT_FOUND_MESSAGE_RE.search(message)
+            for message in messages
+            if isinstance(message, str)
+        ):
+            return True
+        if (
+            scraped_resource.get("method") == details_method
+            and scraped_resource.get("statusCode") == 200
+            and isinstance(result, dict)
+            and result.get("success")
+            and not result.get("result")
+        ):
+            return True
+    return False
+
+
+def _decode_reply(body: bytes) -> Optional[list[dict]]:
+    """The resources of a batched remoting reply, None if the reply is malformed
+    (e.g. an html error page, or a truncated body)
+    """
+    try:
+        scraped_data = json.loads(body)
+    except ValueError:
+        logger.warning("Failed to decode GuideStar reply: %r", body[:200])
+        return None
+    if not isinstance(scraped_data, list) or not all(
+        isinstance(scraped_resource, dict) for scraped_resource in scraped_data
+    ):
+        logger.warning("Unexpected GuideStar reply: %r", body[:200])
+        return None
+    return scraped_data
+
+
+def _all_failed(
+    tid_to_ngo_id: dict[int, int],
+    requested_resources: list[str],
+    scraped_resources: dict[int, list[dict]],
+) -> ParsedNgoBatch:
+    """A malformed reply fails the requested resources of every NGO in the batch"""
+    return ParsedNgoBatch(
+        failed_resources={
+            ngo_id: (list(requested_resources), scraped_resources.get(ngo_id, []))
+            for ngo_id in tid_to_ngo_id.values()
+        }
+    )
+
+
+def _split_failed_resources(
+    ngo_scraped_data: list[dict], requested_resources: list[str]
+) -> tuple[list[dict], list[str]]:
+    """Split the scraped resources of an NGO to the ones that arrived successfully,
+    and the names of the requested resources that failed or are missing from the reply.
+    """
+    succeeded = []
+    for scraped_resource in ngo_scraped_data:
+        if scraped_resource.get("statusCode") != 200:
+            logger.debug(
+                "Failed to scrap %s, Returned status code: %s",
+                scraped_resource.get("method"),
+                scraped_resource.get("statusCode"),
+            )
+            continue
+        result = scraped_resource.get("result")
+        if not isinstance(result, dict) or not result.get("success"):
+            logger.debug(
+                "Failed to get malkar resource %s", scraped_resource.get("method")
+            )
+            continue
+        succeeded.append(scraped_resource)
+
+    arrived = {
+        METHOD_NAME_RESOURCE_NAME.get(scraped_resource.get("method"))
+        for scraped_resource in succeeded
+    }
+    failed = [resource for resource in requested_resources if resource not in arrived]
+    return succeeded, failed
+
+
+def _missing_ngo_item(ngo_id: int) -> dict:
+    logger.debug("GuideStar has no ngo %s", ngo_id)
+    return dict(ngo_id=ngo_id, filter_reason=FILTER_REASON_MISSING)
+
+
+def parse_ngo_batch(
+    body: bytes,
+    tid_to_ngo_id: dict[int, int],
+    requested_resources: list[str],
+    scraped_resources: Optional[dict[int, list[dict]]] = None,
+) -> ParsedNgoBatch:
+    """Decode a batched remoting reply and build the item of every NGO in it.
+    `scraped_resources` are resources of the same NGOs fetched by earlier requests, by ngo_id.
+    NGOs with failed resources are returned in `failed_resources`, to re-request only those.
+    NGOs GuideStar doesn't know are returned as filtered items, they are never retried.
+    A failed NGO does not fail the rest of the batch, a malformed reply fails all of them.
+    """
+    scraped_resources = scraped_resources or {}
+    scraped_data = _decode_reply(body)
+    if scraped_data is None:
+        return _all_failed(tid_to_ngo_id, requested_resources, scraped_resources)
+    if is_token_rejected(scraped_data):
+        return ParsedNgoBatch(token_rejected=True)
+
+    parsed_batch = ParsedNgoBatch()
+    for ngo_id, ngo_scraped_data in _demultiplex_by_ngo(
+        scraped_data, tid_to_ngo_id
+    ).items():
+        if _is_ngo_missing(ngo_scraped_data):
+            parsed_batch.items.append(_missing_ngo_item(ngo_id))
+            continue
+        succeeded, failed = _split_failed_resources(
+            ngo_scraped_data, requested_resources
+        )
+        ngo_scraped_data = scraped_resources.get(ngo_id, []) + succeeded
+        if failed:
+            parsed_batch.failed_resources[ngo_id] = (failed, ngo_scraped_data)
+            continue
+        try:
+            parsed_batch.items.append(
+                load_ngo_info(ngo_id, ngo_scraped_data, parsed_batch.missing_fields)
+            )
+        except Exception:
+            parsed_batch.failures.append(
+                (ngo_id, f"Failed to load ngo: {ngo_id}\n{traceback.format_exc()}")
+            )
+    return parsed_batch
+
+
+def parse_ngo_finances_batch(
+    body: bytes, tid_to_ngo_id: dict[int, int], requested_resources: list[str]
+) -> ParsedNgoBatch:
+    """First phase of a two-phase fetch, where only the finances of each NGO were requested.
+    NGOs filtered out by their finances are returned as filtered items,
+    the scraped finances of the others in `finances_passed`.
+    """
+    scraped_data = _decode_reply(body)
+    if scraped_data is None:
+        return _all_failed(tid_to_ngo_id, requested_resources, {})
+    if is_token_rejected(scraped_data):
+        return ParsedNgoBatch(token_rejected=True)
+
+    parsed_batch = ParsedNgoBatch()
+    for ngo_id, ngo_scraped_data in _demultiplex_by_ngo(
+        scraped_data, tid_to_ngo_id
+    ).items():
+        if _is_ngo_missing(ngo_scraped_data):
+            parsed_batch.items.append(_missing_ngo_item(ngo_id))
+            continue
+        succeeded, failed = _split_failed_resources(
+            ngo_scraped_data, requested_resources
+        )
+        if failed:
+            parsed_batch.failed_resources[ngo_id] = (failed, succeeded)
+            continue
+        try:
+            filter_reason = finance_filter_reason(
+                ngo_id, succeeded[0], parsed_batch.missing_fields
+            )
+            if filter_reason is None:
+                parsed_batch.finances_passed[ngo_id] = succeeded
+            else:
+                logger.debug("Filtering out ngo %s", ngo_id)
+                parsed_batch.items.append(
+                    dict(ngo_id=ngo_id, filter_reason=filter_reason)
+                )
+        except Exception:
+            parsed_batch.failures.append(
+                (ngo_id, f"Failed to load ngo: {ngo_id}\n{traceback.format_exc()}")
+            )
+    return parsed_batch
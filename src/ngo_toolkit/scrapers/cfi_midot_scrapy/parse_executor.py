@@ -0,0 +1,81 @@
+import logging
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Any, Callable, Optional
+
+from scrapy.settings import Settings
+from twisted.internet import defer, threads
+from twisted.python.failure import Failure
+
+logger = logging.getLogger(__name__)
+
+PARSE_MODES = ("inline", "thread", "process")
+
+
+def _deferred_from_future(future: Future) -> defer.Deferred:
+    """Fire a Deferred on the reactor thread once a concurrent future is done"""
+    from twisted.internet import reactor
+
+    deferred = defer.Deferred()
+
+    def on_done(done_future: Future) -> None:
+        # `exception()` raises for a cancelled future, e.g. on `shutdown(cancel_futures=True)`
+        if done_future.cancelled():
+            reactor.callFromThread(deferred.errback, Failure(defer.CancelledError()))
+            return
+        exception = done_future.exception()
+        if exception is not None:
+            reactor.callFromThread(deferred.errback, Failure(exception))
+        else:
+            reactor.callFromThread(deferred.callback, done_future.result())
+
+    future.add_done_callback(on_done)
+    return deferred
+
+
+class ParseExecutor:
+    """Runs CPU bound parsing off the reactor thread, results come back as Deferreds.
+
+    - "inline": on the reactor thread, as a plain call
+    - "thread": in the reactor thread pool (`REACTOR_THREADPOOL_MAXSIZE`)
+    - "process": in a process pool of `workers` processes, the function, its arguments
+      and its result must be picklable
+
+    At most `max_in_flight` calls are submitted at once, the rest wait on the reactor.
+    As the callbacks awaiting them are still running, Scrapy stops feeding more responses
+    to the spider once its scraper slot is full, instead of queueing unbounded work.
+    """
+
+    def __init__(self, mode: str = "inline", workers: int = 1, max_in_flight: int = 64):
+        if mode not in PARSE_MODES:
+            raise ValueError(f"Unknown parse mode: {mode}, expected one of {PARSE_MODES}")
+        self.mode = mode
+        self._semaphore = defer.DeferredSemaphore(max(max_in_flight, 1))
+        self._process_pool: Optional[ProcessPoolExecutor] = None
+        if mode == "process":
+            self._process_pool = ProcessPoolExecutor(max_workers=workers)
+
+    @classmethod
+    def from_settings(cls, settings: Settings) -> "ParseExecutor":
+        return cls(
+            mode=settings.get("GUIDESTAR_PARSE_MODE"),
+            workers=settings.getint("GUIDESTAR_PARSE_WORKERS"),
+            max_in_flight=settings.getint("GUIDESTAR_PARSE_MAX_IN_FLIGHT"),
+        )
+
+    def _submit(self, fn: Callable, *args: Any) -> defer.Deferred:
+        from twisted.internet import reactor
+
+        if self.mode == "thread":
+            return threads.deferToThreadPool(
+                reactor, reactor.getThreadPool(), fn, *args
+            )
+        if self.mode == "process":
+            return _deferred_from_future(self._process_pool.submit(fn, *args))
+        return defer.maybeDeferred(fn, *args)
+
+    def submit(self, fn: Callable, *args: Any) -> defer.Deferred:
+        return self._semaphore.run(self._submit, fn, *args)
+
+    def shutdown(self) -> None:
+        if self._process_pool is not None:
+            self._process_pool.shutdown(wait=False, cancel_futures=True)
@@ -1,7 +1,17 @@
+import csv
+import os
+
 from scrapy.exporters import CsvItemExporter
 
+from ngo_toolkit.scheduling.scrape_state import (
+    SCRAPE_STATE_FILENAME,
+    FilterReason,
+    ScrapeOutcome,
+    ScrapeStateStore,
+)
+from ngo_toolkit.scrapers.cfi_midot_scrapy.finance_batch import NgoFinanceBatch
 from ngo_toolkit.scrapers.cfi_midot_scrapy.items import (
-    NgoFinanceInfoSchema,
+    NgoFinanceInfo,
     NgoGeneralInfoSchema,
     NgoInfo,
 )
@@ -20,8 +30,30 @@ class GuideStarMultiCSVExporter(object):
     ]
 
     def open_spider(self, spider):
+        # "data", or the directory of a single shard in a sharded crawl
+        self.output_dir = spider.settings.get("GUIDESTAR_OUTPUT_DIR")
+        os.makedirs(self.output_dir, exist_ok=True)
+        # Keep the previous output, NGOs that are not scraped on this run are carried over from it
+        for name in self.defined_items:
+            output_path = os.path.join(self.output_dir, f"{name}.csv")
+            previous_path = os.path.join(self.output_dir, f"{name}.previous.csv")
+            # An existing previous file means the last crawl didn't finish, so it's still the latest full output
+            if os.path.exists(output_path) and not os.path.exists(previous_path):
+                os.replace(output_path, previous_path)
+        self.exported_ngo_ids: set[int] = set()
+        # NGOs that left the registry are dropped from the output, not carried over
+        self.removed_ngo_ids: set[int] = set(getattr(spider, "removed_ngo_ids", ()))
+        # Financial reports waiting to be exported together, see `_export_financial_info`
+        self.finance_batch_size = spider.settings.getint(
+            "GUIDESTAR_EXPORT_FINANCE_BATCH_SIZE"
+        )
+        self.pending_financial_info: list[NgoFinanceInfo] = []
+
         self.files = dict(
-            [(name, open(f"data/{name}.csv", "w+b")) for name in self.defined_items]
+            [
+                (name, open(os.path.join(self.output_dir, f"{name}.csv"), "w+b"))
+                for name in self.defined_items
+            ]
         )
         self.exporters = dict(
             [(name, CsvItemExporter(self.files[name])) for name in self.defined_items]
@@ -33,9 +65,9 @@ class GuideStarMultiCSVExporter(object):
     def _multi_exporter_for_item(self, item: NgoInfo) -> None:
 
         if item.financial_info:
-            financial_info = NgoFinanceInfoSchema(many=True).dump(item.financial_info)
-            for report in financial_info:
-                self.exporters["NgoFinanceInfo"].export_item(report)
+            self.pending_financial_info.extend(item.financial_info)
+            if len(self.pending_financial_info) >= self.finance_batch_size:
+                self._export_financial_info()
 
         if item.general_info:
             general_info = NgoGeneralInfoSchema().dump(item.general_info)
@@ -48,13 +80,79 @@ class GuideStarMultiCSVExporter(object):
         #     for report in top_earners_info:
         #         self.exporters["NgoTopRecipientsSalaries"].export_item(top_earners_info)
 
+    def _export_financial_info(self) -> None:
+        """Export the pending reports with the `NgoFinanceInfoSchema` columns,
+        computed for all of them at once by `NgoFinanceBatch`
+        """
+        if not self.pending_financial_info:
+            return
+        finance_df = NgoFinanceBatch.from_reports(self.pending_financial_info).to_frame()
+        self.pending_financial_info = []
+        # NaN ratios are exported empty, like the None ratios of `NgoFinanceInfo`
+        finance_df = finance_df.astype(object).where(finance_df.notna(), None)
+        for report in finance_df.to_dict("records"):
+            self.exporters["NgoFinanceInfo"].export_item(report)
+
+    def _carry_over_previous_rows(self, name: str) -> None:
+        previous_path = os.path.join(self.output_dir, f"{name}.previous.csv")
+        if not os.path.exists(previous_path):
+            return
+
+        with open(previous_path, newline="", encoding="utf-8") as previous_file:
+            for row in csv.DictReader(previous_file):
+                ngo_id = int(row["ngo_id"])
+                if (
+                    ngo_id not in self.exported_ngo_ids
+                    and ngo_id not in self.removed_ngo_ids
+                ):
+                    self.exporters[name].export_item(row)
+        os.remove(previous_path)
+
     def close_spider(self, spider):
+        self._export_financial_info()
+        for name in self.defined_items:
+            self._carry_over_previous_rows(name)
         [e.finish_exporting() for e in self.exporters.values()]
         [f.close() for f in self.files.values()]
 
     def process_item(self, item: NgoInfo | dict, spider):
         if isinstance(item, dict):
             self.exporters["filtered_ngos"].export_item(item)
+            self.exported_ngo_ids.add(item["ngo_id"])
         else:
             self._multi_exporter_for_item(item)
+            self.exported_ngo_ids.add(item.ngo_id)
         return item
+
+
+class NgoScrapeStatePipeline(object):
+    """Records the outcome of each scraped NGO, used to schedule the next crawls"""
+
+    def open_spider(self, spider):
+        self.store = ScrapeStateStore.load()
+        # A shard of a sharded crawl saves its own copy, merged back by `merge_shards`
+        self.store.path = os.path.join(
+            spider.settings.get("GUIDESTAR_OUTPUT_DIR"), SCRAPE_STATE_FILENAME
+        )
+        self.seen_ngo_ids: set[int] = set()
+
+    def process_item(self, item: NgoInfo | dict, spider):
+        if isinstance(item, dict):
+            self.store.record(
+                item["ngo_id"],
+                ScrapeOutcome.FILTERED,
+                filter_reason=FilterReason(item["filter_reason"]),
+            )
+            self.seen_ngo_ids.add(item["ngo_id"])
+        else:
+            self.store.record(
+                item.ngo_id, ScrapeOutcome.OK, item.last_financial_report_year
+            )
+            self.seen_ngo_ids.add(item.ngo_id)
+        return item
+
+    def close_spider(self, spider):
+        # NGOs without an item either failed or were never reached
+        for ngo_id in set(spider.ngo_ids) - self.seen_ngo_ids:
+            self.store.record(ngo_id, ScrapeOutcome.FAILED)
+        self.store.save()
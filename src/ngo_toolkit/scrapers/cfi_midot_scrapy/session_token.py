@@ -0,0 +1,60 @@
+import re
+
+import attr
+
+# Visualforce remoting rejects stale tokens with an exception mentioning the csrf/session
+TOKEN_REJECTED_STATUS_CODES = (400, 401, 403)
+TOKEN_REJECTED_MESSAGE_RE = re.compile(r"csrf|session|authenticity", re.IGNORECASE)
+
+
+class SessionTokenParseError(ValueError):
+    """Raised when a helper page has no csrf/vid tokens, e.g. a maintenance or challenge page"""
+
+
+def _get_csrf(page_text):
+    csrf_re = re.compile(
+        r'\{"name":"getUserInfo","len":0,"ns":"","ver":43\.0,"csrf":"([^"]+)"\}'
+    )
+    return "VmpFPSxNakF4T0Mwd05DMHhNMVF3TnpvMU16b3lOaTR5TkRGYSxyWk4waExQQ09WeTJJNnVPMWJuV3IzLFpXWTNaRFkz"
+    csrf, *_ = csrf_re.findall(page_text)
+    return csrf
+
+
+def _get_vid(page_text):
+    csrf_re = re.compile(r'RemotingProviderImpl\(\{"vf":\{"vid":"([^"]+)"')
+    csrf, *_ = csrf_re.findall(page_text)
+    return csrf
+
+
+@attr.s(frozen=True, auto_attribs=True)
+class GuideStarSessionToken:
+    """csrf/vid pair shared by all `apexremote` requests of a crawl.
+
+    `generation` is incremented on every refresh, so a rejected response can tell
+    whether it was sent with the current token or with one that was already replaced.
+    """
+
+    csrf: str
+    vid: str
+    generation: int = 0
+
+    @classmethod
+    def from_page(cls, page_text: str, generation: int = 0) -> "GuideStarSessionToken":
+        try:
+            csrf, vid = _get_csrf(page_text), _get_vid(page_text)
+        except ValueError as err:
+            raise SessionTokenParseError("No session token in the helper page") from err
+        return cls(csrf=csrf, vid=vid, generation=generation)
+
+    def as_ctx(self) -> dict:
+        return {"csrf": self.csrf, "ns": "", "vid": self.vid, "ver": 39}
+
+
+def is_token_rejected(ngo_scraped_data: list[dict]) -> bool:
+    """Check if the remoting reply failed because the csrf/vid token is expired or invalid"""
+    for scraped_resource in ngo_scraped_data:
+        if scraped_resource.get("statusCode") not in TOKEN_REJECTED_STATUS_CODES:
+            continue
+        if TOKEN_REJECTED_MESSAGE_RE.search(scraped_resource.get("message") or ""):
+            return True
+    return False
@@ -35,31 +35,75 @@ CONCURRENT_REQUESTS = 256
 CONCURRENT_REQUESTS_PER_DOMAIN = 256
 CONCURRENT_REQUESTS_PER_IP = 256
 
-AUTOTHROTTLE_ENABLED = True
-AUTOTHROTTLE_START_DELAY = 1
-AUTOTHROTTLE_MAX_DELAY = 0.25
-AUTOTHROTTLE_TARGET_CONCURRENCY = 128
-AUTOTHROTTLE_DEBUG = True
+# AutoThrottle is replaced by `AimdConcurrencyMiddleware`, which adapts the concurrency
+# instead of the delay. CONCURRENT_REQUESTS_* above are only upper bounds.
+AUTOTHROTTLE_ENABLED = False
+
+AIMD_ENABLED = True
+AIMD_START_CONCURRENCY = 16
+AIMD_MIN_CONCURRENCY = 1
+AIMD_MAX_CONCURRENCY = 256
+# Keep increasing while the average latency (seconds) and error rate stay under these
+AIMD_TARGET_LATENCY = 5.0
+AIMD_TARGET_ERROR_RATE = 0.05
+# Requests added per round trip, and the factor applied on 429/5xx/timeouts
+AIMD_INCREASE = 1
+AIMD_DECREASE = 0.5
+# Seconds between throughput measurements in the crawl stats
+AIMD_STATS_INTERVAL = 30
+
+# The csrf/vid session token is fetched once and shared by all NGO requests.
+# Give up if GuideStar rejects it more times than this during a single crawl.
+GUIDESTAR_MAX_SESSION_TOKEN_REFRESHES = 20
+# Helper pages (organization pages the token is fetched from) that may fail in a row,
+# each failure moves on to the page of the next pending NGO
+GUIDESTAR_MAX_SESSION_TOKEN_FAILURES = 5
+# Number of NGOs whose resources are requested in a single apexremote POST
+GUIDESTAR_NGOS_PER_REQUEST = 10
+# Request the finances of every NGO first, and its other resources only if it passes the
+# turnover filter. Most NGOs are filtered out, so their details are never downloaded.
+GUIDESTAR_TWO_PHASE_FETCH = True
+# Also scrape the top earners salaries (getMalkarWageEarners) of the NGOs
+GUIDESTAR_SCRAPE_TOP_EARNERS = False
+# Where the scraped datasets and scrape state are written.
+# Each shard of a sharded crawl writes to its own directory, see `sharded_crawl`
+GUIDESTAR_OUTPUT_DIR = "data"
+# Financial reports exported together, their totals and ratios are computed as columns
+GUIDESTAR_EXPORT_FINANCE_BATCH_SIZE = 1000
+# Times the failed resources of an NGO are re-requested, before it moves to the dead-letter queue.
+# The dead-letter queue is retried once (a single attempt) at the end of the crawl,
+# at the lower concurrency below.
+GUIDESTAR_RESOURCE_RETRY_TIMES = 2
+DOWNLOAD_SLOTS = {
+    "guidestar-dead-letter": {"concurrency": 8, "delay": 1, "randomize_delay": True},
+}
+# Where replies are decoded and NGO items are built: "inline" on the reactor thread,
+# "thread" in the reactor thread pool or "process" in a pool of GUIDESTAR_PARSE_WORKERS processes
+GUIDESTAR_PARSE_MODE = environ.get("GUIDESTAR_PARSE_MODE", "inline")
+GUIDESTAR_PARSE_WORKERS = 4
+# Replies being parsed at once, further replies wait for a free slot
+GUIDESTAR_PARSE_MAX_IN_FLIGHT = 64
+# The type validation of the scraped items is set by the ITEMS_TYPE_VALIDATION environment
+# variable, as the item classes are built on import, see `items.py`
 
 RETRY_ENABLED = True
 RETRY_TIMES = 3
+# Only transient failures are retried. 404/410 are final and 400/401/403/405/406/409
+# will fail the same way again, see `GuideStarRetryMiddleware`
 RETRY_HTTP_CODES = [
     500,
     502,
     503,
     504,
-    400,
-    401,
-    403,
-    404,
-    405,
-    406,
-    407,
+    522,
+    524,
     408,
-    409,
-    410,
     429,
 ]
+# Exponential backoff between retries, in seconds: base * 2 ** retries, jittered, up to max.
+# Throttled (429/503) responses wait for their Retry-After header when they have one.
+GUIDESTAR_RETRY_BACKOFF_BASE = 1
+GUIDESTAR_RETRY_BACKOFF_MAX = 60
 # ----
 # Configure a delay for requests for the same website (default: 0)
 # See https://docs.scrapy.org/en/latest/topics/settings.html#download-delay
@@ -89,9 +133,12 @@ RETRY_HTTP_CODES = [
 
 # Enable or disable downloader middlewares
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
-# DOWNLOADER_MIDDLEWARES = {
-#    'ngo_toolkit.scrapers.cfi_midot_scrapy.middlewares.CfimidotDownloaderMiddleware': 543,
-# }
+DOWNLOADER_MIDDLEWARES = {
+    "scrapy.downloadermiddlewares.retry.RetryMiddleware": None,
+    "ngo_toolkit.scrapers.cfi_midot_scrapy.middlewares.GuideStarRetryMiddleware": 550,
+    # Sees the 429/5xx responses before the retry middleware turns them into retries
+    "ngo_toolkit.scrapers.cfi_midot_scrapy.middlewares.AimdConcurrencyMiddleware": 560,
+}
 
 # Enable or disable extensions
 # See https://docs.scrapy.org/en/latest/topics/extensions.html
@@ -102,6 +149,7 @@ RETRY_HTTP_CODES = [
 # Configure item pipelines
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 ITEM_PIPELINES = {
+    "ngo_toolkit.scrapers.cfi_midot_scrapy.pipelines.NgoScrapeStatePipeline": 900,
     "ngo_toolkit.scrapers.cfi_midot_scrapy.pipelines.GuideStarMultiCSVExporter": 1000,
 }
 
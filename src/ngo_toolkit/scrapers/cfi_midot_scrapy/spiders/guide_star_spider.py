@@ -1,13 +1,28 @@
 import json
 import logging
-import re
-from typing import Callable, Iterator, Union
+from collections import Counter, defaultdict, deque
+from typing import AsyncIterator, Callable, Iterator, Optional, Union
 
 import scrapy
+from scrapy import signals
+from scrapy.exceptions import CloseSpider, DontCloseSpider
+from scrapy.spidermiddlewares.httperror import HttpError
+from scrapy.utils.defer import maybe_deferred_to_future
 from ngo_toolkit.scrapers.cfi_midot_scrapy.items import NgoInfo
 from ngo_toolkit.scrapers.cfi_midot_scrapy.items_loaders import (
+    FILTER_REASON_MISSING,
     RESOURCE_NAME_TO_METHOD_NAME,
-    load_ngo_info,
+)
+from ngo_toolkit.scrapers.cfi_midot_scrapy.middlewares import GuideStarRetryMiddleware
+from ngo_toolkit.scrapers.cfi_midot_scrapy.ngo_batch_parser import (
+    ParsedNgoBatch,
+    parse_ngo_batch,
+    parse_ngo_finances_batch,
+)
+from ngo_toolkit.scrapers.cfi_midot_scrapy.parse_executor import ParseExecutor
+from ngo_toolkit.scrapers.cfi_midot_scrapy.session_token import (
+    GuideStarSessionToken,
+    SessionTokenParseError,
 )
 
 logger = logging.getLogger(__name__)
@@ -25,41 +40,27 @@ HEADERS = {
 }
 
 
-def _get_csrf(page_text):
-    csrf_re = re.compile(
-        r'\{"name":"getUserInfo","len":0,"ns":"","ver":43\.0,"csrf":"([^"]+)"\}'
-    )
-    return "VmpFPSxNakF4T0Mwd05DMHhNMVF3TnpvMU16b3lOaTR5TkRGYSxyWk4waExQQ09WeTJJNnVPMWJuV3IzLFpXWTNaRFkz"
-    csrf, *_ = csrf_re.findall(page_text)
-    return csrf
-
-
-def _get_vid(page_text):
-    csrf_re = re.compile(r'RemotingProviderImpl\(\{"vf":\{"vid":"([^"]+)"')
-    csrf, *_ = csrf_re.findall(page_text)
-    return csrf
-
-
 def generate_body_payload(
     resources: list[str],
-    ngo_num: int,
-    page_text: str,
+    ngo_nums: list[int],
+    session_token: GuideStarSessionToken,
 ) -> list[dict]:
-    csrf = _get_csrf(page_text)
-    vid = _get_vid(page_text)
-
+    """Build a single remoting request with an RPC action per resource of every NGO.
+    Each action gets a distinct `tid`, which is echoed back in its result.
+    """
     body_payload: list[dict] = []
-    for resource_num, resource in enumerate(resources):
-        body_payload.append(
-            {
-                "action": "GSTAR_Ctrl",
-                "method": RESOURCE_NAME_TO_METHOD_NAME[resource],
-                "data": [ngo_num],
-                "type": "rpc",
-                "tid": 3 + resource_num,
-                "ctx": {"csrf": csrf, "ns": "", "vid": vid, "ver": 39},
-            }
-        )
+    for ngo_num in ngo_nums:
+        for resource in resources:
+            body_payload.append(
+                {
+                    "action": "GSTAR_Ctrl",
+                    "method": RESOURCE_NAME_TO_METHOD_NAME[resource],
+                    "data": [ngo_num],
+                    "type": "rpc",
+                    "tid": 3 + len(body_payload),
+                    "ctx": session_token.as_ctx(),
+                }
+            )
     return body_payload
 
 
@@ -85,12 +86,68 @@ class GuideStarSpider(scrapy.Spider):
         # "top_earners_info",
     ]
 
-    def __init__(self, ngo_ids: Union[list[int], str], **kwargs) -> None:
+    # Two-phase fetch: resources requested first for every NGO, which decide whether it is filtered out
+    finance_resources = ["financial_info"]
+
+    # Download slot of the dead-letter pass, its concurrency is set in `DOWNLOAD_SLOTS`
+    dead_letter_download_slot = "guidestar-dead-letter"
+
+    # Any organization page embeds the csrf/vid tokens needed by `ngo_xml_data_url`
+    helper_page_url = "https://www.guidestar.org.il/organization/{ngo_id}"
+
+    def __init__(
+        self,
+        ngo_ids: Union[list[int], str],
+        removed_ngo_ids: Union[list[int], str, None] = None,
+        **kwargs,
+    ) -> None:
         self.ngo_ids = _parse_ngo_ids(ngo_ids)
+        # NGOs that left the registry, their rows aren't carried over to the new output
+        self.removed_ngo_ids = _parse_ngo_ids(removed_ngo_ids) if removed_ngo_ids else []
+        # Shared by all requests, refreshed only when GuideStar rejects it
+        self.session_token: Optional[GuideStarSessionToken] = None
+        self._refreshing_session_token = False
+        # NGOs waiting for a (new) session token before being requested
+        self._pending_ngo_ids: deque[int] = deque()
+        # Requests rejected with the session token, re-sent as they were once it is refreshed:
+        # (ngo_ids, resources, scraped resources, attempt, dead-letter pass)
+        self._pending_requests: list[
+            tuple[list[int], list[str], Optional[dict[int, list[dict]]], int, bool]
+        ] = []
+        # (resource, scraped field) -> number of scraped records missing it
+        self.missing_fields: Counter = Counter()
+        # NGOs that kept failing, retried at the end of the crawl:
+        # (ngo_id, names of the resources that failed, resources scraped so far)
+        self._dead_letter: list[tuple[int, list[str], list[dict]]] = []
         super().__init__(**kwargs)
 
-    def request(self, url: str, ngo_id: int, callback: Callable) -> scrapy.Request:
-        request = scrapy.Request(url=url, callback=callback, meta={"ngo_id": ngo_id})
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs) -> "GuideStarSpider":
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        spider.parse_executor = ParseExecutor.from_settings(crawler.settings)
+        if (
+            crawler.settings.getbool("GUIDESTAR_SCRAPE_TOP_EARNERS")
+            and "top_earners_info" not in spider.resources
+        ):
+            spider.resources = [*spider.resources, "top_earners_info"]
+        # Resources requested only for the NGOs whose finances pass the filter
+        spider.detail_resources = [
+            resource
+            for resource in spider.resources
+            if resource not in spider.finance_resources
+        ]
+        spider.two_phase_fetch = crawler.settings.getbool(
+            "GUIDESTAR_TWO_PHASE_FETCH"
+        ) and bool(spider.detail_resources)
+        crawler.signals.connect(spider.spider_idle, signal=signals.spider_idle)
+        return spider
+
+    def request(
+        self, url: str, ngo_id: int, callback: Callable, **kwargs
+    ) -> scrapy.Request:
+        request = scrapy.Request(
+            url=url, callback=callback, meta={"ngo_id": ngo_id}, **kwargs
+        )
 
         # Mutates headers
         HEADERS["Referer"] = url
@@ -100,55 +157,350 @@ class GuideStarSpider(scrapy.Spider):
         return request
 
     def start_requests(self) -> Iterator[scrapy.Request]:
-        for ngo_id in self.ngo_ids:
-            # Used to build body_payload for ngo_data request
-            helper_page_url = f"https://www.guidestar.org.il/organization/{ngo_id}"
-
-            yield self.request(
-                url=helper_page_url,
-                ngo_id=ngo_id,
-                callback=self.scrape_xml_data,
+        self._pending_ngo_ids.extend(self.ngo_ids)
+        if self._pending_ngo_ids:
+            yield self._session_token_request()
+
+    def _session_token_request(self, helper_failures: int = 0) -> scrapy.Request:
+        """`helper_failures` counts the helper pages that already failed for this token"""
+        max_refreshes = self.settings.getint("GUIDESTAR_MAX_SESSION_TOKEN_REFRESHES")
+        if self.session_token and self.session_token.generation >= max_refreshes:
+            raise CloseSpider("GuideStar keeps rejecting the session token")
+
+        self._refreshing_session_token = True
+        # The page of the next pending NGO, see `_on_session_token_request_failed`
+        helper_ngo_id = (
+            self._pending_ngo_ids[0] if self._pending_ngo_ids else self.ngo_ids[0]
+        )
+        logger.debug("Fetching GuideStar session token")
+        request = self.request(
+            url=self.helper_page_url.format(ngo_id=helper_ngo_id),
+            ngo_id=helper_ngo_id,
+            callback=self.scrape_xml_data,
+            errback=self._on_session_token_request_failed,
+            # The helper page is fetched again on every refresh
+            dont_filter=True,
+        )
+        request.meta["helper_failures"] = helper_failures
+        return request
+
+    def _on_session_token_request_failed(
+        self, failure
+    ) -> Iterator[scrapy.Request | dict]:
+        """The helper page failed (e.g. out of retries), use the page of another pending NGO.
+        Without a token no NGO can be requested, so the crawl is closed after too many failures.
+        An NGO without a page (404/410) is missing rather than failed, it is filtered out.
+        """
+        helper_ngo_id = failure.request.meta["ngo_id"]
+        if (
+            failure.check(HttpError)
+            and failure.value.response.status
+            in GuideStarRetryMiddleware.PERMANENT_HTTP_CODES
+            and self._pending_ngo_ids
+            and self._pending_ngo_ids[0] == helper_ngo_id
+        ):
+            # Already counted by `GuideStarRetryMiddleware`
+            self._pending_ngo_ids.popleft()
+            yield dict(ngo_id=helper_ngo_id, filter_reason=FILTER_REASON_MISSING)
+            if self._pending_ngo_ids or self._pending_requests:
+                yield self._session_token_request(
+                    failure.request.meta["helper_failures"]
+                )
+            else:
+                self._refreshing_session_token = False
+            return
+
+        yield from self._on_helper_page_failed(failure.request, failure.value)
+
+    def _on_helper_page_failed(
+        self, helper_request: scrapy.Request, error: Exception
+    ) -> Iterator[scrapy.Request]:
+        """No session token from the helper page, whether it failed or had no token in it"""
+        helper_ngo_id = helper_request.meta["ngo_id"]
+        helper_failures = helper_request.meta["helper_failures"] + 1
+        logger.warning(
+            "Failed to fetch the session token from the page of ngo %s: %r",
+            helper_ngo_id,
+            error,
+        )
+        self.crawler.stats.inc_value("guidestar/session_token_failed")
+        max_failures = self.settings.getint("GUIDESTAR_MAX_SESSION_TOKEN_FAILURES")
+        if helper_failures >= max_failures:
+            self._refreshing_session_token = False
+            raise CloseSpider(
+                f"Failed to fetch the session token from {helper_failures} helper pages"
             )
 
+        # The failed helper NGO is still requested, after the others
+        if self._pending_ngo_ids and self._pending_ngo_ids[0] == helper_ngo_id:
+            self._pending_ngo_ids.rotate(-1)
+        yield self._session_token_request(helper_failures)
+
     def scrape_xml_data(self, helper_page_response) -> Iterator[scrapy.Request]:
-        ngo_id = helper_page_response.meta["ngo_id"]
-        body_payload = generate_body_payload(
-            self.resources, ngo_id, helper_page_response.text
-        )
+        generation = self.session_token.generation + 1 if self.session_token else 0
+        try:
+            session_token = GuideStarSessionToken.from_page(
+                helper_page_response.text, generation=generation
+            )
+        except SessionTokenParseError as err:
+            # Loaded, but not an organization page (maintenance, challenge...)
+            yield from self._on_helper_page_failed(helper_page_response.request, err)
+            return
+        self.session_token = session_token
+        self._refreshing_session_token = False
+        self.crawler.stats.inc_value("guidestar/session_token_fetched")
+
+        yield from self._drain_pending_ngos()
+
+    def _drain_pending_ngos(self) -> Iterator[scrapy.Request]:
+        pending_requests, self._pending_requests = self._pending_requests, []
+        for ngo_ids, resources, scraped_resources, attempt, dead_letter_pass in (
+            pending_requests
+        ):
+            yield self._ngo_xml_data_request(
+                ngo_ids,
+                resources,
+                scraped_resources,
+                attempt=attempt,
+                dead_letter_pass=dead_letter_pass,
+            )
+
+        batch_size = max(self.settings.getint("GUIDESTAR_NGOS_PER_REQUEST"), 1)
+        while self._pending_ngo_ids:
+            batch = [
+                self._pending_ngo_ids.popleft()
+                for _ in range(min(batch_size, len(self._pending_ngo_ids)))
+            ]
+            yield self._ngo_xml_data_request(batch, self._first_phase_resources)
+
+    @property
+    def _first_phase_resources(self) -> list[str]:
+        return self.finance_resources if self.two_phase_fetch else self.resources
+
+    def _ngo_xml_data_request(
+        self,
+        ngo_ids: list[int],
+        resources: list[str],
+        scraped_resources: Optional[dict[int, list[dict]]] = None,
+        attempt: int = 0,
+        dead_letter_pass: bool = False,
+    ) -> scrapy.Request:
+        """`scraped_resources` are resources of the same NGOs already fetched, by ngo_id.
+        `attempt` counts the times these resources were already requested and failed.
+        """
+        body_payload = generate_body_payload(resources, ngo_ids, self.session_token)
+        meta = {
+            "ngo_ids": ngo_ids,
+            "tid_to_ngo_id": {
+                action["tid"]: action["data"][0] for action in body_payload
+            },
+            "session_token_generation": self.session_token.generation,
+            "resources": resources,
+            "scraped_resources": scraped_resources,
+            "resource_attempt": attempt,
+            "dead_letter_pass": dead_letter_pass,
+        }
+        if dead_letter_pass:
+            meta["download_slot"] = self.dead_letter_download_slot
 
-        yield scrapy.Request(
+        return scrapy.Request(
             url=self.ngo_xml_data_url,
             method="POST",
             body=json.dumps(body_payload),
             headers=HEADERS,
             callback=self.parse,
-            meta=helper_page_response.meta,
+            errback=self._on_ngo_request_failed,
+            meta=meta,
+            # Re-requested NGOs share the same url and body
+            dont_filter=True,
         )
 
-    def parse(self, response, **kwargs) -> Iterator[NgoInfo | dict]:
-        """Parse NGO data from response"""
-        ngo_id = response.meta["ngo_id"]
-        logger.debug("Starting Parsing of xml_data for: %s", ngo_id)
-        ngo_scraped_data = response.json()
-        self._validate_all_resources_arrived_successfully(ngo_scraped_data, ngo_id)
-        ngo_info_item = load_ngo_info(ngo_id, ngo_scraped_data)
-        logger.debug("Finish Parsing xml_data for: %s", ngo_id)
+    def _on_session_token_rejected(self, meta: dict) -> Iterator[scrapy.Request]:
+        """Re-queue the request and refresh the token, unless it was already refreshed.
+        A rejection isn't a failed attempt, the request is re-sent with the same
+        resources, attempt and dead-letter pass.
+        """
+        self.crawler.stats.inc_value("guidestar/session_token_rejected")
+        request_state = (
+            meta["ngo_ids"],
+            meta["resources"],
+            meta["scraped_resources"],
+            meta["resource_attempt"],
+            meta["dead_letter_pass"],
+        )
+        if meta["session_token_generation"] == self.session_token.generation:
+            self._pending_requests.append(request_state)
+            if not self._refreshing_session_token:
+                yield self._session_token_request()
+        elif self._refreshing_session_token:
+            self._pending_requests.append(request_state)
+        else:
+            # Sent with a stale token which was already replaced
+            ngo_ids, resources, scraped_resources, attempt, dead_letter_pass = (
+                request_state
+            )
+            yield self._ngo_xml_data_request(
+                ngo_ids,
+                resources,
+                scraped_resources,
+                attempt=attempt,
+                dead_letter_pass=dead_letter_pass,
+            )
 
-        yield ngo_info_item
+    def _retry_failed_resources(
+        self, failed_resources: dict[int, tuple[list[str], list[dict]]], meta: dict
+    ) -> Iterator[scrapy.Request]:
+        """Re-request only the resources that failed, keeping the ones already scraped.
+        NGOs out of attempts are given up on, the dead-letter pass is a single attempt.
+        """
+        attempt = meta["resource_attempt"] + 1
+        retry_times = self.settings.getint("GUIDESTAR_RESOURCE_RETRY_TIMES")
+        out_of_attempts = meta["dead_letter_pass"] or attempt > retry_times
+        # NGOs missing the same resources are re-requested together
+        retries: dict[tuple[str, ...], dict[int, list[dict]]] = defaultdict(dict)
+        for ngo_id, (failed, scraped) in failed_resources.items():
+            if out_of_attempts:
+                self._give_up_on_ngo(ngo_id, failed, scraped, meta["dead_letter_pass"])
+                continue
+            retries[tuple(failed)][ngo_id] = scraped
 
-    def _validate_all_resources_arrived_successfully(
-        self, ngo_scraped_data: list[dict], ngo_id: int
+        for failed, scraped_resources in retries.items():
+            self.crawler.stats.inc_value(
+                "guidestar/ngo_resources_retried", len(scraped_resources)
+            )
+            yield self._ngo_xml_data_request(
+                list(scraped_resources),
+                list(failed),
+                scraped_resources,
+                attempt=attempt,
+                dead_letter_pass=meta["dead_letter_pass"],
+            )
+
+    def _give_up_on_ngo(
+        self,
+        ngo_id: int,
+        failed: list[str],
+        scraped: list[dict],
+        dead_letter_pass: bool,
     ) -> None:
+        """Move the NGO to the dead-letter queue, or fail it if it is already from there"""
+        if dead_letter_pass:
+            logger.error("Failed to scrap ngo: %s, resources: %s", ngo_id, failed)
+            self.crawler.stats.inc_value("guidestar/ngo_failed")
+            return
+        self._dead_letter.append((ngo_id, failed, scraped))
+        self.crawler.stats.inc_value("guidestar/ngo_dead_lettered")
 
-        if len(ngo_scraped_data) != len(self.resources):
-            raise Exception("Not all resources scraped for ngo")
+    def _on_ngo_request_failed(self, failure) -> None:
+        """The request failed for good (e.g. out of retries), all its NGOs are given up on"""
+        meta = failure.request.meta
+        logger.warning("Request for ngos %s failed: %r", meta["ngo_ids"], failure.value)
+        scraped_resources = meta["scraped_resources"] or {}
+        for ngo_id in meta["ngo_ids"]:
+            self._give_up_on_ngo(
+                ngo_id,
+                meta["resources"],
+                scraped_resources.get(ngo_id, []),
+                meta["dead_letter_pass"],
+            )
 
-        for scraped_resource in ngo_scraped_data:
-            if scraped_resource["statusCode"] != 200:
-                raise Exception(
-                    f"Failed to scrap ngo: {ngo_id}, Returned status code: {scraped_resource['statusCode']}"
+    def spider_idle(self) -> None:
+        """Once everything else is done, retry the dead-letter queue at a lower concurrency"""
+        if not self._dead_letter or self.session_token is None:
+            return
+        dead_letter, self._dead_letter = self._dead_letter, []
+        logger.info("Retrying %s ngos from the dead-letter queue", len(dead_letter))
+
+        retries: dict[tuple[str, ...], dict[int, list[dict]]] = defaultdict(dict)
+        for ngo_id, failed, scraped in dead_letter:
+            retries[tuple(failed)][ngo_id] = scraped
+        batch_size = max(self.settings.getint("GUIDESTAR_NGOS_PER_REQUEST"), 1)
+        for failed, scraped_resources in retries.items():
+            ngo_ids = list(scraped_resources)
+            for start in range(0, len(ngo_ids), batch_size):
+                batch = ngo_ids[start : start + batch_size]
+                self.crawler.engine.crawl(
+                    self._ngo_xml_data_request(
+                        batch,
+                        list(failed),
+                        {ngo_id: scraped_resources[ngo_id] for ngo_id in batch},
+                        dead_letter_pass=True,
+                    )
                 )
-            if not scraped_resource["result"]["success"]:
-                raise Exception(
-                    f"Failed to scrap ngo: {ngo_id}. Failed to get one or more malkar resources"
+        raise DontCloseSpider
+
+    async def parse(
+        self, response, **kwargs
+    ) -> AsyncIterator[NgoInfo | dict | scrapy.Request]:
+        """Parse the data of every NGO in the batch from response"""
+        ngo_ids = response.meta["ngo_ids"]
+        logger.debug("Starting Parsing of xml_data for: %s", ngo_ids)
+        is_finances_phase = (
+            self.two_phase_fetch and response.meta["resources"] == self.finance_resources
+        )
+        if is_finances_phase:
+            parse_args = (
+                parse_ngo_finances_batch,
+                response.body,
+                response.meta["tid_to_ngo_id"],
+                response.meta["resources"],
+            )
+        else:
+            parse_args = (
+                parse_ngo_batch,
+                response.body,
+                response.meta["tid_to_ngo_id"],
+                response.meta["resources"],
+                response.meta["scraped_resources"],
+            )
+        # Decoding and building the items is CPU bound, it may run off the reactor thread
+        parsed_batch: ParsedNgoBatch = await maybe_deferred_to_future(
+            self.parse_executor.submit(*parse_args)
+        )
+        if parsed_batch.token_rejected:
+            for request in self._on_session_token_rejected(response.meta):
+                yield request
+            return
+
+        if is_finances_phase:
+            self.crawler.stats.inc_value(
+                "guidestar/ngo_filtered_before_details", len(parsed_batch.items)
+            )
+            if parsed_batch.finances_passed:
+                yield self._ngo_xml_data_request(
+                    list(parsed_batch.finances_passed),
+                    self.detail_resources,
+                    scraped_resources=parsed_batch.finances_passed,
+                    dead_letter_pass=response.meta["dead_letter_pass"],
                 )
+
+        for request in self._retry_failed_resources(
+            parsed_batch.failed_resources, response.meta
+        ):
+            yield request
+
+        self.missing_fields.update(parsed_batch.missing_fields)
+        # A failed NGO must not fail the rest of the batch
+        for ngo_id, error in parsed_batch.failures:
+            logger.error(error)
+            self.crawler.stats.inc_value("guidestar/ngo_failed")
+        logger.debug("Finish Parsing xml_data for: %s", ngo_ids)
+        for ngo_info_item in parsed_batch.items:
+            if (
+                isinstance(ngo_info_item, dict)
+                and ngo_info_item["filter_reason"] == FILTER_REASON_MISSING
+            ):
+                self.crawler.stats.inc_value("guidestar/ngo_missing")
+            yield ngo_info_item
+
+    def closed(self, reason: str) -> None:
+        self.parse_executor.shutdown()
+        for (resource, field_name), count in self.missing_fields.items():
+            self.crawler.stats.set_value(
+                f"guidestar/missing_field/{resource}/{field_name}", count
+            )
+        if self.missing_fields:
+            logger.info(
+                "Missing scraped fields, (resource, field): count: %s",
+                dict(self.missing_fields.most_common()),
+            )
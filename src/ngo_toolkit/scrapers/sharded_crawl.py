@@ -0,0 +1,215 @@
+import csv
+import heapq
+import logging
+import multiprocessing
+import os
+import shutil
+import zlib
+from typing import Iterable, Iterator
+
+from ngo_toolkit.scheduling.scrape_state import SCRAPE_STATE_FILENAME, ScrapeStateStore
+from ngo_toolkit.scrapers.cfi_midot_scrapy.pipelines import GuideStarMultiCSVExporter
+
+logger = logging.getLogger(__name__)
+
+# Each shard writes its outputs to data/shards/<shard index>
+SHARDS_DIR = "data/shards"
+DATASET_NAMES = GuideStarMultiCSVExporter.defined_items
+
+
+class ShardCrawlError(Exception):
+    """Raised when a shard of a sharded crawl did not finish successfully"""
+
+
+def shard_of(ngo_id: int, shard_count: int) -> int:
+    # Stable across processes and machines, unlike `hash`
+    return zlib.crc32(str(ngo_id).encode()) % shard_count
+
+
+def partition_ngo_ids(ngo_ids: list[int], shard_count: int) -> list[list[int]]:
+    shards: list[list[int]] = [[] for _ in range(shard_count)]
+    for ngo_id in ngo_ids:
+        shards[shard_of(ngo_id, shard_count)].append(ngo_id)
+    return shards
+
+
+def shard_output_dir(shard_index: int) -> str:
+    return os.path.join(SHARDS_DIR, str(shard_index))
+
+
+def _sort_key(row: dict) -> tuple[int, int]:
+    return int(row["ngo_id"]), int(row.get("report_year") or 0)
+
+
+def _read_rows(path: str) -> Iterator[dict]:
+    with open(path, newline="", encoding="utf-8") as csv_file:
+        yield from csv.DictReader(csv_file)
+
+
+def _read_fieldnames(path: str) -> list[str]:
+    with open(path, newline="", encoding="utf-8") as csv_file:
+        return next(csv.reader(csv_file), [])
+
+
+def _write_rows(path: str, fieldnames: list[str], rows) -> None:
+    # Write to a temporary file first, so a crash never leaves a truncated dataset
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", newline="", encoding="utf-8") as csv_file:
+        writer = csv.DictWriter(
+            csv_file, fieldnames=fieldnames, restval="", extrasaction="ignore"
+        )
+        writer.writeheader()
+        writer.writerows(rows)
+    os.replace(tmp_path, path)
+
+
+def _sort_shard_outputs(output_dir: str) -> None:
+    """Sort each dataset of a shard by ngo_id, so the shards can be merged as streams"""
+    for name in DATASET_NAMES:
+        path = os.path.join(output_dir, f"{name}.csv")
+        if not os.path.exists(path):
+            continue
+        # Nothing was exported to it, not even a header
+        fieldnames = _read_fieldnames(path)
+        if not fieldnames:
+            continue
+        rows = sorted(_read_rows(path), key=_sort_key)
+        _write_rows(path, fieldnames, rows)
+
+
+def run_shard(ngo_ids: list[int], shard_index: int) -> None:
+    """Crawl the NGOs of a single shard, in this process, to the shard's own output directory"""
+    from scrapy.crawler import CrawlerProcess
+    from scrapy.utils.project import get_project_settings
+    from ngo_toolkit.scrapers.cfi_midot_scrapy.spiders.guide_star_spider import (
+        GuideStarSpider,
+    )
+
+    output_dir = shard_output_dir(shard_index)
+    # Outputs of a previous run of the shard must not be carried over into this one
+    shutil.rmtree(output_dir, ignore_errors=True)
+
+    crawl_settings = get_project_settings()
+    crawl_settings.set("GUIDESTAR_OUTPUT_DIR", output_dir)
+    process = CrawlerProcess(crawl_settings)
+    process.crawl(GuideStarSpider, ngo_ids)
+    process.start()
+
+    _sort_shard_outputs(output_dir)
+
+
+def crawl_sharded(ngo_ids: list[int], shard_count: int) -> None:
+    """Crawl the NGOs in `shard_count` processes, partitioned by the hash of their ngo_id"""
+    # A fresh interpreter per shard, each crawl needs its own Twisted reactor
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(
+            target=run_shard,
+            args=(shard_ngo_ids, shard_index),
+            name=f"guidestar-shard-{shard_index}",
+        )
+        for shard_index, shard_ngo_ids in enumerate(
+            partition_ngo_ids(ngo_ids, shard_count)
+        )
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    failed_shards = [
+        shard_index
+        for shard_index, process in enumerate(processes)
+        if process.exitcode != 0
+    ]
+    if failed_shards:
+        raise ShardCrawlError(f"Shards {failed_shards} did not finish successfully")
+
+
+def _shard_paths(name: str, shard_dirs: list[str]) -> list[str]:
+    return [
+        os.path.join(shard_dir, f"{name}.csv")
+        for shard_dir in shard_dirs
+        if os.path.exists(os.path.join(shard_dir, f"{name}.csv"))
+    ]
+
+
+def _scraped_ngo_ids(shard_dirs: list[str]) -> set[int]:
+    """NGOs exported to any dataset of any shard, filtered ones included.
+    Same as the `exported_ngo_ids` of a non-sharded crawl.
+    """
+    return {
+        int(row["ngo_id"])
+        for name in DATASET_NAMES
+        for path in _shard_paths(name, shard_dirs)
+        for row in _read_rows(path)
+    }
+
+
+def _merge_dataset(
+    name: str,
+    shard_dirs: list[str],
+    output_dir: str,
+    scraped_ngo_ids: set[int],
+    removed_ngo_ids: set[int],
+) -> None:
+    shard_paths = _shard_paths(name, shard_dirs)
+    canonical_path = os.path.join(output_dir, f"{name}.csv")
+
+    # NGOs that weren't scraped by any shard are carried over from the previous output.
+    # An NGO scraped in any dataset isn't, e.g. the finances of an NGO filtered out on this run,
+    # nor an NGO that left the registry.
+    # Sorted in memory, as the output of a non-sharded crawl is not sorted.
+    carried_over = []
+    if os.path.exists(canonical_path):
+        carried_over = sorted(
+            (
+                row
+                for row in _read_rows(canonical_path)
+                if int(row["ngo_id"]) not in scraped_ngo_ids
+                and int(row["ngo_id"]) not in removed_ngo_ids
+            ),
+            key=_sort_key,
+        )
+
+    fieldnames: list[str] = []
+    for path in [*shard_paths, *([canonical_path] if carried_over else [])]:
+        fieldnames += [
+            field for field in _read_fieldnames(path) if field not in fieldnames
+        ]
+    if not fieldnames:
+        return
+
+    merged_rows = heapq.merge(
+        *(_read_rows(path) for path in shard_paths), carried_over, key=_sort_key
+    )
+    _write_rows(canonical_path, fieldnames, merged_rows)
+
+
+def merge_shards(
+    shard_count: int,
+    output_dir: str = "data",
+    removed_ngo_ids: Iterable[int] = (),
+) -> None:
+    """Merge the shard outputs into the canonical datasets, sorted by ngo_id,
+    with a streaming k-way merge of the (sorted) shard datasets.
+    The rows of `removed_ngo_ids`, NGOs that left the registry, are dropped.
+    The scrape state of each shard is merged back for the NGOs of that shard.
+    """
+    shard_dirs = [shard_output_dir(shard_index) for shard_index in range(shard_count)]
+    scraped_ngo_ids = _scraped_ngo_ids(shard_dirs)
+    removed_ngo_ids = set(removed_ngo_ids)
+    for name in DATASET_NAMES:
+        _merge_dataset(name, shard_dirs, output_dir, scraped_ngo_ids, removed_ngo_ids)
+
+    store = ScrapeStateStore.load()
+    for shard_index, shard_dir in enumerate(shard_dirs):
+
+        def in_shard(ngo_id: int, shard_index=shard_index) -> bool:
+            return shard_of(ngo_id, shard_count) == shard_index
+
+        shard_state_path = os.path.join(shard_dir, SCRAPE_STATE_FILENAME)
+        if os.path.exists(shard_state_path):
+            store.merge_partition(ScrapeStateStore.load(shard_state_path), in_shard)
+    store.save()
+    logger.info("Merged the outputs of %s shards", shard_count)
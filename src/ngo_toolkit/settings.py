@@ -5,6 +5,16 @@ class Settings(BaseSettings):
     PUBLIC_SPREADSHEET_ID: str # The ID of the spreadsheet to update.
     RANKED_NGO_SHEET_NAME: str # The name of the ranked NGO result file.
 
+    # Days to wait before scraping an NGO again
+    RECRAWL_UP_TO_DATE_DAYS: int = 60 # Latest report is already for last year
+    RECRAWL_OUTDATED_DAYS: int = 7 # Latest report is older, a new one may show up
+    # Filtered out NGOs, by their filter reason
+    RECRAWL_NO_FINANCES_DAYS: int = 30 # No financial report on GuideStar
+    RECRAWL_LOW_TURNOVER_DAYS: int = 60 # Yearly turnover below the filter
+    RECRAWL_MISSING_DAYS: int = 90 # GuideStar doesn't know the NGO
+
+    RANKING_WORKERS: int = 1 # Number of processes ranking the years in parallel
+
 
     class Config:
         env_file = ".env"  # Specify the .env file
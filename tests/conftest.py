@@ -0,0 +1,14 @@
+import os
+
+# `ngo_toolkit.settings` requires the publishing settings, which the tests never use
+os.environ.setdefault("GOOGLE_SHEETS_CREDENTIALS", "{}")
+os.environ.setdefault("PUBLIC_SPREADSHEET_ID", "test-spreadsheet")
+os.environ.setdefault("RANKED_NGO_SHEET_NAME", "RankedNgo")
+
+# Loaded once here, away from the local .env of the repository root and its credentials
+_cwd = os.getcwd()
+os.chdir(os.path.dirname(__file__))
+try:
+    import ngo_toolkit.settings  # noqa: F401
+finally:
+    os.chdir(_cwd)
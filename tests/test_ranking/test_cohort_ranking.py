@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+
+from ngo_toolkit.ranking.cohort_ranking import CohortRanker, _grouped_pct_ranks
+
+from tests.test_ranking.test_scenarios import _ranked_year
+
+
+def _general_info(ngo_ids: pd.Series) -> pd.DataFrame:
+    return pd.DataFrame(
+        {
+            "ngo_id": ngo_ids,
+            "main_activity_field": ["health", "education"] * (len(ngo_ids) // 2),
+            "activity_fields": ["health,education", "education"] * (len(ngo_ids) // 2),
+            "target_audience": "children",
+        }
+    )
+
+
+def test_turnover_category_cohort_matches_rank_ngos():
+    ranked_year = _ranked_year()
+    ranker = CohortRanker(ranked_year, _general_info(ranked_year["ngo_id"]))
+    cohort_ranks = ranker.rank_within_cohort(["yearly_turnover_category"])
+    expected = ranked_year.sort_values("ngo_id", ignore_index=True)
+    np.testing.assert_array_equal(
+        cohort_ranks["cohort_percentile_num"], expected["percentile_num"]
+    )
+    np.testing.assert_allclose(
+        cohort_ranks["cohort_benchmark"], expected["main_rank_benchmark"]
+    )
+
+
+def test_grouped_pct_ranks_average_ties_like_pandas():
+    codes = np.array([0, 1, 0, 0, 1, 0, 1, 0])
+    values = np.array([60, 80, 60, 40, 80, 100, 40, 60], dtype=float)
+    pct_ranks, sizes, means = _grouped_pct_ranks(codes, values)
+
+    grouped = pd.Series(values).groupby(codes)
+    np.testing.assert_allclose(pct_ranks, grouped.rank(pct=True))
+    np.testing.assert_array_equal(sizes, grouped.transform("size"))
+    np.testing.assert_allclose(means, grouped.transform("mean"))
+
+
+def test_multi_valued_cohort_ranks_an_ngo_in_each_of_its_values():
+    ranked_year = _ranked_year()
+    general_info = _general_info(ranked_year["ngo_id"])
+    ranker = CohortRanker(ranked_year, general_info)
+    cohort_ranks = ranker.rank_within_cohort(["activity_fields"])
+
+    exploded = (
+        ranked_year[["ngo_id", "main_rank"]]
+        .merge(general_info, on="ngo_id")
+        .assign(activity_fields=lambda df: df["activity_fields"].str.split(","))
+        .explode("activity_fields")
+        .sort_values("ngo_id", kind="stable", ignore_index=True)
+    )
+    assert len(cohort_ranks) == len(exploded)
+    merged = cohort_ranks.merge(exploded, on=["ngo_id", "activity_fields"])
+    assert len(merged) == len(exploded)
+
+    grouped = merged.groupby("activity_fields")["main_rank_y"]
+    np.testing.assert_allclose(merged["cohort_percentile"], grouped.rank(pct=True))
+    np.testing.assert_array_equal(merged["cohort_size"], grouped.transform("size"))
+    np.testing.assert_allclose(merged["cohort_benchmark"], grouped.transform("mean"))
+    assert set(cohort_ranks["cohort_size"]) == {len(ranked_year) // 2, len(ranked_year)}
@@ -0,0 +1,110 @@
+import math
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from ngo_toolkit.ranking.ranking_cache import RankingCache
+from ngo_toolkit.ranking.ranking_service import (
+    compute_turnover_growth_ratio,
+    compute_turnover_growth_ratios,
+    rank_ngos_incremental,
+)
+
+# (last, previous, previous previous) turnovers, None is a missing report
+TURNOVER_CASES = [
+    (1_000_000, 800_000, 500_000),
+    (1_000_000, 800_000, None),
+    (1_000_000, None, 500_000),
+    (1_000_000, None, None),
+    (None, 800_000, 500_000),
+    (None, None, None),
+    # Zero turnovers
+    (0, 800_000, 500_000),
+    (1_000_000, 0, 500_000),
+    (1_000_000, 800_000, 0),
+    (1_000_000, 0, 0),
+    # Old turnovers too small for a meaningful growth ratio
+    (1_000_000, 25_000, 20_000),
+    (1_000_000, 30_000, 25_000),
+    (1_000_000, 10_000, 30_000),
+    (500_000, 2_000_000, 4_000_000),
+]
+
+
+def _nan_if_missing(turnover):
+    return np.nan if turnover is None else turnover
+
+
+@pytest.mark.parametrize("last, previous, previous_previous", TURNOVER_CASES)
+def test_growth_ratios_match_scalar_version(last, previous, previous_previous):
+    expected = compute_turnover_growth_ratio(
+        last_turnover=last,
+        previous_turnover=previous,
+        previous_previous_turnover=previous_previous,
+    )
+    (growth_ratio,) = compute_turnover_growth_ratios(
+        last_turnover=np.array([_nan_if_missing(last)]),
+        previous_turnover=np.array([_nan_if_missing(previous)]),
+        previous_previous_turnover=np.array([_nan_if_missing(previous_previous)]),
+    )
+    assert math.isclose(growth_ratio, expected)
+
+
+def test_growth_ratios_of_all_cases_at_once():
+    last, previous, previous_previous = (
+        np.array([_nan_if_missing(turnover) for turnover in turnovers], dtype=float)
+        for turnovers in zip(*TURNOVER_CASES)
+    )
+    expected = [
+        compute_turnover_growth_ratio(
+            last_turnover=case[0],
+            previous_turnover=case[1],
+            previous_previous_turnover=case[2],
+        )
+        for case in TURNOVER_CASES
+    ]
+    growth_ratios = compute_turnover_growth_ratios(
+        last_turnover=last,
+        previous_turnover=previous,
+        previous_previous_turnover=previous_previous,
+    )
+    np.testing.assert_allclose(growth_ratios, expected)
+
+
+def _financial_reports(reports: list[tuple[int, int, float]]) -> pd.DataFrame:
+    """(ngo_id, report_year, yearly_turnover) -> the report columns ranking needs"""
+    financial_reports = pd.DataFrame(
+        reports, columns=["ngo_id", "report_year", "yearly_turnover"]
+    )
+    financial_reports["yearly_turnover_category"] = "CAT_1M"
+    financial_reports["balance_ratio"] = 0.1
+    financial_reports["max_income_ratio"] = 0.6
+    financial_reports["admin_expense_ratio"] = 0.2
+    return financial_reports
+
+
+def _by_year(financial_reports: pd.DataFrame):
+    return financial_reports.sort_values(by="report_year").groupby(["report_year"])
+
+
+def test_incremental_ranking_reports_the_year_before_a_changed_year(tmp_path):
+    reports = [
+        (ngo_id, year, 600_000 + 1_000 * ngo_id)
+        for ngo_id in range(1, 6)
+        for year in (2019, 2020, 2021)
+        if (ngo_id, year) != (5, 2021)
+    ]
+    cache = RankingCache(str(tmp_path))
+    ranked_dfs, _ = rank_ngos_incremental(_by_year(_financial_reports(reports)), cache)
+    ranked_2020 = next(df for df in ranked_dfs if df["report_year"].iloc[0] == 2020)
+    assert ranked_2020.set_index("ngo_id").loc[5, "is_dropped_next_year"]
+
+    # NGO 5 reports for 2021 too, so it's no longer dropped after 2020
+    reports.append((5, 2021, 605_000))
+    ranked_dfs, changed_years = rank_ngos_incremental(
+        _by_year(_financial_reports(reports)), cache
+    )
+    ranked_2020 = next(df for df in ranked_dfs if df["report_year"].iloc[0] == 2020)
+    assert not ranked_2020.set_index("ngo_id").loc[5, "is_dropped_next_year"]
+    assert 2020 in changed_years
@@ -0,0 +1,68 @@
+import numpy as np
+import pandas as pd
+
+from ngo_toolkit.ranking.ranking_service import rank_ngos
+from ngo_toolkit.ranking.scenarios import RankingScenario, evaluate_scenarios
+
+TURNOVER_CATEGORIES = ["CAT_500K", "CAT_1M", "CAT_5M"]
+
+
+def _ranked_year(seed: int = 0, ngo_count: int = 60) -> pd.DataFrame:
+    """The latest year ranked by `rank_ngos`, over random reports of three years"""
+    rng = np.random.default_rng(seed)
+    reports = pd.DataFrame(
+        [
+            (ngo_id, year)
+            for ngo_id in range(1, ngo_count + 1)
+            for year in (2019, 2020, 2021)
+            # Some NGOs miss a year, so their growth ratio is NaN
+            if not (ngo_id % 7 == 0 and year == 2020)
+        ],
+        columns=["ngo_id", "report_year"],
+    )
+    reports["yearly_turnover"] = rng.integers(100_000, 2_000_000, len(reports))
+    reports["yearly_turnover_category"] = rng.choice(TURNOVER_CATEGORIES, len(reports))
+    reports["balance_ratio"] = rng.uniform(-0.2, 0.2, len(reports))
+    reports["max_income_ratio"] = rng.uniform(0.3, 1, len(reports))
+    reports["admin_expense_ratio"] = rng.uniform(0, 0.5, len(reports))
+    ranked_years = rank_ngos(
+        reports.sort_values("report_year").groupby(["report_year"])
+    )
+    return ranked_years[0]
+
+
+def test_baseline_scenario_reproduces_rank_ngos():
+    ranked_year = _ranked_year()
+    results = evaluate_scenarios(
+        ranked_year, [RankingScenario(name="growth_only", growth_weight=1)]
+    )
+    expected = ranked_year.set_index("ngo_id")
+    pd.testing.assert_series_equal(
+        results.main_ranks.loc["baseline"],
+        expected["main_rank"],
+        check_names=False,
+        check_dtype=False,
+    )
+    pd.testing.assert_series_equal(
+        results.percentiles.loc["baseline"],
+        expected["percentile_num"],
+        check_names=False,
+        check_dtype=False,
+    )
+    assert results.summary.loc["baseline", "mean_abs_rank_change"] == 0
+
+
+def test_scenario_weights_apply_to_the_sub_ranks():
+    ranked_year = _ranked_year(seed=1)
+    scenario = RankingScenario(
+        name="balance_heavy", growth_weight=0.2, balance_weight=0.6
+    )
+    results = evaluate_scenarios(ranked_year, [scenario])
+    expected = (
+        0.2 * ranked_year["growth_rank"]
+        + 0.6 * ranked_year["balance_rank"]
+        + 0.2 * ranked_year["stability_rank"]
+    ).astype(int)
+    np.testing.assert_array_equal(
+        results.main_ranks.loc["balance_heavy"].to_numpy(), expected.to_numpy()
+    )
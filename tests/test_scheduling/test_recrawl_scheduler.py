@@ -0,0 +1,73 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from ngo_toolkit.scheduling.recrawl_scheduler import select_ngos_to_scrape
+from ngo_toolkit.scheduling.scrape_state import (
+    FilterReason,
+    ScrapeOutcome,
+    ScrapeStateStore,
+)
+from ngo_toolkit.settings import settings
+
+NOW = datetime(2026, 6, 1)
+
+
+def _store_filtered(
+    tmp_path, filter_reason, days_ago: int, ngo_id: int = 1
+) -> ScrapeStateStore:
+    store = ScrapeStateStore(str(tmp_path / "NgoScrapeState.csv"))
+    store.record(
+        ngo_id,
+        ScrapeOutcome.FILTERED,
+        scraped_at=NOW - timedelta(days=days_ago),
+        filter_reason=filter_reason,
+    )
+    return store
+
+
+@pytest.mark.parametrize(
+    "filter_reason, recrawl_days",
+    [
+        (FilterReason.NO_FINANCES, settings.RECRAWL_NO_FINANCES_DAYS),
+        (FilterReason.LOW_TURNOVER, settings.RECRAWL_LOW_TURNOVER_DAYS),
+        (FilterReason.MISSING, settings.RECRAWL_MISSING_DAYS),
+        # Saved before filter reasons were kept
+        (None, settings.RECRAWL_NO_FINANCES_DAYS),
+    ],
+)
+def test_filtered_ngos_wait_the_interval_of_their_reason(
+    tmp_path, filter_reason, recrawl_days
+):
+    waiting = _store_filtered(tmp_path, filter_reason, recrawl_days - 1)
+    due = _store_filtered(tmp_path, filter_reason, recrawl_days)
+
+    assert select_ngos_to_scrape([1], waiting, now=NOW) == []
+    assert select_ngos_to_scrape([1], due, now=NOW) == [1]
+    assert select_ngos_to_scrape([1], waiting, now=NOW, full=True) == [1]
+
+
+def test_filter_reason_round_trips_through_the_store(tmp_path):
+    store = _store_filtered(tmp_path, FilterReason.LOW_TURNOVER, 3)
+    store.record(2, ScrapeOutcome.OK, report_year=2025, scraped_at=NOW)
+    store.save()
+
+    loaded = ScrapeStateStore.load(store.path)
+
+    assert loaded.get(1) == store.get(1)
+    assert loaded.get(1).filter_reason == FilterReason.LOW_TURNOVER
+    assert loaded.get(2).filter_reason is None
+
+
+def test_states_without_filter_reason_load(tmp_path):
+    path = tmp_path / "NgoScrapeState.csv"
+    path.write_text(
+        "ngo_id,last_scraped_at,last_outcome,last_report_year\n"
+        "1,2026-05-01T00:00:00,filtered,\n",
+        encoding="utf-8",
+    )
+
+    state = ScrapeStateStore.load(str(path)).get(1)
+
+    assert state.last_outcome == ScrapeOutcome.FILTERED
+    assert state.filter_reason is None
@@ -0,0 +1,54 @@
+from typing import Optional
+
+import pytest
+
+from ngo_toolkit.scrapers.api_interaction import RegistryClient, RegistryDownloadError
+
+
+class _StubRegistryClient(RegistryClient):
+    """Serves `record_count` records, at most `rows_max` per page like CKAN.
+    Pages from `served_count` on come back empty.
+    """
+
+    def __init__(
+        self,
+        record_count: int,
+        rows_max: int,
+        with_total: bool = True,
+        served_count: Optional[int] = None,
+    ):
+        super().__init__(page_size=50_000, session=object())
+        self.records = [{"מספר עמותה": ngo_id} for ngo_id in range(record_count)]
+        self.rows_max = rows_max
+        self.with_total = with_total
+        self.served_count = record_count if served_count is None else served_count
+
+    def _fetch_page(self, offset: int) -> tuple[list[dict], Optional[int]]:
+        page_end = min(offset + self.page_size, offset + self.rows_max, self.served_count)
+        page = self.records[offset:page_end]
+        return page, len(self.records) if self.with_total else None
+
+
+@pytest.mark.parametrize("with_total", [True, False])
+def test_short_pages_are_not_the_last_page(with_total):
+    client = _StubRegistryClient(100_000, rows_max=32_000, with_total=with_total)
+
+    pages = list(client.iter_records())
+
+    assert [len(page) for page in pages] == [32_000, 32_000, 32_000, 4_000]
+    assert [record for page in pages for record in page] == client.records
+
+
+def test_iter_records_resumes_from_offset():
+    client = _StubRegistryClient(10, rows_max=4)
+
+    pages = list(client.iter_records(offset=6))
+
+    assert pages == [client.records[6:10]]
+
+
+def test_empty_page_before_total_is_an_error():
+    client = _StubRegistryClient(100, rows_max=40, served_count=40)
+
+    with pytest.raises(RegistryDownloadError):
+        list(client.iter_records())
@@ -0,0 +1,139 @@
+import csv
+import math
+import random
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from scrapy.settings import Settings
+
+from ngo_toolkit.scrapers.cfi_midot_scrapy.finance_batch import (
+    FINANCE_INPUT_FIELDS,
+    NgoFinanceBatch,
+    categorize_turnovers,
+)
+from ngo_toolkit.scrapers.cfi_midot_scrapy.items import (
+    _TURNOVER_CATEGORIES,
+    NgoFinanceInfo,
+    NgoFinanceInfoSchema,
+    NgoGeneralInfo,
+    NgoInfo,
+    TurnoverCategory,
+)
+from ngo_toolkit.scrapers.cfi_midot_scrapy.pipelines import GuideStarMultiCSVExporter
+
+
+def _random_reports(count: int, seed: int = 0) -> list[NgoFinanceInfo]:
+    rng = random.Random(seed)
+    reports = []
+    for idx in range(count):
+        # Mostly sparse reports, so the zero turnover / expenses guards are exercised
+        values = {
+            name: rng.choice([0, 0, rng.randint(1, 3_000_000), rng.uniform(1, 1e6)])
+            for name in FINANCE_INPUT_FIELDS
+        }
+        reports.append(
+            NgoFinanceInfo(ngo_id=580000000 + idx, report_year=2021, **values)
+        )
+    # Every input is 0
+    reports.append(NgoFinanceInfo(ngo_id=580999999, report_year=2021))
+    return reports
+
+
+TURNOVERS = [
+    *(category.min_value for category in TurnoverCategory),
+    *(category.min_value - 1 for category in TurnoverCategory),
+    # sys.maxsize - 1 isn't representable as a float, the largest category is bound separately
+    *(
+        category.max_value - 1
+        for category in TurnoverCategory
+        if category.max_value < 2**53
+    ),
+    1e18,
+    250_000.5,
+    -1,
+    -0.5,
+    float("nan"),
+    float("inf"),
+    1e30,
+]
+
+
+def _scalar_category_idx(turnover: float) -> int:
+    try:
+        return _TURNOVER_CATEGORIES.index(TurnoverCategory.from_value(turnover))
+    except ValueError:
+        return -1
+
+
+def test_categorize_turnovers_matches_from_value():
+    expected = [_scalar_category_idx(turnover) for turnover in TURNOVERS]
+    assert categorize_turnovers(np.array(TURNOVERS)).tolist() == expected
+    # Negative, NaN and too large turnovers have no category
+    assert expected[-5:] == [-1] * 5
+
+
+def _assert_same_value(actual, expected, column: str) -> None:
+    if expected is None:
+        assert actual is None or math.isnan(actual), column
+    elif isinstance(expected, str):
+        assert actual == expected, column
+    else:
+        assert math.isclose(actual, expected, rel_tol=1e-9, abs_tol=1e-9), column
+
+
+def test_batch_matches_the_schema_dump_of_each_report():
+    reports = _random_reports(500)
+    expected_rows = NgoFinanceInfoSchema(many=True).dump(reports)
+
+    finance_df = NgoFinanceBatch.from_reports(reports).to_frame()
+
+    assert list(finance_df.columns) == list(expected_rows[0])
+    for row, expected_row in zip(finance_df.to_dict("records"), expected_rows):
+        for column, expected in expected_row.items():
+            _assert_same_value(row[column], expected, column)
+
+
+def _export(tmp_path, ngo_infos: list[NgoInfo], batch_size: int) -> list[dict]:
+    spider = SimpleNamespace(
+        settings=Settings(
+            {
+                "GUIDESTAR_OUTPUT_DIR": str(tmp_path),
+                "GUIDESTAR_EXPORT_FINANCE_BATCH_SIZE": batch_size,
+            }
+        )
+    )
+    exporter = GuideStarMultiCSVExporter()
+    exporter.open_spider(spider)
+    for ngo_info in ngo_infos:
+        exporter.process_item(ngo_info, spider)
+    exporter.close_spider(spider)
+    with open(tmp_path / "NgoFinanceInfo.csv", newline="", encoding="utf-8") as f:
+        return list(csv.DictReader(f))
+
+
+@pytest.mark.parametrize("batch_size", [1, 7, 1000])
+def test_exporter_writes_the_schema_columns(tmp_path, batch_size):
+    reports = _random_reports(30, seed=1)
+    ngo_infos = [
+        NgoInfo(
+            ngo_id=report.ngo_id,
+            general_info=NgoGeneralInfo(ngo_id=report.ngo_id, ngo_name="עמותה"),
+            financial_info=[report],
+        )
+        for report in reports
+    ]
+    expected_rows = NgoFinanceInfoSchema(many=True).dump(reports)
+
+    rows = _export(tmp_path, ngo_infos, batch_size)
+
+    assert len(rows) == len(expected_rows)
+    for row, expected_row in zip(rows, expected_rows):
+        assert list(row) == list(expected_row)
+        for column, expected in expected_row.items():
+            if expected is None:
+                assert row[column] == "", column
+            elif isinstance(expected, str):
+                assert row[column] == expected, column
+            else:
+                assert math.isclose(float(row[column]), expected, rel_tol=1e-9), column
@@ -0,0 +1,193 @@
+from collections import deque
+from types import SimpleNamespace
+
+import pytest
+from scrapy.exceptions import CloseSpider
+from scrapy.http import HtmlResponse
+from scrapy.settings import Settings
+from scrapy.spidermiddlewares.httperror import HttpError
+from scrapy.statscollectors import MemoryStatsCollector
+from twisted.python.failure import Failure
+
+from ngo_toolkit.scrapers.cfi_midot_scrapy import settings as project_settings
+from ngo_toolkit.scrapers.cfi_midot_scrapy.spiders.guide_star_spider import (
+    GuideStarSpider,
+)
+
+HELPER_PAGE = 'RemotingProviderImpl({"vf":{"vid":"vid"'
+
+
+@pytest.fixture
+def spider() -> GuideStarSpider:
+    settings = Settings()
+    settings.setmodule(project_settings)
+    spider = GuideStarSpider(ngo_ids=[1, 2, 3])
+    # The spider methods under test only need the settings and stats of the crawler
+    spider.settings = settings
+    spider.crawler = SimpleNamespace(settings=settings)
+    spider.crawler.stats = MemoryStatsCollector(spider.crawler)
+    spider.two_phase_fetch = False
+    spider._pending_ngo_ids.extend(spider.ngo_ids)
+    return spider
+
+
+def _refresh_session_token(spider: GuideStarSpider) -> list:
+    helper_request = spider._session_token_request()
+    return list(
+        spider.scrape_xml_data(
+            HtmlResponse(
+                helper_request.url,
+                body=HELPER_PAGE.encode(),
+                encoding="utf-8",
+                request=helper_request,
+            )
+        )
+    )
+
+
+def test_rejected_dead_letter_request_keeps_its_state(spider):
+    _refresh_session_token(spider)
+    scraped_resources = {1: [{"name": "general_info"}], 2: []}
+    rejected = spider._ngo_xml_data_request(
+        [1, 2],
+        ["financial_info"],
+        scraped_resources,
+        attempt=1,
+        dead_letter_pass=True,
+    )
+
+    # The token is refreshed, the request is re-sent once it is
+    [helper_request] = spider._on_session_token_rejected(rejected.meta)
+    assert helper_request.url.startswith("https://www.guidestar.org.il/organization/")
+    [request] = _refresh_session_token(spider)
+
+    assert request.meta["ngo_ids"] == [1, 2]
+    assert request.meta["resources"] == ["financial_info"]
+    assert request.meta["scraped_resources"] == scraped_resources
+    assert request.meta["resource_attempt"] == 1
+    assert request.meta["dead_letter_pass"]
+    assert request.meta["download_slot"] == spider.dead_letter_download_slot
+    assert request.meta["session_token_generation"] == 1
+
+
+def test_dead_letter_pass_is_a_single_attempt(spider):
+    _refresh_session_token(spider)
+    request = spider._ngo_xml_data_request(
+        [1], ["financial_info"], dead_letter_pass=True
+    )
+
+    retries = list(
+        spider._retry_failed_resources({1: (["financial_info"], [])}, request.meta)
+    )
+
+    assert retries == []
+    assert spider._dead_letter == []
+    assert spider.crawler.stats.get_value("guidestar/ngo_failed") == 1
+
+
+def test_failed_resources_are_retried_then_dead_lettered(spider):
+    _refresh_session_token(spider)
+    retry_times = spider.settings.getint("GUIDESTAR_RESOURCE_RETRY_TIMES")
+    failed_resources = {1: (["financial_info"], [{"name": "general_info"}])}
+    meta = spider._ngo_xml_data_request([1], ["financial_info"]).meta
+
+    attempts = 1
+    while retries := list(spider._retry_failed_resources(failed_resources, meta)):
+        [retry] = retries
+        assert not retry.meta["dead_letter_pass"]
+        meta = retry.meta
+        attempts += 1
+
+    assert attempts == 1 + retry_times
+    assert spider._dead_letter == [(1, ["financial_info"], [{"name": "general_info"}])]
+
+
+def _helper_page_failure(helper_request, status: int) -> Failure:
+    response = HtmlResponse(helper_request.url, status=status, request=helper_request)
+    failure = Failure(HttpError(response, "Ignoring non-200 response"))
+    failure.request = helper_request
+    return failure
+
+
+def test_missing_helper_page_moves_on_to_the_next_ngo(spider):
+    helper_request = spider._session_token_request()
+    assert helper_request.meta["ngo_id"] == 1
+
+    missing_item, next_helper_request = spider._on_session_token_request_failed(
+        _helper_page_failure(helper_request, 404)
+    )
+
+    assert missing_item == {"ngo_id": 1, "filter_reason": "missing"}
+    assert next_helper_request.meta["ngo_id"] == 2
+    assert next_helper_request.meta["helper_failures"] == 0
+    assert list(spider._pending_ngo_ids) == [2, 3]
+    assert spider._refreshing_session_token
+
+
+def test_last_missing_helper_page_stops_the_refresh(spider):
+    spider._pending_ngo_ids = deque([3])
+    helper_request = spider._session_token_request()
+
+    results = list(
+        spider._on_session_token_request_failed(
+            _helper_page_failure(helper_request, 410)
+        )
+    )
+
+    assert results == [{"ngo_id": 3, "filter_reason": "missing"}]
+    assert not spider._refreshing_session_token
+
+
+def test_failed_helper_page_is_rotated(spider):
+    helper_request = spider._session_token_request()
+
+    [next_helper_request] = spider._on_session_token_request_failed(
+        _helper_page_failure(helper_request, 500)
+    )
+
+    assert next_helper_request.meta["ngo_id"] == 2
+    assert next_helper_request.meta["helper_failures"] == 1
+    assert list(spider._pending_ngo_ids) == [2, 3, 1]
+
+
+def _helper_page(helper_request, body: str) -> HtmlResponse:
+    return HtmlResponse(
+        helper_request.url, body=body.encode(), encoding="utf-8", request=helper_request
+    )
+
+
+def test_helper_page_without_token_moves_on_to_the_next_ngo(spider):
+    helper_request = spider._session_token_request()
+
+    [next_helper_request] = spider.scrape_xml_data(
+        _helper_page(helper_request, "<html>maintenance</html>")
+    )
+
+    assert spider.session_token is None
+    assert spider._refreshing_session_token
+    assert next_helper_request.meta["ngo_id"] == 2
+    assert next_helper_request.meta["helper_failures"] == 1
+    assert list(spider._pending_ngo_ids) == [2, 3, 1]
+    assert spider.crawler.stats.get_value("guidestar/session_token_failed") == 1
+
+
+def test_helper_pages_without_token_close_the_spider(spider):
+    max_failures = spider.settings.getint("GUIDESTAR_MAX_SESSION_TOKEN_FAILURES")
+    helper_request = spider._session_token_request()
+
+    with pytest.raises(CloseSpider):
+        for _ in range(max_failures):
+            [helper_request] = spider.scrape_xml_data(
+                _helper_page(helper_request, "<html>maintenance</html>")
+            )
+
+    assert not spider._refreshing_session_token
+
+
+@pytest.mark.parametrize(
+    "removed_ngo_ids, expected", [(None, []), ("", []), ("5,8", [5, 8]), ([5], [5])]
+)
+def test_removed_ngo_ids_argument(removed_ngo_ids, expected):
+    spider = GuideStarSpider(ngo_ids="1,2", removed_ngo_ids=removed_ngo_ids)
+
+    assert spider.removed_ngo_ids == expected
@@ -0,0 +1,100 @@
+import pickle
+from typing import Optional, Union
+
+import attr
+import pytest
+from attrs_strict import BadTypeError
+
+from ngo_toolkit.scrapers.cfi_midot_scrapy.items import (
+    ITEMS_TYPE_VALIDATION_MODES,
+    NgoFinanceInfo,
+    NgoGeneralInfo,
+    NgoInfo,
+    type_validators_transformer,
+)
+
+
+def _report_class(mode: str):
+    """A small item class, shaped like `NgoFinanceInfo`, validated by `mode`"""
+
+    @attr.s(
+        frozen=True,
+        slots=True,
+        auto_attribs=True,
+        field_transformer=type_validators_transformer(mode),
+    )
+    class Report:
+        ngo_id: int
+        report_year: int
+        donations_from_israel: Union[int, float] = 0
+        expenses_other: Union[int, float] = 0
+        program_expense_ratio: Optional[float] = None
+        activity_fields: Optional[list[str]] = None
+
+    return Report
+
+
+VALID_REPORT = dict(
+    ngo_id=580000000,
+    report_year=2021,
+    donations_from_israel=1_000_000.5,
+    expenses_other=250_000,
+    program_expense_ratio=None,
+    activity_fields=["חינוך", "רווחה"],
+)
+
+
+@pytest.mark.parametrize("mode", ITEMS_TYPE_VALIDATION_MODES)
+def test_valid_items_pass_every_mode(mode):
+    report = _report_class(mode)(**VALID_REPORT)
+    assert report.activity_fields == ["חינוך", "רווחה"]
+
+
+@pytest.mark.parametrize("mode", ["strict", "fast"])
+@pytest.mark.parametrize(
+    "field, value",
+    [
+        ("ngo_id", "580000000"),
+        ("donations_from_israel", "1000"),
+        ("program_expense_ratio", 1),
+        ("activity_fields", ["חינוך", 1]),
+        ("activity_fields", "חינוך"),
+    ],
+)
+def test_invalid_items_are_rejected(mode, field, value):
+    with pytest.raises(BadTypeError):
+        _report_class(mode)(**{**VALID_REPORT, field: value})
+
+
+def test_unknown_mode_is_rejected():
+    with pytest.raises(ValueError):
+        type_validators_transformer("lenient")
+
+
+def _ngo_info() -> NgoInfo:
+    return NgoInfo(
+        ngo_id=580000000,
+        general_info=NgoGeneralInfo(ngo_id=580000000, ngo_name="עמותה"),
+        financial_info=[
+            NgoFinanceInfo(
+                ngo_id=580000000,
+                report_year=report_year,
+                donations_from_israel=donations,
+                expenses_salary_for_activities=donations / 2,
+            )
+            for report_year, donations in ((2021, 1_200_000.0), (2020, 900_000.0))
+        ],
+    )
+
+
+def test_items_pickle_round_trip():
+    ngo_info = _ngo_info()
+    # Computed once before pickling, cached values must survive the round trip too
+    assert ngo_info.last_financial_info.yearly_turnover == 1_200_000.0
+
+    unpickled = pickle.loads(pickle.dumps(ngo_info))
+
+    assert unpickled == ngo_info
+    assert unpickled.last_financial_info.yearly_turnover_category.name == "CAT_3M"
+    assert unpickled.financial_info[0].program_expense_ratio == 1.0
+    assert unpickled.growth_ratio == ngo_info.growth_ratio
@@ -0,0 +1,293 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from types import SimpleNamespace
+
+import pytest
+from scrapy import Request
+from scrapy.http import Response
+from scrapy.settings import Settings
+from scrapy.statscollectors import MemoryStatsCollector
+from twisted.internet.error import TimeoutError as DownloadTimeoutError
+
+from ngo_toolkit.scrapers.cfi_midot_scrapy import middlewares
+from ngo_toolkit.scrapers.cfi_midot_scrapy import settings as project_settings
+from ngo_toolkit.scrapers.cfi_midot_scrapy.middlewares import (
+    AimdConcurrencyMiddleware,
+    GuideStarRetryMiddleware,
+)
+
+URL = "https://www.guidestar.org.il/apexremote"
+
+
+def _crawler(**overrides) -> SimpleNamespace:
+    """The settings and stats of a crawler, and the slots of its downloader"""
+    settings = Settings()
+    settings.setmodule(project_settings)
+    settings.update(overrides)
+    crawler = SimpleNamespace(settings=settings)
+    crawler.stats = MemoryStatsCollector(crawler)
+    crawler.engine = SimpleNamespace(downloader=SimpleNamespace(slots={}))
+    return crawler
+
+
+def _response(request: Request, status: int, headers: dict = None) -> Response:
+    return Response(request.url, status=status, headers=headers, request=request)
+
+
+@pytest.fixture
+def retry_spider() -> SimpleNamespace:
+    # No backoff, so the retries are returned without waiting on the reactor
+    return SimpleNamespace(crawler=_crawler(GUIDESTAR_RETRY_BACKOFF_MAX=0))
+
+
+@pytest.fixture
+def retry_middleware(retry_spider) -> GuideStarRetryMiddleware:
+    return GuideStarRetryMiddleware(retry_spider.crawler.settings)
+
+
+@pytest.mark.parametrize(
+    "status, failure_class",
+    [
+        (200, None),
+        (400, None),
+        (403, None),
+        (404, "permanent"),
+        (410, "permanent"),
+        (429, "throttled"),
+        (503, "throttled"),
+        (500, "transient"),
+        (504, "transient"),
+    ],
+)
+def test_responses_are_classified_by_status(retry_middleware, status, failure_class):
+    response = _response(Request(URL), status)
+    assert retry_middleware._classify_response(response) == failure_class
+
+
+def test_retry_after_in_seconds_is_capped():
+    middleware = GuideStarRetryMiddleware(_crawler().settings)
+    request = Request(URL)
+    assert middleware._retry_after_delay(
+        _response(request, 429, {"Retry-After": "7"})
+    ) == pytest.approx(7)
+    assert middleware._retry_after_delay(
+        _response(request, 429, {"Retry-After": "3600"})
+    ) == pytest.approx(60)
+    assert middleware._retry_after_delay(_response(request, 429)) is None
+
+
+def test_retry_after_as_an_http_date():
+    middleware = GuideStarRetryMiddleware(_crawler().settings)
+    request = Request(URL)
+    retry_at = datetime.now(timezone.utc) + timedelta(seconds=30)
+    delay = middleware._retry_after_delay(
+        _response(request, 503, {"Retry-After": format_datetime(retry_at, usegmt=True)})
+    )
+    assert 28 <= delay <= 30
+
+    # A date in the past retries right away, a malformed one falls back to the backoff
+    retry_at = datetime.now(timezone.utc) - timedelta(seconds=30)
+    assert (
+        middleware._retry_after_delay(
+            _response(
+                request, 503, {"Retry-After": format_datetime(retry_at, usegmt=True)}
+            )
+        )
+        == 0
+    )
+    assert (
+        middleware._retry_after_delay(_response(request, 503, {"Retry-After": "soon"}))
+        is None
+    )
+
+
+def test_backoff_grows_with_the_retries_up_to_the_max():
+    middleware = GuideStarRetryMiddleware(_crawler().settings)
+    assert 0.5 <= middleware._backoff_delay(Request(URL)) <= 1.5
+    assert 2 <= middleware._backoff_delay(Request(URL, meta={"retry_times": 2})) <= 6
+    assert middleware._backoff_delay(
+        Request(URL, meta={"retry_times": 10})
+    ) == pytest.approx(60)
+
+
+def test_permanent_response_is_not_retried(retry_middleware, retry_spider):
+    request = Request(URL, meta={"ngo_id": 1})
+    response = _response(request, 404)
+    result = asyncio.run(
+        retry_middleware.process_response(request, response, retry_spider)
+    )
+    assert result is response
+    stats = retry_spider.crawler.stats
+    assert stats.get_value("guidestar/wasted_requests/permanent") == 1
+    assert stats.get_value("guidestar/ngo_missing") == 1
+
+
+def test_throttled_response_is_retried(retry_middleware, retry_spider):
+    request = Request(URL)
+    response = _response(request, 429, {"Retry-After": "5"})
+    result = asyncio.run(
+        retry_middleware.process_response(request, response, retry_spider)
+    )
+    assert isinstance(result, Request)
+    assert result.meta["retry_times"] == 1
+    stats = retry_spider.crawler.stats
+    assert stats.get_value("guidestar/wasted_requests/throttled") == 1
+
+
+def test_transient_response_gives_up_after_the_retry_times(
+    retry_middleware, retry_spider
+):
+    request = Request(URL, meta={"retry_times": project_settings.RETRY_TIMES})
+    response = _response(request, 500)
+    result = asyncio.run(
+        retry_middleware.process_response(request, response, retry_spider)
+    )
+    assert result is response
+    stats = retry_spider.crawler.stats
+    assert stats.get_value("guidestar/wasted_requests/transient") == 1
+    assert stats.get_value("guidestar/gave_up/transient") == 1
+
+
+def test_ok_and_dont_retry_responses_pass_through(retry_middleware, retry_spider):
+    request = Request(URL)
+    response = _response(request, 200)
+    assert (
+        asyncio.run(retry_middleware.process_response(request, response, retry_spider))
+        is response
+    )
+    request = Request(URL, meta={"dont_retry": True})
+    response = _response(request, 503)
+    assert (
+        asyncio.run(retry_middleware.process_response(request, response, retry_spider))
+        is response
+    )
+    assert retry_spider.crawler.stats.get_stats() == {}
+
+
+def test_timeouts_are_retried_as_transient(retry_middleware, retry_spider):
+    request = Request(URL)
+    result = asyncio.run(
+        retry_middleware.process_exception(
+            request, DownloadTimeoutError(), retry_spider
+        )
+    )
+    assert isinstance(result, Request)
+    assert (
+        retry_spider.crawler.stats.get_value("guidestar/wasted_requests/transient")
+        == 1
+    )
+    assert (
+        asyncio.run(
+            retry_middleware.process_exception(request, ValueError(), retry_spider)
+        )
+        is None
+    )
+
+
+@pytest.fixture
+def aimd_crawler() -> SimpleNamespace:
+    crawler = _crawler()
+    for slot_key in ("guidestar", "guidestar-dead-letter"):
+        crawler.engine.downloader.slots[slot_key] = SimpleNamespace(concurrency=8)
+    return crawler
+
+
+@pytest.fixture
+def clock(monkeypatch) -> SimpleNamespace:
+    clock = SimpleNamespace(now=100.0)
+    monkeypatch.setattr(
+        middlewares, "time", SimpleNamespace(monotonic=lambda: clock.now)
+    )
+    return clock
+
+
+def _slot_request(latency: float = 0.5, slot_key: str = "guidestar") -> Request:
+    return Request(URL, meta={"download_slot": slot_key, "download_latency": latency})
+
+
+def _respond(middleware, status: int, latency: float = 0.5, slot_key="guidestar"):
+    request = _slot_request(latency, slot_key)
+    return middleware.process_response(request, _response(request, status), None)
+
+
+def test_concurrency_grows_by_one_per_round_trip(aimd_crawler):
+    middleware = AimdConcurrencyMiddleware(aimd_crawler)
+    downloader_slot = aimd_crawler.engine.downloader.slots["guidestar"]
+    _respond(middleware, 200)
+    # The slot starts at AIMD_START_CONCURRENCY
+    assert downloader_slot.concurrency == project_settings.AIMD_START_CONCURRENCY
+
+    # A round trip is about `concurrency` responses
+    for _ in range(project_settings.AIMD_START_CONCURRENCY):
+        _respond(middleware, 200)
+    assert downloader_slot.concurrency == project_settings.AIMD_START_CONCURRENCY + 1
+
+
+def test_concurrency_stops_growing_over_the_target_latency(aimd_crawler):
+    middleware = AimdConcurrencyMiddleware(aimd_crawler)
+    for _ in range(50):
+        _respond(middleware, 200, latency=project_settings.AIMD_TARGET_LATENCY * 2)
+    assert (
+        middleware.slots["guidestar"].concurrency
+        == project_settings.AIMD_START_CONCURRENCY
+    )
+
+
+def test_concurrency_decreases_once_per_round_trip(aimd_crawler, clock):
+    middleware = AimdConcurrencyMiddleware(aimd_crawler)
+    _respond(middleware, 200, latency=1.0)
+    concurrency = middleware.slots["guidestar"].concurrency
+
+    # A burst of failures within the round trip (latency) is a single congestion event
+    _respond(middleware, 429)
+    clock.now += 0.5
+    _respond(middleware, 503)
+    middleware.process_exception(_slot_request(), DownloadTimeoutError(), None)
+    assert middleware.slots["guidestar"].concurrency == pytest.approx(
+        concurrency * project_settings.AIMD_DECREASE
+    )
+    assert aimd_crawler.engine.downloader.slots["guidestar"].concurrency == int(
+        concurrency * project_settings.AIMD_DECREASE
+    )
+
+    clock.now += 1
+    middleware.process_exception(_slot_request(), DownloadTimeoutError(), None)
+    assert middleware.slots["guidestar"].concurrency == pytest.approx(
+        concurrency * project_settings.AIMD_DECREASE**2
+    )
+    assert aimd_crawler.stats.get_value("aimd/guidestar/decreases") == 2
+
+
+def test_concurrency_does_not_decrease_under_the_min(aimd_crawler, clock):
+    middleware = AimdConcurrencyMiddleware(aimd_crawler)
+    for _ in range(20):
+        clock.now += 10
+        _respond(middleware, 500)
+    assert (
+        middleware.slots["guidestar"].concurrency
+        == project_settings.AIMD_MIN_CONCURRENCY
+    )
+
+
+def test_only_timeouts_are_congestion(aimd_crawler, clock):
+    middleware = AimdConcurrencyMiddleware(aimd_crawler)
+    assert middleware.process_exception(_slot_request(), ValueError(), None) is None
+    assert (
+        middleware.slots["guidestar"].concurrency
+        == project_settings.AIMD_START_CONCURRENCY
+    )
+
+
+def test_fixed_slots_keep_their_concurrency(aimd_crawler, clock):
+    middleware = AimdConcurrencyMiddleware(aimd_crawler)
+    for status in (200, 429, 200):
+        clock.now += 10
+        _respond(middleware, status, slot_key="guidestar-dead-letter")
+    middleware.process_exception(
+        _slot_request(slot_key="guidestar-dead-letter"), DownloadTimeoutError(), None
+    )
+    assert "guidestar-dead-letter" not in middleware.slots
+    dead_letter_slot = aimd_crawler.engine.downloader.slots["guidestar-dead-letter"]
+    assert dead_letter_slot.concurrency == 8
+    assert aimd_crawler.stats.get_stats() == {}
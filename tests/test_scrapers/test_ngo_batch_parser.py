@@ -0,0 +1,149 @@
+import json
+
+import pytest
+
+from ngo_toolkit.scrapers.cfi_midot_scrapy.ngo_batch_parser import (
+    parse_ngo_batch,
+    parse_ngo_finances_batch,
+)
+
+RESOURCES = ["general_info", "financial_info"]
+
+FINANCES = [{"Year": 2021, "Donations_Country": 2_000_000, "Expenses_Other": 1_000}]
+
+
+def _resource_reply(method: str, result, success: bool = True, **kwargs) -> dict:
+    return {
+        "statusCode": 200,
+        "method": method,
+        "result": {"success": success, "result": result},
+        **kwargs,
+    }
+
+
+def _reply(ngos: dict[int, list[dict]]) -> tuple[bytes, dict[int, int]]:
+    """A batched apexremote reply, for NGOs given as ngo_id: replies of its resources"""
+    reply, tid_to_ngo_id = [], {}
+    for ngo_id, resource_replies in ngos.items():
+        for resource_reply in resource_replies:
+            tid = 3 + len(reply)
+            tid_to_ngo_id[tid] = ngo_id
+            reply.append({**resource_reply, "tid": tid})
+    return json.dumps(reply).encode(), tid_to_ngo_id
+
+
+def test_unknown_ngos_are_missing_not_failed():
+    body, tid_to_ngo_id = _reply(
+        {
+            1: [
+                _resource_reply("getMalkarDetails", {"Name": "עמותה"}),
+                _resource_reply("getMalkarFinances", FINANCES),
+            ],
+            # No details at all
+            2: [
+                _resource_reply("getMalkarDetails", None),
+                _resource_reply("getMalkarFinances", []),
+            ],
+            # Failed with a "not found" message
+            3: [
+                {
+                    "statusCode": 400,
+                    "method": "getMalkarDetails",
+                    "type": "exception",
+                    "message": "Malkar not found",
+                },
+                _resource_reply("getMalkarFinances", None, success=False),
+            ],
+            # A transient failure, retried
+            4: [
+                {"statusCode": 500, "method": "getMalkarDetails", "message": "Error"},
+                _resource_reply("getMalkarFinances", FINANCES),
+            ],
+        }
+    )
+
+    parsed_batch = parse_ngo_batch(body, tid_to_ngo_id, RESOURCES)
+
+    assert [type(item).__name__ for item in parsed_batch.items] == [
+        "NgoInfo",
+        "dict",
+        "dict",
+    ]
+    assert parsed_batch.items[1:] == [
+        {"ngo_id": 2, "filter_reason": "missing"},
+        {"ngo_id": 3, "filter_reason": "missing"},
+    ]
+    assert list(parsed_batch.failed_resources) == [4]
+
+
+def test_unknown_ngos_are_missing_in_the_finances_phase():
+    body, tid_to_ngo_id = _reply(
+        {
+            1: [_resource_reply("getMalkarFinances", FINANCES)],
+            2: [
+                _resource_reply(
+                    "getMalkarFinances",
+                    None,
+                    success=False,
+                    message="לא נמצא ארגון",
+                )
+            ],
+        }
+    )
+
+    parsed_batch = parse_ngo_finances_batch(body, tid_to_ngo_id, ["financial_info"])
+
+    assert list(parsed_batch.finances_passed) == [1]
+    assert parsed_batch.items == [{"ngo_id": 2, "filter_reason": "missing"}]
+    assert parsed_batch.failed_resources == {}
+
+
+MALFORMED_BODIES = [
+    b"<html>Service Unavailable</html>",
+    b'[{"statusCode": 200, "tid": 3',
+    b'{"statusCode": 200}',
+    b'["unexpected"]',
+]
+
+
+@pytest.mark.parametrize("body", MALFORMED_BODIES)
+def test_malformed_reply_fails_every_ngo_resource(body):
+    tid_to_ngo_id = {3: 1, 4: 1, 5: 2, 6: 2}
+    scraped_resources = {1: [_resource_reply("getMalkarDetails", {"Name": "עמותה"})]}
+
+    parsed_batch = parse_ngo_batch(
+        body, tid_to_ngo_id, ["financial_info"], scraped_resources
+    )
+
+    assert parsed_batch.failed_resources == {
+        1: (["financial_info"], scraped_resources[1]),
+        2: (["financial_info"], []),
+    }
+    assert parsed_batch.items == []
+
+
+@pytest.mark.parametrize("body", MALFORMED_BODIES)
+def test_malformed_reply_fails_every_ngo_finances(body):
+    parsed_batch = parse_ngo_finances_batch(body, {3: 1, 4: 2}, ["financial_info"])
+
+    assert parsed_batch.failed_resources == {
+        1: (["financial_info"], []),
+        2: (["financial_info"], []),
+    }
+
+
+def test_resource_without_result_is_failed():
+    body, tid_to_ngo_id = _reply(
+        {
+            1: [
+                {"statusCode": 200, "method": "getMalkarDetails"},
+                _resource_reply("getMalkarFinances", FINANCES),
+            ]
+        }
+    )
+
+    parsed_batch = parse_ngo_batch(body, tid_to_ngo_id, RESOURCES)
+
+    [(failed, scraped)] = parsed_batch.failed_resources.values()
+    assert failed == ["general_info"]
+    assert [resource["method"] for resource in scraped] == ["getMalkarFinances"]
@@ -0,0 +1,83 @@
+import json
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import pytest
+from twisted.internet import defer, reactor
+
+from ngo_toolkit.scrapers.cfi_midot_scrapy.ngo_batch_parser import parse_ngo_batch
+from ngo_toolkit.scrapers.cfi_midot_scrapy.parse_executor import _deferred_from_future
+
+RESOURCES = ["general_info", "financial_info"]
+
+
+def _finance_report(report_year: int, donations: float) -> dict:
+    return {"Year": report_year, "Donations_Country": donations, "Expenses_Other": 1_000}
+
+
+def _remoting_reply(ngos: dict[int, float]) -> tuple[bytes, dict[int, int]]:
+    """A batched apexremote reply, for NGOs given as ngo_id: yearly donations"""
+    reply, tid_to_ngo_id = [], {}
+    for ngo_id, donations in ngos.items():
+        for method, result in (
+            ("getMalkarDetails", {"Name": f"עמותה {ngo_id}"}),
+            (
+                "getMalkarFinances",
+                [_finance_report(2021, donations), _finance_report(2020, donations)],
+            ),
+        ):
+            tid = 3 + len(reply)
+            tid_to_ngo_id[tid] = ngo_id
+            reply.append(
+                {
+                    "statusCode": 200,
+                    "tid": tid,
+                    "method": method,
+                    "result": {"success": True, "result": result},
+                }
+            )
+    return json.dumps(reply).encode(), tid_to_ngo_id
+
+
+def test_parse_ngo_batch_round_trips_through_a_process_pool():
+    # NGO 1 passes the turnover filter, NGO 2 is filtered out
+    body, tid_to_ngo_id = _remoting_reply({1: 2_000_000.0, 2: 10_000.0})
+    expected = parse_ngo_batch(body, tid_to_ngo_id, RESOURCES)
+    assert [type(item).__name__ for item in expected.items] == ["NgoInfo", "dict"]
+
+    with ProcessPoolExecutor(max_workers=1) as process_pool:
+        parsed_batch = process_pool.submit(
+            parse_ngo_batch, body, tid_to_ngo_id, RESOURCES
+        ).result()
+
+    assert parsed_batch == expected
+
+
+@pytest.fixture
+def call_from_thread_inline(monkeypatch):
+    # No reactor is running in the tests, fire the Deferreds right away
+    monkeypatch.setattr(
+        reactor, "callFromThread", lambda fn, *args: fn(*args), raising=False
+    )
+
+
+def test_deferred_from_future_result(call_from_thread_inline):
+    future = Future()
+    deferred = _deferred_from_future(future)
+    results = []
+    deferred.addCallback(results.append)
+
+    future.set_result(42)
+
+    assert results == [42]
+
+
+def test_deferred_from_cancelled_future(call_from_thread_inline):
+    future = Future()
+    deferred = _deferred_from_future(future)
+    failures = []
+    deferred.addErrback(failures.append)
+
+    future.cancel()
+
+    assert len(failures) == 1
+    assert failures[0].check(defer.CancelledError)
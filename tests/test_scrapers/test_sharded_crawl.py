@@ -0,0 +1,159 @@
+import csv
+import os
+import random
+import shutil
+
+import pytest
+from scrapy.settings import Settings
+
+from ngo_toolkit.scrapers.cfi_midot_scrapy.items import (
+    NgoFinanceInfo,
+    NgoGeneralInfo,
+    NgoInfo,
+)
+from ngo_toolkit.scrapers.cfi_midot_scrapy.pipelines import GuideStarMultiCSVExporter
+from ngo_toolkit.scrapers.sharded_crawl import (
+    DATASET_NAMES,
+    _sort_key,
+    _sort_shard_outputs,
+    merge_shards,
+    partition_ngo_ids,
+    shard_output_dir,
+)
+
+SHARD_COUNT = 3
+
+
+def _ngo_info(ngo_id: int, donations: float) -> NgoInfo:
+    return NgoInfo(
+        ngo_id=ngo_id,
+        general_info=NgoGeneralInfo(ngo_id=ngo_id, ngo_name=f"עמותה {ngo_id}"),
+        financial_info=[
+            NgoFinanceInfo(
+                ngo_id=ngo_id, report_year=report_year, donations_from_israel=donations
+            )
+            for report_year in (2020, 2021)
+        ],
+    )
+
+
+def _filtered(ngo_id: int) -> dict:
+    return dict(ngo_id=ngo_id, filter_reason="low_turnover")
+
+
+# NGOs 1-8 were all scraped by the previous crawl, 9 and 10 are new
+PREVIOUS_ITEMS = [_ngo_info(ngo_id, 1_000_000.0) for ngo_id in range(1, 7)] + [
+    _filtered(7),
+    _filtered(8),
+]
+# NGOs 1 and 2 are filtered out and 3, 4 updated on this run. 5, 6, 8 aren't scraped.
+ITEMS = [
+    _filtered(1),
+    _filtered(2),
+    _ngo_info(3, 2_000_000.0),
+    _ngo_info(4, 3_000_000.0),
+    _ngo_info(7, 4_000_000.0),
+    _ngo_info(9, 5_000_000.0),
+    _filtered(10),
+]
+
+
+def _export(items: list, output_dir: str, removed_ngo_ids: tuple = ()) -> None:
+    spider = type(
+        "Spider",
+        (),
+        {
+            "settings": Settings(
+                {
+                    "GUIDESTAR_OUTPUT_DIR": output_dir,
+                    "GUIDESTAR_EXPORT_FINANCE_BATCH_SIZE": 2,
+                }
+            ),
+            "removed_ngo_ids": list(removed_ngo_ids),
+        },
+    )()
+    exporter = GuideStarMultiCSVExporter()
+    exporter.open_spider(spider)
+    for item in items:
+        exporter.process_item(item, spider)
+    exporter.close_spider(spider)
+
+
+def _ngo_id(item) -> int:
+    return item["ngo_id"] if isinstance(item, dict) else item.ngo_id
+
+
+def _crawl_sharded(items: list, removed_ngo_ids: tuple = ()) -> None:
+    """Export the items as the shards of a sharded crawl would, then merge them"""
+    shards = partition_ngo_ids([_ngo_id(item) for item in items], SHARD_COUNT)
+    for shard_index, shard_ngo_ids in enumerate(shards):
+        output_dir = shard_output_dir(shard_index)
+        shutil.rmtree(output_dir, ignore_errors=True)
+        _export([item for item in items if _ngo_id(item) in shard_ngo_ids], output_dir)
+        _sort_shard_outputs(output_dir)
+    merge_shards(SHARD_COUNT, removed_ngo_ids=removed_ngo_ids)
+
+
+def _read_datasets(output_dir: str) -> dict[str, bytes]:
+    datasets = {}
+    for name in DATASET_NAMES:
+        with open(os.path.join(output_dir, f"{name}.csv"), "rb") as csv_file:
+            datasets[name] = csv_file.read()
+    return datasets
+
+
+def _sorted_rows(output_dir: str, name: str) -> list[dict]:
+    path = os.path.join(output_dir, f"{name}.csv")
+    with open(path, newline="", encoding="utf-8") as csv_file:
+        return sorted(csv.DictReader(csv_file), key=_sort_key)
+
+
+@pytest.fixture
+def previous_output(tmp_path, monkeypatch):
+    # The shards and the canonical datasets are at paths relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    _export(PREVIOUS_ITEMS, "data")
+    shutil.copytree("data", "previous")
+
+
+def test_merge_matches_the_non_sharded_crawl(previous_output):
+    shutil.copytree("previous", "non_sharded")
+    _export(ITEMS, "non_sharded")
+
+    _crawl_sharded(ITEMS)
+
+    for name in DATASET_NAMES:
+        assert _sorted_rows("data", name) == _sorted_rows("non_sharded", name), name
+    # The stale reports of the NGOs filtered out on this run are not carried over
+    finance_rows = _sorted_rows("data", "NgoFinanceInfo")
+    assert {int(row["ngo_id"]) for row in finance_rows} == {3, 4, 5, 6, 7, 9}
+
+
+def test_merge_is_deterministic(previous_output):
+    _crawl_sharded(ITEMS)
+    merged = _read_datasets("data")
+
+    for seed in range(3):
+        shutil.rmtree("data")
+        shutil.copytree("previous", "data")
+        shuffled_items = ITEMS.copy()
+        random.Random(seed).shuffle(shuffled_items)
+        _crawl_sharded(shuffled_items)
+
+        assert _read_datasets("data") == merged
+
+
+def test_ngos_removed_from_the_registry_are_not_carried_over(previous_output):
+    # NGO 5 has reports, 8 was filtered out, neither is scraped on this run
+    removed_ngo_ids = (5, 8)
+    shutil.copytree("previous", "non_sharded")
+    _export(ITEMS, "non_sharded", removed_ngo_ids)
+
+    _crawl_sharded(ITEMS, removed_ngo_ids)
+
+    for output_dir in ("data", "non_sharded"):
+        for name in DATASET_NAMES:
+            ngo_ids = {int(row["ngo_id"]) for row in _sorted_rows(output_dir, name)}
+            assert not ngo_ids & set(removed_ngo_ids), (output_dir, name)
+    for name in DATASET_NAMES:
+        assert _sorted_rows("data", name) == _sorted_rows("non_sharded", name), name